@@ -7,24 +7,77 @@ import asyncio
 import smartpot.available_pots as available_pots
 import smartpot.characteristics as characteristics
 import smartpot.connected_pots as connected_pots
+import smartpot.connection_scheduler as connection_scheduler
+import smartpot.events as events
 import smartpot.known_pots as known_pots
 import smartpot.measurements as measurements
+import smartpot.metrics as metrics
+import smartpot.pot_states as pot_states
+import smartpot.pump_dispatcher as pump_dispatcher
 import smartpot.pump_tasks as pump_tasks
 import smartpot.rest_api as rest_api
 import threading
+import time
 import traceback
 
+# The maximum number of pots to connect to concurrently per adapter.
+MAX_CONCURRENT_CONNECTS = 4
 
-# A thread that manages the connection to the Smart Pots.
+# The number of consecutive scan failures after which the adapter of a shard
+# is considered to have failed and its pots are moved to other shards.
+SHARD_MAX_SCAN_FAILURES = 3
+
+# The time in seconds a shard has to scan without failure after which it is
+# considered to work again.
+SHARD_RECOVERY_TIME = 60.0
+
+# The time in seconds to wait before scanning again after a scan failed. The
+# time is doubled for every consecutive failure up to
+# `SCAN_RETRY_MAX_INTERVAL`.
+SCAN_RETRY_INTERVAL = 1.0
+SCAN_RETRY_MAX_INTERVAL = 60.0
+
+# The number of measurement notifications received per pot (see `metrics`).
+notifications_received = metrics.Counter(
+    'smartpot_notifications_total',
+    'Number of received measurement notifications.', ['pot_id'])
+
+# The time at which the hub started (see `time.monotonic`) and the time in
+# seconds it took until all known pots were connected for the first time or
+# `None` if they have not been connected yet.
+start_time = time.monotonic()
+time_to_all_connected = None
+
+# Lock that ensures that `time_to_all_connected` is only recorded once.
+time_to_all_connected_lock = threading.Lock()
+
+
+# A thread that manages the connection to the Smart Pots via the adapter of
+# the given shard (see `connected_pots`).
+#
+# This thread scans for available Smart Pots continuously. As soon as a known
+# Smart Pot that is not connected advertises and is assigned to the shard of
+# this thread, a connection is established and we start to listen for
+# measurements and run pump tasks (see `pump_dispatcher`).
+#
+# Connections are established concurrently such that a slow or failing pot
+# does not delay the connections to other pots. If scanning fails repeatedly,
+# the adapter is considered to have failed and the pots of the shard are
+# disconnected such that they are reassigned to other shards.
 #
-# This thread periodically scans for available Smart Pots. If a known Smart Pot
-# is available, a connection is established and we start to listen for
-# measurements and run pending pump tasks.
+# In the `scheduled` connection mode (see `connection_scheduler`), the pots
+# that are assigned to the shard are not kept connected. Instead, they are
+# visited one after another using at most `CONNECTION_SLOTS` connections at
+# the same time.
 class ConnectionThread (threading.Thread):
-    def __init__(self):
+    def __init__(self, shard):
         threading.Thread.__init__(self)
         self.deamon = True
+        self.name = f'Connection Thread {shard.name}'
+        self.shard = shard
         self.event_loop = asyncio.new_event_loop()
+        self.pot_ids = {}
+        self.scan_failures = 0
 
     def run(self):
         asyncio.set_event_loop(self.event_loop)
@@ -32,74 +85,245 @@ class ConnectionThread (threading.Thread):
 
     # Main loop of the thread.
     async def loop(self):
+        self.connect_semaphore = asyncio.Semaphore(MAX_CONCURRENT_CONNECTS)
+        self.connecting = set()
+        connected_pots.add_disconnect_listener(self.on_pot_disconnected)
+        if connection_scheduler.is_enabled():
+            self.devices = {}
+            self.visiting = set()
+            self.slot_freed = asyncio.Event()
+            asyncio.ensure_future(self.run_scheduler())
         while True:
+            recovered = self.event_loop.call_later(SHARD_RECOVERY_TIME,
+                                                   self.on_shard_recovered)
             try:
-                await self.run_scan()
-                await self.run_connect()
+                await available_pots.scan_continuously(
+                    self.is_pot_missing, self.on_pot_advertised,
+                    self.shard.adapter)
             except Exception as e:
+                recovered.cancel()
                 print(f'Error: {e}')
                 traceback.print_exc()
+                self.scan_failures += 1
+                if self.scan_failures >= SHARD_MAX_SCAN_FAILURES:
+                    await self.fail_over()
+                await asyncio.sleep(min(
+                    SCAN_RETRY_INTERVAL * 2 ** (self.scan_failures - 1),
+                    SCAN_RETRY_MAX_INTERVAL))
 
-    # Scans to find available pots.
-    async def run_scan(self):
-        await available_pots.scan(10.0)
-
-    # Connects to available known pots.
-    async def run_connect(self):
-        for device in available_pots.get_available_pots():
-            # Try to connect if the pot is known.
-            if known_pots.is_pot_known_addr(device.address):
-                pot_id = known_pots.lookup_known_pot_id(device.address)
-                client = await connected_pots.connect(device)
-                if client is None:
-                    continue
-
-                # Enable notifications for the soil moisture and water level
-                # characteristics.
-                def on_measurements(data):
-                    measurements.add_measurement(pot_id, *data)
-                await characteristics.subscribe_measurements(client, on_measurements)
-
-                # Enqueue pump tasks for the pot that have not been completed
-                # yet because the pot was not connected when the task was
-                # created.
-                for task in pump_tasks.get_pending_tasks_of(pot_id):
-                    pump_tasks.enqueue_pump_task(task)
-
-
-connectionThread = ConnectionThread()
-connectionThread.start()
-
-
-# A thread that blocks until a new pump task is scheduled and then runs that
-# task in the `connectThread`s event loop.
-class PumpThread(threading.Thread):
-    def __init__(self):
-        threading.Thread.__init__(self)
-        self.deamon = True
+    # Marks the shard as working again after it scanned without failure for
+    # `SHARD_RECOVERY_TIME` seconds.
+    def on_shard_recovered(self):
+        self.scan_failures = 0
+        connected_pots.restore_shard(self.shard)
 
-    def run(self):
-        # Executes the given pump task.
-        async def run_task(task):
-            addr = known_pots.lookup_known_pot_addr(task.pot_id)
-            if connected_pots.is_connected(addr):
-                client = connected_pots.get_pot_by_addr(addr)
-                await characteristics.write_pump_amount(client, task.amount)
-                pump_tasks.set_task_execution_date(task)
-
-        # Run pump tasks in the event loop of the `connectionThread`.
+    # Marks the shard as failed and disconnects its pots such that they are
+    # reassigned to other shards.
+    async def fail_over(self):
+        addrs = connected_pots.fail_shard(self.shard)
+        if addrs:
+            print(f'Moving {len(addrs)} pots from failed adapter '
+                  f'{self.shard.name} to other adapters')
+        for addr in addrs:
+            await connected_pots.disconnect(addr)
+
+    # Tests whether there is a known pot that is not connected.
+    #
+    # In the `scheduled` connection mode, pots are only connected while they
+    # are visited such that scanning never stops.
+    def is_pot_missing(self):
+        if connection_scheduler.is_enabled():
+            return True
+        return not all(map(connected_pots.is_connected,
+                           known_pots.get_known_pot_addrs()))
+
+    # Starts to connect to the advertising device if it is a known pot that is
+    # neither connected nor being connected to and is assigned to the shard of
+    # this thread.
+    #
+    # At most `MAX_CONCURRENT_CONNECTS` connections are established at the
+    # same time.
+    #
+    # In the `scheduled` connection mode, the device is remembered such that
+    # it can be visited by the scheduler instead.
+    def on_pot_advertised(self, device):
+        addr = device.address
+        if connection_scheduler.is_enabled():
+            if (known_pots.is_pot_known_addr(addr)
+                    and connected_pots.claim_pot(addr, self.shard)):
+                self.devices[addr] = device
+        elif (known_pots.is_pot_known_addr(addr)
+                and not connected_pots.is_connected(addr)
+                and addr not in self.connecting
+                and connected_pots.claim_pot(addr, self.shard)):
+            self.connecting.add(addr)
+            asyncio.ensure_future(self.connect_pot(device))
+
+    # Connects to the given available known pot and reports errors.
+    #
+    # If the pot could not be connected, it is released from the shard such
+    # that another shard may connect to it.
+    async def connect_pot(self, device):
+        try:
+            await self.set_up_pot(device)
+        except Exception as e:
+            print(f'Error: Failed to set up {device.address}: {e}')
+        finally:
+            self.connecting.discard(device.address)
+        if not connected_pots.is_connected(device.address):
+            connected_pots.release_pot(device.address, self.shard)
+        record_time_to_all_connected()
+
+    # Connects to the given available known pot.
+    #
+    # Database operations are awaited such that other pots are not blocked
+    # while the database is busy.
+    async def set_up_pot(self, device):
+        pot_id = known_pots.lookup_known_pot_id(device.address)
+        async with self.connect_semaphore:
+            client = await connected_pots.connect(device, self.shard.adapter)
+        if client is None:
+            return
+        self.on_pot_connected(device.address, pot_id)
+
+        # Enable notifications for the soil moisture and water level
+        # characteristics. Measurements are buffered such that the callback
+        # does not block the event loop.
+        def on_measurements(samples, interval):
+            if metrics.ENABLED:
+                notifications_received.inc(pot_id)
+            measurements.add_measurements(pot_id, samples, interval)
+        await characteristics.subscribe_measurements(client, on_measurements)
+
+        # Start to execute pump tasks including the tasks that have not been
+        # completed yet because the pot was not connected when the task was
+        # created.
+        await pump_dispatcher.start_worker(pot_id, client)
+
+    # Visits the due pots of the shard whenever a connection slot is free.
+    #
+    # Errors are reported such that the scheduler keeps running.
+    async def run_scheduler(self):
         while True:
-            task = pump_tasks.dequeue_pump_task()
-            coro = run_task(task)
-            asyncio.run_coroutine_threadsafe(coro, connectionThread.event_loop)
+            self.slot_freed.clear()
+            try:
+                self.schedule_visits()
+            except Exception as e:
+                print(f'Error: {e}')
+                traceback.print_exc()
+            try:
+                await asyncio.wait_for(self.slot_freed.wait(),
+                                       connection_scheduler.SCHEDULE_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    # Starts to visit due pots until all connection slots are in use.
+    #
+    # Pots that are no longer known are forgotten. Pots that have been
+    # assigned to another shard in the meantime are skipped.
+    def schedule_visits(self):
+        for addr in list(self.devices):
+            if not known_pots.is_pot_known_addr(addr):
+                del self.devices[addr]
+        devices = {
+            addr: device for addr, device in self.devices.items()
+            if addr not in self.visiting
+            and connected_pots.get_shard(addr) is self.shard}
+        free_slots = connection_scheduler.CONNECTION_SLOTS - len(
+            self.visiting)
+        for device in connection_scheduler.select_due_pots(devices,
+                                                           free_slots):
+            self.visiting.add(device.address)
+            asyncio.ensure_future(self.visit_pot(device))
+
+    # Connects to the given pot, visits it (see `connection_scheduler.visit`),
+    # disconnects and frees its connection slot afterwards.
+    #
+    # If the visit failed, the pot is released from the shard such that it
+    # is visited by the shard that receives its next advertisement.
+    async def visit_pot(self, device):
+        addr = device.address
+        visited = False
+        try:
+            pot_id = known_pots.lookup_known_pot_id(addr)
+            client = await connected_pots.connect(device, self.shard.adapter)
+            if client is not None:
+                self.on_pot_connected(addr, pot_id)
+                try:
+                    visited = await connection_scheduler.visit(client, pot_id)
+                finally:
+                    await connected_pots.disconnect(addr)
+        except Exception as e:
+            print(f'Error: Failed to visit {addr}: {e}')
+        finally:
+            self.visiting.discard(addr)
+            self.slot_freed.set()
+        if not visited:
+            self.devices.pop(addr, None)
+            connected_pots.release_pot(addr, self.shard)
+
+    # Remembers that the pot with the given address and ID has been connected
+    # by this thread and notifies subscribers.
+    def on_pot_connected(self, addr, pot_id):
+        self.pot_ids[addr] = pot_id
+        pot_states.update_pot_state(pot_id)
+        events.publish('online', pot_id, True)
+
+    # Stops to execute pump tasks of the disconnected pot with the given
+    # address, releases it from the shard and notifies subscribers.
+    #
+    # Disconnect listeners are called for the pots of all shards. Only the
+    # thread of the shard that connected the pot reacts. In the `scheduled`
+    # connection mode, pots are disconnected after every visit. Thus, they are
+    # only released if the visit failed (see `visit_pot`).
+    def on_pot_disconnected(self, addr):
+        if addr in self.pot_ids:
+            pot_id = self.pot_ids.pop(addr)
+            pump_dispatcher.stop_worker(pot_id)
+            if not connection_scheduler.is_enabled():
+                connected_pots.release_pot(addr, self.shard)
+            pot_states.update_pot_state(pot_id)
+            events.publish('online', pot_id, False)
+
+
+# Records and prints how long it took until all known pots were connected for
+# the first time.
+def record_time_to_all_connected():
+    global time_to_all_connected
+    with time_to_all_connected_lock:
+        if time_to_all_connected is not None:
+            return
+        addrs = known_pots.get_known_pot_addrs()
+        if all(connected_pots.is_connected(addr) for addr in addrs):
+            time_to_all_connected = time.monotonic() - start_time
+            print(f'Connected to all {len(addrs)} known pots after '
+                  f'{time_to_all_connected:.1f}s')
+
+
+# Gets the time it took until all known pots were connected for the first time
+# or nothing if they have not been connected yet.
+def get_time_to_all_connected():
+    if time_to_all_connected is None:
+        return []
+    return [((), time_to_all_connected)]
+
 
+metrics.CallbackGauge('smartpot_time_to_all_connected_seconds',
+                      'Time until all known pots were connected.', [],
+                      get_time_to_all_connected)
 
-pumpThread = PumpThread()
-pumpThread.start()
+# Start one connection thread per adapter.
+connectionThreads = [ConnectionThread(shard)
+                     for shard in connected_pots.shards]
+for connectionThread in connectionThreads:
+    connectionThread.start()
 
 
-# Removes old database entries once per day.
+# Removes old database entries, archives old measurements and creates
+# partitions for new measurements once per day.
 def run_periodic_cleanup():
+    measurements.create_upcoming_partitions()
+    measurements.archive_old_measurements()
     measurements.remove_old_measurements()
     pump_tasks.remove_old_history_entries()
 
@@ -109,5 +333,9 @@ def run_periodic_cleanup():
 
 run_periodic_cleanup()
 
-# Run the REST API in the main thread.
+# Run the REST API in the main thread. Coroutine routes run in the event loop
+# of the first connection thread. Operations on pots of other shards are
+# routed to the event loop of their shard (see `connected_pots.disconnect`
+# and `pump_dispatcher.dispatch`).
+rest_api.set_event_loop(connectionThreads[0].event_loop)
 rest_api.run(host="0.0.0.0")
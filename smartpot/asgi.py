@@ -0,0 +1,207 @@
+# This module serves the REST API (see `rest_api`) as an ASGI application.
+#
+# The ASGI server runs in the event loop of the connection thread. Requests
+# are dispatched to the routes of the Flask application directly in that
+# event loop. Thus, coroutine routes can await database queries and Bluetooth
+# operations without any thread switches. Since Flask builds the responses, the
+# JSON contract of the API is the same as with Flask's development server.
+#
+# The server requires `uvicorn`, which is only imported when the ASGI server
+# is started.
+
+import asyncio
+import inspect
+import io
+import smartpot.rest_api as rest_api
+import sys
+
+from flask import request
+
+# The maximum number of bytes in the body of a request.
+MAX_REQUEST_BODY_SIZE = 1024 * 1024
+
+
+# Serves the REST API with `uvicorn` on the given host and port in the given
+# event loop and blocks until the server stops.
+def run(event_loop, host, port):
+    import uvicorn
+
+    config = uvicorn.Config(app, host=host, port=port, lifespan='off')
+    server = uvicorn.Server(config)
+    asyncio.run_coroutine_threadsafe(server.serve(), event_loop).result()
+
+
+# The ASGI application that handles requests of the REST API.
+async def app(scope, receive, send):
+    if scope['type'] != 'http':
+        return
+    body = await receive_body(scope, receive)
+    if body is None:
+        await send_status(send, 413)
+        return
+    response = await dispatch_request(build_environ(scope, body))
+    try:
+        await send_response(response, receive, send)
+    finally:
+        response.close()
+
+
+# Receives the body of the request with the given ASGI scope.
+#
+# Returns `None` without reading the rest of the body as soon as the body is
+# known to exceed `MAX_REQUEST_BODY_SIZE` bytes.
+async def receive_body(scope, receive):
+    for name, value in scope['headers']:
+        if (name.lower() == b'content-length' and value.isdigit()
+                and int(value) > MAX_REQUEST_BODY_SIZE):
+            return None
+    body = bytearray()
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if len(body) > MAX_REQUEST_BODY_SIZE:
+            return None
+        if not message.get('more_body', False):
+            return bytes(body)
+
+
+# Sends a response with the given status code and without body.
+async def send_status(send, status):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-length', b'0'), (b'connection', b'close')],
+    })
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+# Creates a WSGI environment for the request with the given ASGI scope and
+# body such that the request can be handled by Flask.
+def build_environ(scope, body):
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': f'HTTP/{scope["http_version"]}',
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': False,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name != 'CONTENT_LENGTH':
+            key = 'HTTP_' + name
+            environ[key] = (environ[key] + ',' + value if key in environ
+                            else value)
+    return environ
+
+
+# Handles the request with the given WSGI environment like Flask would and
+# returns the response.
+#
+# Coroutine routes are awaited in the current event loop.
+async def dispatch_request(environ):
+    api = rest_api.api
+    with api.request_context(environ):
+        try:
+            try:
+                if request.routing_exception is not None:
+                    raise request.routing_exception
+                result = api.preprocess_request()
+                if result is None:
+                    route = api.view_functions[request.url_rule.endpoint]
+                    result = route(**request.view_args)
+                if inspect.isawaitable(result):
+                    result = await result
+            except Exception as e:
+                result = api.handle_user_exception(e)
+            return api.finalize_request(result)
+        except Exception as e:
+            return api.handle_exception(e)
+
+
+# Sends the given response.
+#
+# The body of streamed responses (e.g., exports) is produced in a thread of
+# the default executor since it may query the database. Bodies that can be
+# iterated asynchronously (e.g., event streams) are iterated in the event loop
+# until the client disconnects.
+async def send_response(response, receive, send):
+    await send({
+        'type': 'http.response.start',
+        'status': response.status_code,
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                    for name, value in response.headers.items()],
+    })
+    if not response.is_streamed:
+        await send({'type': 'http.response.body', 'body': response.get_data()})
+        return
+
+    if hasattr(response.response, '__aiter__'):
+        await send_async_body(response.response, receive, send)
+        return
+
+    loop = asyncio.get_running_loop()
+    chunks = response.iter_encoded()
+    while True:
+        chunk = await loop.run_in_executor(None, next, chunks, None)
+        if chunk is None:
+            break
+        await send_chunk(send, chunk)
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+# Sends the given asynchronously iterable body until it is exhausted or the
+# client disconnects.
+async def send_async_body(body, receive, send):
+    chunks = body.__aiter__()
+    disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+    next_chunk = None
+    try:
+        while not disconnected.done():
+            next_chunk = asyncio.ensure_future(chunks.__anext__())
+            await asyncio.wait([next_chunk, disconnected],
+                               return_when=asyncio.FIRST_COMPLETED)
+            if next_chunk.done():
+                try:
+                    chunk = next_chunk.result()
+                except StopAsyncIteration:
+                    break
+                await send_chunk(send, chunk)
+        else:
+            return
+    finally:
+        disconnected.cancel()
+        if next_chunk is not None and not next_chunk.done():
+            next_chunk.cancel()
+            await asyncio.wait([next_chunk])
+        await chunks.aclose()
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+# Sends the given chunk of a streamed body.
+async def send_chunk(send, chunk):
+    await send({
+        'type': 'http.response.body',
+        'body': chunk.encode() if isinstance(chunk, str) else chunk,
+        'more_body': True,
+    })
+
+
+# Waits until the client disconnects.
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
@@ -1,35 +1,174 @@
-# This module defines a function for scanning for Smart Pot devices that are
-# in reach of the Smart Pot Hub. The scan result is saved until the next scan.
+# This module scans continuously for Smart Pot devices that are in reach of the
+# Smart Pot Hub.
+#
+# Advertisements are processed as soon as they are received. The latest
+# advertisement of every Smart Pot is remembered until the pot has not been
+# seen for `AVAILABLE_POT_TIMEOUT` seconds. The scanner calls a listener to
+# react to advertisements immediately (e.g., to connect to a known pot).
+#
+# If the hub uses multiple Bluetooth adapters, every adapter runs its own
+# scanner (see `connected_pots.ADAPTERS`).
+#
+# Scanning keeps the radio busy. Therefore, the scanner only runs all the time
+# while a pot is missing (e.g., a known pot that is not connected). Otherwise,
+# it scans for `SCAN_WINDOW` seconds at increasing intervals of up to
+# `SCAN_IDLE_MAX_INTERVAL` seconds to keep the list of available pots up to
+# date.
 
 import asyncio
-import bleak
-import bleak.backends.device
+import collections
 import smartpot.characteristics as characteristics
+import smartpot.metrics as metrics
+import smartpot.transport as transport
+import time
 
-from typing import List
+from typing import Dict
 
-# The pots discovered during the last scan.
-available_pots: List[bleak.backends.device.BLEDevice] = []
+# The time in seconds after which a pot that has not advertised is no longer
+# considered available.
+AVAILABLE_POT_TIMEOUT = 60.0
 
+# The duration in seconds of a scan while no pot is missing.
+SCAN_WINDOW = 5.0
 
-# Tests whether the given device advertised the smart pot service.
-def has_smart_pot_service(device):
-    return characteristics.SERVICE_UUID in device.metadata['uuids']
+# The minimum and maximum time in seconds between two scans while no pot is
+# missing. The time is doubled after every scan that did not find a missing
+# pot.
+SCAN_IDLE_MIN_INTERVAL = 10.0
+SCAN_IDLE_MAX_INTERVAL = 120.0
 
+# The time in seconds between two checks whether a pot is missing.
+SCAN_POLL_INTERVAL = 1.0
 
-# Listens for advertisements of smart pot devices for the given duration in
-# seconds.
-async def scan(duration):
-    global available_pots
+# The latest advertisement of a Smart Pot.
+#
+# The `last_seen` field contains the time of the advertisement as returned by
+# `time.monotonic`.
+AvailablePot = collections.namedtuple('AvailablePot', [
+    'device',
+    'rssi',
+    'last_seen',
+])
 
-    devices = await bleak.BleakScanner.discover(duration)
-    available_pots = list(filter(has_smart_pot_service, devices))
+# Dictionary that maps the addresses of discovered pots to their latest
+# advertisement.
+available_pots: Dict[str, AvailablePot] = {}
 
-    # Print addresses of available pots.
-    s = ', '.join([device.address for device in available_pots])
-    print('Available Pots: ' + s)
+# Metrics of scans (see `metrics`).
+scan_duration_seconds = metrics.Histogram(
+    'smartpot_scan_duration_seconds', 'Duration of scans.',
+    buckets=(1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0))
+scan_devices_found = metrics.Histogram(
+    'smartpot_scan_devices_found', 'Number of Smart Pots found per scan.',
+    buckets=(0, 1, 5, 10, 50, 100, 500, 1000))
+advertisements_received = metrics.Counter(
+    'smartpot_advertisements_total',
+    'Number of received advertisements of Smart Pots.')
 
 
-# Gets a list of all smart pots that were discovered during the last scan.
+# Tests whether the given advertisement advertised the smart pot service.
+def has_smart_pot_service(advertisement_data):
+    return characteristics.SERVICE_UUID in advertisement_data.service_uuids
+
+
+# Handles an advertisement received by a scanner.
+#
+# Returns whether the advertisement has been sent by a Smart Pot.
+def on_detection(device, advertisement_data):
+    if not has_smart_pot_service(advertisement_data):
+        return False
+    if metrics.ENABLED:
+        advertisements_received.inc()
+    if device.address not in available_pots:
+        print(f'Discovered Pot: {device.address}')
+    available_pots[device.address] = AvailablePot(
+        device, advertisement_data.rssi, time.monotonic())
+    return True
+
+
+# Scans for Smart Pots with the given adapter (or the default adapter of the
+# transport) until the task is cancelled.
+#
+# The given listener is called with the device of every advertisement of a
+# Smart Pot that is received by the scanner. It is called in the event loop of
+# the scanner and must not block.
+#
+# The given function is called to test whether a pot is missing. While it
+# returns `True`, the scanner runs without interruption. Otherwise, the
+# scanner backs off (see the module comment).
+async def scan_continuously(is_pot_missing, listener, adapter=None):
+    scanner = Scanner(listener, adapter)
+    idle_interval = SCAN_IDLE_MIN_INTERVAL
+    while True:
+        if is_pot_missing():
+            idle_interval = SCAN_IDLE_MIN_INTERVAL
+            await scan_while(scanner, is_pot_missing)
+        else:
+            await scan_for(scanner, SCAN_WINDOW)
+            await sleep_unless(is_pot_missing, idle_interval)
+            idle_interval = min(2 * idle_interval, SCAN_IDLE_MAX_INTERVAL)
+
+
+# A scanner of the transport that calls the given listener with the device of
+# every advertisement of a Smart Pot and records the metrics of its scans.
+class Scanner:
+    def __init__(self, listener, adapter):
+        kw_args = {} if adapter is None else {'adapter': adapter}
+        self._scanner = transport.Scanner(
+            detection_callback=self.on_detection, **kw_args)
+        self._listener = listener
+        self._start_time = None
+        self._found_addrs = set()
+
+    def on_detection(self, device, advertisement_data):
+        if on_detection(device, advertisement_data):
+            if metrics.ENABLED:
+                self._found_addrs.add(device.address)
+            self._listener(device)
+
+    async def start(self):
+        self._found_addrs.clear()
+        await self._scanner.start()
+        self._start_time = time.perf_counter()
+
+    async def stop(self):
+        await self._scanner.stop()
+        if metrics.ENABLED:
+            scan_duration_seconds.observe(
+                time.perf_counter() - self._start_time)
+            scan_devices_found.observe(len(self._found_addrs))
+
+
+# Runs the given scanner as long as the given function returns `True`.
+async def scan_while(scanner, condition):
+    await scanner.start()
+    try:
+        while condition():
+            await asyncio.sleep(SCAN_POLL_INTERVAL)
+    finally:
+        await scanner.stop()
+
+
+# Runs the given scanner for the given duration in seconds.
+async def scan_for(scanner, duration):
+    await scanner.start()
+    try:
+        await asyncio.sleep(duration)
+    finally:
+        await scanner.stop()
+
+
+# Waits for the given duration in seconds or until the given function returns
+# `True`.
+async def sleep_unless(condition, duration):
+    end = time.monotonic() + duration
+    while not condition() and time.monotonic() < end:
+        await asyncio.sleep(SCAN_POLL_INTERVAL)
+
+
+# Gets a list of the latest advertisements of all smart pots that have been
+# seen during the last `AVAILABLE_POT_TIMEOUT` seconds.
 def get_available_pots():
-    return available_pots.copy()
+    min_last_seen = time.monotonic() - AVAILABLE_POT_TIMEOUT
+    return [pot for pot in list(available_pots.values())
+            if pot.last_seen >= min_last_seen]
@@ -4,6 +4,19 @@
 # There are two characteristics: one to read measurement data and one to
 # control the pump relay. To avoid polling the measurement characteristics
 # notifications can be used (see `subscribe_measurements`).
+#
+# The value of the measurements characteristic is a frame of one or more
+# samples of the soil moisture and water level sensors. Every sample consists
+# of two little-endian `uint16` values (soil moisture, water level). Pots
+# that sample more often than they notify send versioned frames with a header
+# that contains the marker `FRAME_MARKER` (`uint8`), the version (`uint8`),
+# the number of samples (`uint8`) and the time in seconds between two samples
+# (little-endian `uint16`), followed by the samples from the oldest to the
+# latest. Legacy pots send a single sample without header. Since the header
+# has five bytes, frames of four bytes are always legacy frames and all other
+# frames are versioned frames.
+
+import struct
 
 # The UUID of the smart pot service.
 SERVICE_UUID = 'b62a0000-069a-4fc6-9d5b-1daadc0cda33'
@@ -14,30 +27,83 @@ MEASUREMENTS_UUID = 'b62a0001-069a-4fc6-9d5b-1daadc0cda33'
 # The UUID of the pump relay characteristic.
 PUMP_AMOUNT_UUID = 'b62a0002-069a-4fc6-9d5b-1daadc0cda33'
 
+# The format of a sample of the measurements characteristic.
+SAMPLE_FORMAT = struct.Struct('<HH')
+
+# The format of the header of a versioned frame of the measurements
+# characteristic.
+FRAME_HEADER_FORMAT = struct.Struct('<BBBH')
+
+# The first byte of every versioned frame of the measurements characteristic.
+FRAME_MARKER = 0xA5
+
+# The version of the frames of the measurements characteristic that is
+# supported.
+FRAME_VERSION = 1
 
-# Decodes the value of the soi moisture and water level characteristic.
+
+# Decodes a frame of the soil moisture and water level characteristic.
+#
+# Returns a tuple of the list of `(soil_moisture, water_level)` samples from
+# the oldest to the latest and the time in seconds between two samples. Legacy
+# frames contain a single sample whose interval is zero. Versioned frames may
+# contain no samples. Since measurements are saved with a resolution of one
+# second, the interval of versioned frames with multiple samples must not be
+# zero.
+#
+# Raises a `ValueError` if the frame is malformed or its version is not
+# supported.
 def decode_measurements(byte_value):
-    soil_moisture = int.from_bytes(byte_value[0:2], byteorder='little')
-    water_level = int.from_bytes(byte_value[2:4], byteorder='little')
-    return soil_moisture, water_level
+    if len(byte_value) == SAMPLE_FORMAT.size:
+        return [SAMPLE_FORMAT.unpack(byte_value)], 0
+    if len(byte_value) < FRAME_HEADER_FORMAT.size:
+        raise ValueError(f'Measurement frame too short: {len(byte_value)}')
+    marker, version, count, interval = FRAME_HEADER_FORMAT.unpack_from(
+        byte_value)
+    if marker != FRAME_MARKER:
+        raise ValueError(f'Invalid measurement frame marker: {marker}')
+    if version != FRAME_VERSION:
+        raise ValueError(f'Unsupported measurement frame version: {version}')
+    if count > 1 and interval == 0:
+        raise ValueError(f'Measurement frame with {count} samples has no '
+                         f'interval')
+    size = FRAME_HEADER_FORMAT.size + count * SAMPLE_FORMAT.size
+    if len(byte_value) != size:
+        raise ValueError(f'Measurement frame with {count} samples has '
+                         f'{len(byte_value)} bytes')
+    samples = memoryview(byte_value)[FRAME_HEADER_FORMAT.size:]
+    return list(SAMPLE_FORMAT.iter_unpack(samples)), interval
 
 
 # Reads the soil moisture and water level characteristic of the given connected
 # pot and returns a future of the result.
 #
 # The result is a tuple where the first element is the soil moisture
-# measurement and the second value is the water level measurement.
+# measurement and the second value is the water level measurement. If the pot
+# returns multiple samples, the latest sample is returned. Raises a
+# `ValueError` if the pot returns a malformed frame or no samples.
 async def read_measurements(client):
     byte_value = await client.read_gatt_char(MEASUREMENTS_UUID)
-    return decode_measurements(byte_value)
+    samples, _ = decode_measurements(byte_value)
+    if not samples:
+        raise ValueError('Measurement frame has no samples')
+    return samples[-1]
 
 
 # Enables notifications for the soil moisture and water level characteristic
 # of the give connected pot.
+#
+# The callback is called with the samples and the interval of every frame
+# (see `decode_measurements`). Malformed frames are reported and dropped.
 async def subscribe_measurements(client, callback):
     def listener(sender, data):
-        measurements = decode_measurements(data)
-        callback(measurements)
+        try:
+            samples, interval = decode_measurements(data)
+        except ValueError as e:
+            print(f'Error: Dropped measurements of {client.address}: {e}')
+            return
+        if samples:
+            callback(samples, interval)
     await client.start_notify(MEASUREMENTS_UUID, listener)
 
 
@@ -1,29 +1,288 @@
 # This module provides methods to manage the Bluetooth connection to Smart Pots.
+#
+# Failed connection attempts are retried with an exponential backoff per
+# device such that pots that are out of range or broken do not occupy the
+# adapter all the time.
+#
+# A single adapter can only hold a few connections. Therefore, the hub can use
+# multiple adapters (see `ADAPTERS`). Every adapter is managed by a shard that
+# scans and connects with its own adapter in its own event loop. A pot is
+# assigned to the shard with the fewest pots among the shards whose adapter
+# received an advertisement of the pot recently (see `claim_pot`). The
+# assignment is kept until the pot disconnects. If the adapter of a shard
+# fails, its pots are released and reassigned to the other shards (see
+# `fail_shard`). The client of a pot must only be used in the event loop of
+# its shard (see `disconnect`).
+
+import asyncio
+import os
+import smartpot.metrics as metrics
+import smartpot.transport as transport
+import threading
+import time
+
+from typing import Callable, Dict, List, Tuple
+
+# The maximum time in seconds to wait for a connection to be established.
+CONNECT_TIMEOUT = 20.0
+
+# The time in seconds to wait before the connection to a device is retried
+# after the first failed attempt. The time is doubled for every subsequent
+# failed attempt up to `CONNECT_BACKOFF_MAX`.
+CONNECT_BACKOFF_BASE = 5.0
+
+# The maximum time in seconds to wait before a connection is retried.
+CONNECT_BACKOFF_MAX = 300.0
+
+# The names of the Bluetooth adapters that are used to connect to Smart Pots
+# as a comma separated list (e.g., `hci0,hci1`). If no adapter is given, the
+# default adapter of the transport is used.
+ADAPTERS = [adapter for adapter
+            in os.environ.get('SMART_POT_ADAPTERS', '').split(',')
+            if adapter] or [None]
+
+# The time in seconds after the last advertisement of a pot that has been
+# received by the adapter of a shard until the shard is no longer considered
+# for the pot.
+SHARD_CANDIDATE_TIMEOUT = 60.0
+
+# The maximum time in seconds to wait for advertisements of a pot from all
+# adapters before the pot is assigned to a shard.
+SHARD_CLAIM_DELAY = 5.0
+
+
+# A group of pots that are connected via the same adapter.
+#
+# The `adapter` is `None` for the default adapter. The `addrs` are the
+# addresses of the pots that are assigned to the shard, i.e., that are being
+# connected or are connected via the adapter of the shard.
+class Shard:
+    def __init__(self, index, adapter):
+        self.index = index
+        self.adapter = adapter
+        self.name = adapter or 'default'
+        self.failed = False
+        self.addrs = set()
+
 
-import bleak
-from bleak.exc import BleakError
+# The shards of all adapters.
+shards = [Shard(i, adapter) for i, adapter in enumerate(ADAPTERS)]
 
-from typing import Dict
+# Dictionary that maps the addresses of pots to the shard they are assigned
+# to.
+pot_shards: Dict[str, Shard] = {}
+
+# Dictionary that maps the addresses of pots to a dictionary that maps the
+# shards whose adapter received an advertisement of the pot to the time of
+# the latest advertisement (see `time.monotonic`).
+shard_candidates: Dict[str, Dict[Shard, float]] = {}
+
+# Dictionary that maps the addresses of pots to the time (see
+# `time.monotonic`) at which the first of the current shard candidates
+# received an advertisement of the pot.
+first_seen: Dict[str, float] = {}
+
+# Lock that serializes changes of the assignments of pots to shards.
+shards_lock = threading.Lock()
 
 # Dictionary that maps addresses to the `BleakClient` of connected smart pots.
-connected_pots: Dict[str, bleak.BleakClient] = {}
+connected_pots: Dict[str, transport.Client] = {}
+
+# Dictionary that maps the addresses of connected smart pots to the event loop
+# of the shard that connected them.
+client_loops: Dict[str, asyncio.AbstractEventLoop] = {}
+
+# Dictionary that maps the addresses of devices whose last connection attempt
+# failed to the number of consecutive failed attempts and the time (see
+# `time.monotonic`) before which no further attempt should be made.
+connect_failures: Dict[str, Tuple[int, float]] = {}
+
+# Functions that are called with the address of every smart pot that has been
+# disconnected.
+disconnect_listeners: List[Callable[[str], None]] = []
+
+# Metrics of connection attempts (see `metrics`).
+connect_attempts = metrics.Counter(
+    'smartpot_connect_attempts_total', 'Number of connection attempts.')
+connect_failures_total = metrics.Counter(
+    'smartpot_connect_failures_total',
+    'Number of failed or timed out connection attempts.')
+connect_duration_seconds = metrics.Histogram(
+    'smartpot_connect_duration_seconds',
+    'Duration of connection attempts.', ['result'],
+    buckets=(0.5, 1.0, 2.0, 5.0, 10.0, CONNECT_TIMEOUT))
 
 
-# Connects to a discovered smart pot device.
+# Gets the number of pots that are assigned to each shard.
+def get_shard_loads():
+    return [((shard.name,), len(shard.addrs)) for shard in shards]
+
+
+metrics.CallbackGauge('smartpot_shard_pots',
+                      'Number of pots that are assigned to a shard.',
+                      ['adapter'], get_shard_loads)
+
+
+# Assigns the pot with the given address to a shard after the adapter of the
+# given shard received an advertisement of the pot.
+#
+# If the pot is not assigned to a shard that has not failed, it is assigned to
+# the shard with the fewest pots among the shards whose adapter received an
+# advertisement of the pot during the last `SHARD_CANDIDATE_TIMEOUT` seconds.
+# Since the adapters do not receive the advertisements at the same time, the
+# pot is not assigned before all working adapters received an advertisement or
+# `SHARD_CLAIM_DELAY` seconds have passed since the first one.
+#
+# Returns whether the pot is assigned to the given shard, i.e., whether the
+# given shard should connect to the pot.
+def claim_pot(addr, shard):
+    now = time.monotonic()
+    with shards_lock:
+        candidates = {
+            candidate: last_seen for candidate, last_seen
+            in shard_candidates.get(addr, {}).items()
+            if now - last_seen < SHARD_CANDIDATE_TIMEOUT}
+        if not candidates:
+            first_seen[addr] = now
+        candidates[shard] = now
+        shard_candidates[addr] = candidates
+        owner = pot_shards.get(addr)
+        if owner is None or owner.failed:
+            available_shards = [candidate for candidate in candidates
+                                if not candidate.failed]
+            working_shards = [other for other in shards if not other.failed]
+            if (not available_shards
+                    or (len(available_shards) < len(working_shards)
+                        and now - first_seen[addr] < SHARD_CLAIM_DELAY)):
+                return False
+            owner = min(available_shards,
+                        key=lambda candidate: (len(candidate.addrs),
+                                               candidate.index))
+            assign_pot(addr, owner)
+        return owner is shard
+
+
+# Assigns the pot with the given address to the given shard or removes its
+# assignment if the shard is `None`. Must be called with the `shards_lock`.
+def assign_pot(addr, shard):
+    previous_shard = pot_shards.pop(addr, None)
+    if previous_shard is not None:
+        previous_shard.addrs.discard(addr)
+    if shard is not None:
+        pot_shards[addr] = shard
+        shard.addrs.add(addr)
+
+
+# Removes the assignment of the pot with the given address to the given shard
+# such that it can be assigned to another shard (e.g., because the pot has
+# disconnected or could not be connected).
+#
+# If the pot has been assigned to another shard in the meantime, this function
+# has no effect.
+def release_pot(addr, shard):
+    with shards_lock:
+        if pot_shards.get(addr) is shard:
+            assign_pot(addr, None)
+
+
+# Gets the shard the pot with the given address is assigned to or `None`.
+def get_shard(addr):
+    return pot_shards.get(addr)
+
+
+# Marks the given shard as failed and releases its pots such that they are
+# reassigned to the other shards.
+#
+# The shard is only marked as failed if there is another shard that has not
+# failed. Returns the addresses of the released pots, which should be
+# disconnected by the failed shard.
+def fail_shard(shard):
+    with shards_lock:
+        if shard.failed or all(other.failed for other in shards
+                               if other is not shard):
+            return []
+        shard.failed = True
+        addrs = list(shard.addrs)
+        for addr in addrs:
+            assign_pot(addr, None)
+        return addrs
+
+
+# Marks the given shard as working again such that pots are assigned to it.
+def restore_shard(shard):
+    shard.failed = False
+
+
+# Connects to a discovered smart pot device via the given adapter or the
+# default adapter of the transport.
 #
 # If the connection to the device is loost, the connection is closed
 # automatically via the `on_disconnected` callback.
-async def connect(device):
-    if not is_connected(device.address):
-        try:
-            client = bleak.BleakClient(device)
-            client.set_disconnected_callback(on_disconnected)
-            await client.connect()
-            connected_pots[client.address] = client
-            print(f'Connected to {client.address}!')
-            return client
-        except BleakError:
-            print(f'Failed to connect to {client.address}!')
+#
+# Returns the `BleakClient` of the connected device or `None` if the device is
+# connected already, the connection could not be established within
+# `CONNECT_TIMEOUT` seconds or the device is backing off from a previously
+# failed attempt (see `is_backing_off`).
+async def connect(device, adapter=None):
+    if is_connected(device.address) or is_backing_off(device.address):
+        return None
+    if metrics.ENABLED:
+        connect_attempts.inc()
+        start_time = time.perf_counter()
+    client = (transport.Client(device) if adapter is None
+              else transport.Client(device, adapter=adapter))
+    try:
+        await asyncio.wait_for(client.connect(), CONNECT_TIMEOUT)
+    except (transport.TransportError, asyncio.TimeoutError):
+        if metrics.ENABLED:
+            connect_failures_total.inc()
+            connect_duration_seconds.observe(
+                time.perf_counter() - start_time, 'failure')
+        await abort_connect(client)
+        record_failed_connect(device.address)
+        print(f'Failed to connect to {device.address}!')
+        return None
+    if metrics.ENABLED:
+        connect_duration_seconds.observe(time.perf_counter() - start_time,
+                                         'success')
+    client.set_disconnected_callback(on_disconnected)
+    connect_failures.pop(device.address, None)
+    client_loops[client.address] = asyncio.get_running_loop()
+    connected_pots[client.address] = client
+    print(f'Connected to {client.address}!')
+    return client
+
+
+# Disconnects the given client whose connection attempt failed or timed out
+# such that no half-open link or pending connection remains.
+async def abort_connect(client):
+    try:
+        await client.disconnect()
+    except Exception as e:
+        print(f'Error: Failed to abort connection to {client.address}: {e}')
+
+
+# Tests whether the last attempt to connect to the device with the given
+# address failed recently such that no new attempt should be made yet.
+def is_backing_off(addr):
+    if addr not in connect_failures:
+        return False
+    _, retry_time = connect_failures[addr]
+    return time.monotonic() < retry_time
+
+
+# Records a failed connection attempt to the device with the given address and
+# computes when the connection should be retried.
+def record_failed_connect(addr):
+    failures, _ = connect_failures.get(addr, (0, 0.0))
+    backoff = min(CONNECT_BACKOFF_BASE * 2 ** failures, CONNECT_BACKOFF_MAX)
+    connect_failures[addr] = (failures + 1, time.monotonic() + backoff)
+
+
+# Registers a function that is called with the address of every smart pot that
+# has been disconnected.
+def add_disconnect_listener(listener):
+    disconnect_listeners.append(listener)
 
 
 # Callback that is invoked when a connected device disconnects unsolicited.
@@ -31,7 +290,15 @@ async def connect(device):
 def on_disconnected(client):
     if is_connected(client.address):
         del connected_pots[client.address]
+        client_loops.pop(client.address, None)
         print(f'Lost connection to {client.address}!')
+        notify_disconnect_listeners(client.address)
+
+
+# Calls all disconnect listeners with the given address.
+def notify_disconnect_listeners(addr):
+    for listener in disconnect_listeners:
+        listener(addr)
 
 
 # Disconnects from the smart pot with the given address.
@@ -40,10 +307,19 @@ def on_disconnected(client):
 # function only needs to be called to disconnect from a pot that has been
 # removed from the list of known pots.
 #
-# If the device is not connected, this function has no effect.
+# If the device is not connected, this function has no effect. If the device
+# has been connected by a shard with a different event loop, the device is
+# disconnected in the event loop of that shard.
 async def disconnect(addr):
+    loop = client_loops.get(addr)
+    if loop is not None and loop is not asyncio.get_running_loop():
+        await asyncio.wrap_future(
+            asyncio.run_coroutine_threadsafe(disconnect(addr), loop))
+        return
     if is_connected(addr):
         client = connected_pots.pop(addr)
+        client_loops.pop(addr, None)
+        notify_disconnect_listeners(addr)
         await client.disconnect()
         print(f'Disconnected from {client.address}!')
 
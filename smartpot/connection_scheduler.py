@@ -0,0 +1,138 @@
+# This module schedules short visits to the Smart Pots for fleets that are
+# larger than the number of connections an adapter can hold.
+#
+# In the `scheduled` connection mode (see `CONNECTION_MODE`), pots are not
+# kept connected. Instead, every connection thread rotates the pots of its
+# adapter through `CONNECTION_SLOTS` connection slots. During a visit, the pot
+# is connected, its current measurements are read, its pending pump tasks are
+# executed and it is disconnected again.
+#
+# Every pot should be visited at least once per `FRESHNESS_BOUND` seconds. A
+# pot is due for a visit once the measurements of its last visit are half as
+# old as the bound such that there is time to visit it before the bound is
+# exceeded. Pots with pending pump tasks are due immediately. Due pots with
+# pending pump tasks are visited first, followed by the pots whose last visit
+# is the oldest.
+
+import asyncio
+import os
+import smartpot.characteristics as characteristics
+import smartpot.connected_pots as connected_pots
+import smartpot.known_pots as known_pots
+import smartpot.measurements as measurements
+import smartpot.metrics as metrics
+import smartpot.pump_tasks as pump_tasks
+import time
+
+from typing import Dict
+
+# How the hub connects to the pots (`persistent` or `scheduled`). In the
+# `persistent` mode, all pots are kept connected.
+CONNECTION_MODE = os.environ.get('SMART_POT_CONNECTION_MODE', 'persistent')
+
+# The maximum number of pots that are visited at the same time per adapter.
+CONNECTION_SLOTS = int(os.environ.get('SMART_POT_CONNECTION_SLOTS', '4'))
+
+# The maximum age in seconds of the latest measurements of a pot.
+FRESHNESS_BOUND = float(
+    os.environ.get('SMART_POT_FRESHNESS_BOUND', str(15 * 60)))
+
+# The maximum duration of a visit in seconds after which the pot is
+# disconnected such that its slot is freed.
+VISIT_TIMEOUT = 60.0
+
+# The time in seconds between two checks for due pots if no slot is freed in
+# the meantime.
+SCHEDULE_INTERVAL = 1.0
+
+# The time (see `time.monotonic`) at which the hub started.
+start_time = time.monotonic()
+
+# Dictionary that maps the addresses of pots to the time (see
+# `time.monotonic`) of their last successful visit.
+last_visits: Dict[str, float] = {}
+
+# Metrics of visits (see `metrics`).
+visit_age_seconds = metrics.Histogram(
+    'smartpot_visit_age_seconds',
+    'Age of the measurements of a pot when it is visited.',
+    buckets=(10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 900.0, 1800.0, 3600.0))
+freshness_violations_total = metrics.Counter(
+    'smartpot_freshness_violations_total',
+    'Number of visits after the freshness bound has been exceeded.')
+
+
+# Tests whether pots are visited by the connection scheduler instead of being
+# kept connected.
+def is_enabled():
+    return CONNECTION_MODE == 'scheduled'
+
+
+# Gets the age in seconds of the measurements of the last visit of the pot
+# with the given address. Pots that have not been visited since the hub
+# started are as old as the freshness bound.
+def get_age(addr, now):
+    return now - last_visits.get(addr, start_time - FRESHNESS_BOUND)
+
+
+# Selects up to the given number of due pots among the given devices.
+#
+# The devices are given as a dictionary that maps addresses to the device
+# of the latest advertisement. Returns the devices in the order in which they
+# should be visited. Devices that are not known pots are skipped.
+def select_due_pots(devices, count):
+    now = time.monotonic()
+    due_pots = []
+    for addr, device in devices.items():
+        if (not known_pots.is_pot_known_addr(addr)
+                or connected_pots.is_backing_off(addr)):
+            continue
+        pot_id = known_pots.lookup_known_pot_id(addr)
+        has_pending_task = pump_tasks.has_pending_task(pot_id)
+        age = get_age(addr, now)
+        if has_pending_task or age >= FRESHNESS_BOUND / 2:
+            due_pots.append((not has_pending_task, -age, addr, device))
+    due_pots.sort(key=lambda due_pot: due_pot[:3])
+    return [device for *_, device in due_pots[:count]]
+
+
+# Visits the pot with the given ID that has been connected via the given
+# client, i.e., reads and saves its measurements and executes its pending pump
+# tasks. The caller is responsible for disconnecting the pot afterwards.
+#
+# Returns whether the visit has been completed successfully within
+# `VISIT_TIMEOUT` seconds.
+async def visit(client, pot_id):
+    try:
+        await asyncio.wait_for(visit_connected(client, pot_id), VISIT_TIMEOUT)
+    except Exception as e:
+        print(f'Error: Failed to visit {client.address}: {e}')
+        return False
+    record_visit(client.address)
+    return True
+
+
+# Reads and saves the measurements of the given connected pot and executes
+# its pending pump tasks.
+async def visit_connected(client, pot_id):
+    soil_moisture, water_level = await characteristics.read_measurements(
+        client)
+    measurements.add_measurement(pot_id, soil_moisture, water_level)
+    for task in await pump_tasks.aget_pending_tasks_of(pot_id):
+        await characteristics.write_pump_amount(client, task.amount)
+        await pump_tasks.aset_task_execution_date(task)
+
+
+# Records a successful visit of the pot with the given address.
+#
+# The age of the measurements is only recorded if the pot has been visited
+# before since the hub started.
+def record_visit(addr):
+    now = time.monotonic()
+    age = get_age(addr, now)
+    visited_before = addr in last_visits
+    last_visits[addr] = now
+    if metrics.ENABLED and visited_before:
+        visit_age_seconds.observe(age)
+        if age > FRESHNESS_BOUND:
+            freshness_violations_total.inc()
@@ -0,0 +1,59 @@
+# This script can be used to measure the throughput of pump tasks through
+# their whole lifecycle, i.e., creating the history entry, dispatching the
+# task to the worker of its pot, writing the pump characteristic and setting
+# the execution date.
+#
+# The benchmark uses a temporary database and fake clients that accept writes
+# immediately. Since the creation timestamp of a task is part of its primary
+# key, every fake pot runs a single task.
+#
+#     python3 -m smartpot.debug.benchmark_pump_tasks
+
+import asyncio
+import os
+import tempfile
+import time
+
+# The number of fake pots. Every pot runs one task.
+POT_COUNT = 1000
+
+
+# A fake `BleakClient` that accepts all writes.
+class FakeClient:
+    async def write_gatt_char(self, uuid, data, *args, **kwargs):
+        pass
+
+
+# Creates, dispatches and executes one pump task per pot and prints the
+# throughput.
+async def run_benchmark():
+    import smartpot.known_pots as known_pots
+    import smartpot.persistance as persistance
+    import smartpot.pump_dispatcher as pump_dispatcher
+    import smartpot.pump_tasks as pump_tasks
+
+    pot_ids = [known_pots.add_known_pot(f'00:00:00:00:{i // 256:02X}:'
+                                        f'{i % 256:02X}', f'Pot {i}')
+               for i in range(POT_COUNT)]
+    for pot_id in pot_ids:
+        await pump_dispatcher.start_worker(pot_id, FakeClient())
+
+    start = time.perf_counter()
+    for pot_id in pot_ids:
+        pump_dispatcher.enqueue(pump_tasks.create_pump_task(pot_id, 1))
+    while pump_dispatcher.pending_keys:
+        await asyncio.sleep(0.001)
+    duration = time.perf_counter() - start
+
+    for pot_id in pot_ids:
+        pump_dispatcher.stop_worker(pot_id)
+    persistance.worker.shutdown()
+
+    print(f'{POT_COUNT} tasks in {duration:.2f} s, '
+          f'{POT_COUNT / duration:.0f} tasks/s')
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ['SMART_POT_DB'] = os.path.join(directory, 'smart-pot.db')
+        asyncio.run(run_benchmark())
@@ -0,0 +1,115 @@
+# This script can be used to measure the latency of the
+# `GET /api/pot/<id>/measurements` route of the REST API while the database
+# is saturated with inserts.
+#
+# The benchmark runs twice in separate processes with temporary databases:
+# once with all queries processed by the database worker thread and once with
+# the pool of reader threads. The p50 and p99 latencies of both runs are
+# printed.
+#
+#     python3 -m smartpot.debug.benchmark_read_latency
+
+import datetime
+import json
+import os
+import smartpot.query_log as query_log
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# The duration of each run in seconds.
+DURATION = 10.0
+
+# The number of threads that insert measurements concurrently.
+WRITER_THREADS = 4
+
+# The number of fake pots in the database. Each writer thread inserts the
+# measurements of its own pot, so there must be at least `WRITER_THREADS`.
+POT_COUNT = 10
+
+
+# Inserts measurements of the given pot with distinct timestamps in the past
+# until `is_running` is cleared.
+def insert_measurements(persistance, measurements, pot_id, is_running):
+    now = persistance.utc_now()
+    n = 0
+    while is_running.is_set():
+        n += 1
+        timestamp = persistance.format_timestamp(
+            now - datetime.timedelta(seconds=n))
+        persistance.execute(f'''
+            INSERT INTO {measurements.ensure_partition(timestamp)} (
+                pot_id, soil_moisture, water_level, timestamp
+            ) VALUES ( ?, ?, ?, ? )
+        ''', (pot_id, n % 1024, n % 1024, timestamp))
+
+
+# Runs the benchmark in the current process and prints the result as JSON.
+def run_benchmark():
+    import smartpot.known_pots as known_pots
+    import smartpot.measurements as measurements
+    import smartpot.persistance as persistance
+    import smartpot.rest_api as rest_api
+
+    pot_ids = [known_pots.add_known_pot(f'00:00:00:00:{i // 256:02X}:'
+                                        f'{i % 256:02X}', f'Pot {i}')
+               for i in range(POT_COUNT)]
+
+    # Saturate the worker thread.
+    is_running = threading.Event()
+    is_running.set()
+    writers = [threading.Thread(target=insert_measurements,
+                                args=(persistance, measurements,
+                                      pot_ids[i], is_running))
+               for i in range(WRITER_THREADS)]
+    for writer in writers:
+        writer.start()
+
+    # Measure latency of the REST API.
+    client = rest_api.api.test_client()
+    latencies = []
+    end = time.monotonic() + DURATION
+    while time.monotonic() < end:
+        pot_id = pot_ids[len(latencies) % len(pot_ids)]
+        start = time.perf_counter()
+        client.get(f'/api/pot/{pot_id}/measurements')
+        latencies.append(time.perf_counter() - start)
+
+    is_running.clear()
+    for writer in writers:
+        writer.join()
+    persistance.worker.shutdown()
+
+    latencies.sort()
+    print(json.dumps({
+        'requests': len(latencies),
+        'p50_ms': query_log.percentile(latencies, 50) * 1000,
+        'p99_ms': query_log.percentile(latencies, 99) * 1000,
+    }))
+
+
+# Runs the benchmark in a subprocess with the given number of reader threads.
+def run_subprocess(reader_count):
+    with tempfile.TemporaryDirectory() as directory:
+        env = dict(os.environ)
+        env['SMART_POT_DB'] = os.path.join(directory, 'smart-pot.db')
+        env['SMART_POT_DB_READERS'] = str(reader_count)
+        output = subprocess.run(
+            [sys.executable, '-m', 'smartpot.debug.benchmark_read_latency',
+             '--run'],
+            env=env, check=True, capture_output=True, text=True).stdout
+        return json.loads(output.strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    if '--run' in sys.argv:
+        run_benchmark()
+    else:
+        for reader_count in [0, 2]:
+            result = run_subprocess(reader_count)
+            print(f'readers={reader_count}: '
+                  f'{result["requests"]} requests, '
+                  f'p50={result["p50_ms"]:.2f} ms, '
+                  f'p99={result["p99_ms"]:.2f} ms')
@@ -0,0 +1,203 @@
+# This script runs an offline benchmark suite of the Smart Pot Hub and writes
+# the results as JSON such that the results of different runs can be compared.
+#
+# For every number of pots in `POT_COUNTS`, a temporary database is created in
+# a separate process and the following metrics are measured.
+#
+#  - `inserts_per_s`: sustained measurement inserts per second through
+#    `persistance.buffer_insert`.
+#  - `api`: p50 and p99 latencies of `GET /api/pots` and `GET /api/pot/<id>`
+#    with `HISTORY_DAYS` days of synthetic history.
+#  - `pump_dispatch`: p50 and p99 latencies from dispatching a pump task until
+#    it is written to its (fake) pot.
+#  - `remove_old_measurements_s`: the duration of
+#    `measurements.remove_old_measurements`.
+#
+#     python3 -m smartpot.debug.benchmark_suite [output.json]
+
+import asyncio
+import datetime
+import json
+import os
+import smartpot.query_log as query_log
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# The numbers of pots to run the benchmarks with.
+POT_COUNTS = [10, 100, 1000]
+
+# The number of days and the time in seconds between two measurements of the
+# synthetic history. The history is longer than a year such that
+# `remove_old_measurements` has something to remove.
+HISTORY_DAYS = 395
+HISTORY_INTERVAL = 6 * 60 * 60
+
+# The number of measurements to insert to measure the insert throughput.
+INSERT_COUNT = 100000
+
+# The number of requests per route to measure the API latency.
+API_REQUESTS = 1000
+
+# The number of pump tasks to measure the dispatch latency and the maximum
+# number of pots that they are distributed over.
+PUMP_TASKS = 500
+PUMP_POTS = 100
+
+# The default file the results are written to.
+DEFAULT_OUTPUT_FILE = 'benchmark-results.json'
+
+
+# Summarizes the given latencies in seconds as p50 and p99 in milliseconds.
+def summarize_latencies(latencies):
+    latencies = sorted(latencies)
+    return {
+        'p50_ms': query_log.percentile(latencies, 50) * 1000,
+        'p99_ms': query_log.percentile(latencies, 99) * 1000,
+    }
+
+
+# A fake `BleakClient` that signals the given event when it is written to.
+class FakeClient:
+    def __init__(self, written):
+        self.written = written
+
+    async def write_gatt_char(self, uuid, data, *args, **kwargs):
+        self.written.set()
+
+
+# Measures the sustained throughput of measurement inserts.
+def benchmark_inserts(persistance, measurements, pot_ids):
+    start_time = persistance.utc_now() - datetime.timedelta(
+        seconds=INSERT_COUNT // len(pot_ids) + 1)
+    rows = []
+    for i in range(INSERT_COUNT):
+        timestamp = persistance.format_timestamp(
+            start_time + datetime.timedelta(seconds=i // len(pot_ids)))
+        rows.append((measurements.ensure_partition(timestamp),
+                     pot_ids[i % len(pot_ids)], i % 1024, i % 1024, timestamp))
+
+    start = time.perf_counter()
+    for table, *row in rows:
+        persistance.buffer_insert(f'''
+            INSERT INTO {table} (
+                pot_id, soil_moisture, water_level, timestamp
+            ) VALUES ( ?, ?, ?, ? )
+        ''', tuple(row))
+    persistance.flush()
+    return INSERT_COUNT / (time.perf_counter() - start)
+
+
+# Measures the latency of the given routes of the REST API.
+def benchmark_api(rest_api, routes):
+    client = rest_api.api.test_client()
+    result = {}
+    for name, get_route in routes.items():
+        latencies = []
+        for i in range(API_REQUESTS):
+            route = get_route(i)
+            start = time.perf_counter()
+            client.get(route)
+            latencies.append(time.perf_counter() - start)
+        result[name] = summarize_latencies(latencies)
+    return result
+
+
+# Measures the latency from dispatching a pump task until it is written to
+# its pot.
+def benchmark_pump_dispatch(pump_dispatcher, pump_tasks, pot_ids):
+    event_loop = asyncio.new_event_loop()
+    threading.Thread(target=event_loop.run_forever, daemon=True).start()
+
+    written = threading.Event()
+    pot_ids = pot_ids[:PUMP_POTS]
+    for pot_id in pot_ids:
+        asyncio.run_coroutine_threadsafe(
+            pump_dispatcher.start_worker(pot_id, FakeClient(written)),
+            event_loop).result()
+
+    # The tasks do not have history entries such that their creation
+    # timestamps can be chosen freely.
+    latencies = []
+    for i in range(PUMP_TASKS):
+        task = pump_tasks.PumpTask(pot_ids[i % len(pot_ids)], 1,
+                                   f'benchmark-{i}')
+        written.clear()
+        start = time.perf_counter()
+        pump_dispatcher.dispatch(task)
+        written.wait()
+        latencies.append(time.perf_counter() - start)
+
+    for pot_id in pot_ids:
+        event_loop.call_soon_threadsafe(pump_dispatcher.stop_worker, pot_id)
+    return summarize_latencies(latencies)
+
+
+# Runs all benchmarks with the given number of pots in the current process and
+# prints the result as JSON.
+def run_benchmark(pot_count):
+    from smartpot.debug.create_fake_measurements \
+        import create_measurement_history
+    from smartpot.debug.fake_pots import get_fake_pot_addrs
+    from smartpot.debug.fake_pots import get_fake_plant_names
+    import smartpot.known_pots as known_pots
+    import smartpot.measurements as measurements
+    import smartpot.persistance as persistance
+    import smartpot.pump_dispatcher as pump_dispatcher
+    import smartpot.pump_tasks as pump_tasks
+    import smartpot.rest_api as rest_api
+
+    pot_ids = [known_pots.add_known_pot(addr, name) for addr, name
+               in zip(get_fake_pot_addrs(pot_count),
+                      get_fake_plant_names(pot_count))]
+    result = {'pots': pot_count}
+    result['inserts_per_s'] = benchmark_inserts(persistance, measurements,
+                                                pot_ids)
+    result['history_measurements'] = create_measurement_history(
+        pot_ids, HISTORY_DAYS, HISTORY_INTERVAL)
+    result['api'] = benchmark_api(rest_api, {
+        '/api/pots': lambda i: '/api/pots',
+        '/api/pot/<id>': lambda i: f'/api/pot/{pot_ids[i % pot_count]}',
+    })
+    result['pump_dispatch'] = benchmark_pump_dispatch(
+        pump_dispatcher, pump_tasks, pot_ids)
+
+    start = time.perf_counter()
+    measurements.remove_old_measurements()
+    result['remove_old_measurements_s'] = time.perf_counter() - start
+
+    persistance.worker.shutdown()
+    print(json.dumps(result))
+
+
+# Runs the benchmarks with the given number of pots in a subprocess with a
+# temporary database.
+def run_subprocess(pot_count):
+    with tempfile.TemporaryDirectory() as directory:
+        env = dict(os.environ)
+        env['SMART_POT_DB'] = os.path.join(directory, 'smart-pot.db')
+        output = subprocess.run(
+            [sys.executable, '-m', 'smartpot.debug.benchmark_suite',
+             '--run', str(pot_count)],
+            env=env, check=True, capture_output=True, text=True).stdout
+        return json.loads(output.strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    if '--run' in sys.argv:
+        run_benchmark(int(sys.argv[sys.argv.index('--run') + 1]))
+    else:
+        output_file = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_OUTPUT_FILE
+        results = []
+        for pot_count in POT_COUNTS:
+            results.append(run_subprocess(pot_count))
+            print(json.dumps(results[-1]))
+        with open(output_file, 'w') as file:
+            json.dump({
+                'timestamp': datetime.datetime.now(
+                    datetime.timezone.utc).replace(tzinfo=None).isoformat(),
+                'results': results,
+            }, file, indent=2)
+        print(f'Results written to {output_file}')
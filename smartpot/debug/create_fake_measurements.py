@@ -1,23 +1,90 @@
 # This script can be used during debugging to create database entries for
 # random measurement data of fake pots that have been created by the
 # `create_fake_pots.py` script.
+#
+# By default, a single measurement is created for every fake pot. If a number
+# of days is given, a history of measurements is created for every known pot
+# instead. The history covers the given number of days until now and contains
+# a measurement every `interval` seconds (default: one hour).
+#
+#     python3 -m smartpot.debug.create_fake_measurements [days [interval]]
 
+import datetime
 import random
 import smartpot.known_pots as known_pots
 import smartpot.measurements as measurements
 import smartpot.persistance as persistance
+import sys
 from smartpot.debug.fake_pots import fake_pot_addrs
 
-# Initialize random number generator.
-random.seed()
+# The default time in seconds between two measurements of a history.
+DEFAULT_HISTORY_INTERVAL = 60 * 60
+
+# The number of measurements that are inserted in a single transaction.
+HISTORY_BATCH_SIZE = 10000
+
 
 # Creates database entries with random measurement data for the fake pots.
-for addr in fake_pot_addrs:
-    id = known_pots.lookup_known_pot_id(addr)
-    soil_moisture = random.randint(0, 1023)
-    water_level = random.randint(0, 1023)
-    measurements.add_measurement(id, soil_moisture, water_level)
-    print(f'Added measurement for {addr} to database')
-
-# Shutdown the persistance thread such that the script can exit.
-persistance.worker.shutdown()
+def create_measurements():
+    for addr in fake_pot_addrs:
+        id = known_pots.lookup_known_pot_id(addr)
+        soil_moisture = random.randint(0, 1023)
+        water_level = random.randint(0, 1023)
+        measurements.add_measurement(id, soil_moisture, water_level)
+        print(f'Added measurement for {addr} to database')
+
+
+# Creates database entries with random measurement data for the given pots
+# that cover the given number of days until now with one measurement every
+# `interval` seconds.
+#
+# Returns the number of created measurements.
+def create_measurement_history(pot_ids, days,
+                               interval=DEFAULT_HISTORY_INTERVAL):
+    now = persistance.utc_now().replace(microsecond=0)
+    count = int(days * 24 * 60 * 60 // interval)
+    batches = {}
+    for i in range(count, 0, -1):
+        timestamp = persistance.format_timestamp(
+            now - datetime.timedelta(seconds=i * interval))
+        table = measurements.ensure_partition(timestamp)
+        batch = batches.setdefault(table, [])
+        batch.extend((pot_id, random.randint(0, 1023),
+                      random.randint(0, 1023), timestamp)
+                     for pot_id in pot_ids)
+        if len(batch) >= HISTORY_BATCH_SIZE:
+            insert_measurements(table, batches.pop(table))
+    for table, batch in batches.items():
+        insert_measurements(table, batch)
+    measurements.load_last_measurements()
+    return count * len(pot_ids)
+
+
+# Inserts the given `(pot_id, soil_moisture, water_level, timestamp)` tuples
+# into the given partition in a single transaction.
+def insert_measurements(table, rows):
+    def insert(cursor):
+        cursor.executemany(f'''
+            INSERT OR IGNORE INTO {table} (
+                pot_id, soil_moisture, water_level, timestamp
+            ) VALUES ( ?, ?, ?, ? )
+        ''', rows)
+    persistance.transaction(insert)
+
+
+if __name__ == '__main__':
+    # Initialize random number generator.
+    random.seed()
+
+    if len(sys.argv) > 1:
+        days = float(sys.argv[1])
+        interval = (float(sys.argv[2]) if len(sys.argv) > 2
+                    else DEFAULT_HISTORY_INTERVAL)
+        pot_ids = list(known_pots.get_known_pot_names())
+        count = create_measurement_history(pot_ids, days, interval)
+        print(f'Added {count} measurements to database')
+    else:
+        create_measurements()
+
+    # Shutdown the persistance thread such that the script can exit.
+    persistance.worker.shutdown()
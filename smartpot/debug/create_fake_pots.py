@@ -1,14 +1,26 @@
 # This script can be used during debugging to create database entries for
 # non-existing Smart Pots.
+#
+# By default, entries for the three `fake_pot_addrs` are created. An optional
+# argument specifies the number of fake pots, e.g., to add the pots of the
+# simulated transport (see `simulated_transport.py`) to the database.
+#
+#     python3 -m smartpot.debug.create_fake_pots [count]
 
-from smartpot.debug.fake_pots import fake_pot_addrs, fake_plant_names
+from smartpot.debug.fake_pots import fake_pot_addrs
+from smartpot.debug.fake_pots import get_fake_pot_addrs, get_fake_plant_names
 import smartpot.known_pots as known_pots
 import smartpot.persistance as persistance
+import sys
+
+# The number of fake pots to create.
+count = int(sys.argv[1]) if len(sys.argv) > 1 else len(fake_pot_addrs)
 
 # Create database entries for fake pots.
-for addr, name in zip(fake_pot_addrs, fake_plant_names):
-    known_pots.add_known_pot(addr, name)
-    print(f'Added {addr} to database')
+for addr, name in zip(get_fake_pot_addrs(count), get_fake_plant_names(count)):
+    if not known_pots.is_pot_known_addr(addr):
+        known_pots.add_known_pot(addr, name)
+        print(f'Added {addr} to database')
 
 # Shutdown the persistance thread such that the script can exit.
 persistance.worker.shutdown()
@@ -13,3 +13,19 @@ fake_plant_names = [
     'Davallia',
     'Cycas revoluta'
 ]
+
+
+# Gets the addresses of the given number of fake pots. The first addresses are
+# the `fake_pot_addrs`.
+def get_fake_pot_addrs(count):
+    return [f'00:00:00:00:{i // 256:02X}:{i % 256:02X}'
+            for i in range(1, count + 1)]
+
+
+# Gets the names of the plants in the given number of fake pots. The first
+# names are the `fake_plant_names`.
+def get_fake_plant_names(count):
+    return fake_plant_names[:count] + [
+        f'{fake_plant_names[i % len(fake_plant_names)]} {i}'
+        for i in range(len(fake_plant_names), count)
+    ]
@@ -0,0 +1,278 @@
+# This module simulates a fleet of Smart Pots that can be used instead of
+# real Bluetooth devices to load test the Smart Pot Hub (see `transport`).
+#
+# The simulated pots advertise the smart pot service while they are not
+# connected, send measurement notifications at a configurable interval and
+# accept writes to the pump characteristic. Connection latency, failed
+# connection attempts, failed writes and unsolicited disconnects are injected
+# at random. The fleet is configured via the following environment variables.
+#
+#     SMART_POT_SIM_POTS                  number of pots (default: 100)
+#     SMART_POT_SIM_ADVERTISING_INTERVAL  seconds (default: 1.0)
+#     SMART_POT_SIM_MEASUREMENT_INTERVAL  seconds (default: 1.0)
+#     SMART_POT_SIM_SAMPLES_PER_FRAME     samples per notification; legacy
+#                                         frames are sent if set to one
+#                                         (default: 1, at most 255)
+#     SMART_POT_SIM_CONNECT_LATENCY       mean seconds (default: 0.5)
+#     SMART_POT_SIM_WRITE_LATENCY         mean seconds (default: 0.05)
+#     SMART_POT_SIM_FAILURE_RATE          probability that a connection
+#                                         attempt or write fails
+#                                         (default: 0.05)
+#     SMART_POT_SIM_DISCONNECT_RATE       probability per second that a
+#                                         connected pot disconnects
+#                                         (default: 0.001)
+#     SMART_POT_SIM_FAILED_ADAPTERS       comma separated list of adapters
+#                                         that fail, optionally with the
+#                                         number of seconds after which they
+#                                         fail (e.g., `hci1:30`)
+#
+# The simulated pots can be reached via any adapter (see
+# `connected_pots.ADAPTERS`). Once an adapter has failed, its scanners stop
+# reporting advertisements, starting or stopping them raises an error and all
+# pots that are connected via the adapter disconnect.
+#
+# The addresses of the simulated pots are the addresses of the fake pots (see
+# `fake_pots.get_fake_pot_addrs`). Use `create_fake_pots.py` to add them to
+# the database such that the hub connects to them.
+
+import asyncio
+import collections
+import os
+import random
+import smartpot.characteristics as characteristics
+import struct
+import time
+
+from smartpot.debug.fake_pots import get_fake_pot_addrs
+from typing import Dict
+
+# The configuration of the simulated fleet.
+POT_COUNT = int(os.environ.get('SMART_POT_SIM_POTS', '100'))
+ADVERTISING_INTERVAL = float(
+    os.environ.get('SMART_POT_SIM_ADVERTISING_INTERVAL', '1.0'))
+MEASUREMENT_INTERVAL = float(
+    os.environ.get('SMART_POT_SIM_MEASUREMENT_INTERVAL', '1.0'))
+SAMPLES_PER_FRAME = max(1, min(
+    int(os.environ.get('SMART_POT_SIM_SAMPLES_PER_FRAME', '1')), 255))
+CONNECT_LATENCY = float(os.environ.get('SMART_POT_SIM_CONNECT_LATENCY', '0.5'))
+WRITE_LATENCY = float(os.environ.get('SMART_POT_SIM_WRITE_LATENCY', '0.05'))
+FAILURE_RATE = float(os.environ.get('SMART_POT_SIM_FAILURE_RATE', '0.05'))
+DISCONNECT_RATE = float(
+    os.environ.get('SMART_POT_SIM_DISCONNECT_RATE', '0.001'))
+
+# The maximum value of a measurement.
+MAX_MEASUREMENT = 1023
+
+
+# Parses the adapters that fail and the number of seconds after which they
+# fail (see `SMART_POT_SIM_FAILED_ADAPTERS`).
+def parse_failed_adapters(value):
+    failed_adapters = {}
+    for entry in filter(None, value.split(',')):
+        adapter, _, delay = entry.partition(':')
+        failed_adapters[adapter] = time.monotonic() + float(delay or 0)
+    return failed_adapters
+
+
+# Dictionary that maps the names of the adapters that fail to the time (see
+# `time.monotonic`) at which they fail.
+adapter_failure_times = parse_failed_adapters(
+    os.environ.get('SMART_POT_SIM_FAILED_ADAPTERS', ''))
+
+# A simulated device as reported by the `Scanner`.
+Device = collections.namedtuple('Device', ['address', 'name'])
+
+# The advertisement data of a simulated device as reported by the `Scanner`.
+AdvertisementData = collections.namedtuple('AdvertisementData', [
+    'rssi',
+    'service_uuids',
+])
+
+
+# The error that is raised when a simulated operation fails.
+class TransportError(Exception):
+    pass
+
+
+# The state of a simulated Smart Pot.
+class SimulatedPot:
+    def __init__(self, addr):
+        self.device = Device(addr, 'Smart Pot')
+        self.rssi = random.randint(-90, -40)
+        self.soil_moisture = random.randint(0, MAX_MEASUREMENT)
+        self.water_level = random.randint(0, MAX_MEASUREMENT)
+        self.client = None
+        self.pumped_amount = 0
+
+    # Changes the measurements of the pot slightly.
+    def update_measurements(self):
+        self.soil_moisture = clamp(self.soil_moisture + random.randint(-5, 5))
+        self.water_level = clamp(self.water_level - random.randint(0, 1))
+
+    # Encodes the current measurements like the measurements characteristic
+    # of a legacy pot.
+    def encode_measurements(self):
+        return struct.pack('<HH', self.soil_moisture, self.water_level)
+
+    # Updates the measurements `SAMPLES_PER_FRAME` times and encodes all
+    # samples as a frame of the measurements characteristic.
+    #
+    # Since frames have a resolution of one second, the interval of the
+    # samples is at least one second even if they are sampled more often.
+    def encode_measurement_frame(self):
+        if SAMPLES_PER_FRAME == 1:
+            self.update_measurements()
+            return self.encode_measurements()
+        samples = []
+        for _ in range(SAMPLES_PER_FRAME):
+            self.update_measurements()
+            samples += [self.soil_moisture, self.water_level]
+        return struct.pack(f'<BBBH{len(samples)}H',
+                           characteristics.FRAME_MARKER,
+                           characteristics.FRAME_VERSION, SAMPLES_PER_FRAME,
+                           max(1, round(MEASUREMENT_INTERVAL)), *samples)
+
+
+# Dictionary that maps addresses to all simulated pots.
+simulated_pots: Dict[str, SimulatedPot] = {
+    addr: SimulatedPot(addr) for addr in get_fake_pot_addrs(POT_COUNT)
+}
+
+
+# Limits the given measurement to the range of valid measurements.
+def clamp(value):
+    return max(0, min(value, MAX_MEASUREMENT))
+
+
+# Waits for a random delay with the given mean in seconds.
+async def random_delay(mean):
+    if mean > 0:
+        await asyncio.sleep(random.expovariate(1 / mean))
+
+
+# Tests whether the given adapter has failed.
+def has_adapter_failed(adapter):
+    failure_time = adapter_failure_times.get(adapter)
+    return failure_time is not None and time.monotonic() >= failure_time
+
+
+# Raises a `TransportError` if the given adapter has failed.
+def check_adapter(adapter):
+    if has_adapter_failed(adapter):
+        raise TransportError(f'Adapter {adapter} has failed')
+
+
+# A scanner that reports advertisements of all simulated pots that are not
+# connected. Has the same interface as `bleak.BleakScanner`.
+class Scanner:
+    def __init__(self, detection_callback=None, adapter=None, **kwargs):
+        self._detection_callback = detection_callback
+        self._adapter = adapter
+        self._task = None
+
+    async def start(self):
+        check_adapter(self._adapter)
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._advertise())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        check_adapter(self._adapter)
+
+    # Reports an advertisement of every pot that is not connected once per
+    # `ADVERTISING_INTERVAL` until the adapter fails.
+    async def _advertise(self):
+        while not has_adapter_failed(self._adapter):
+            for pot in list(simulated_pots.values()):
+                if pot.client is None and self._detection_callback:
+                    rssi = pot.rssi + random.randint(-3, 3)
+                    self._detection_callback(pot.device, AdvertisementData(
+                        rssi, [characteristics.SERVICE_UUID]))
+            await asyncio.sleep(ADVERTISING_INTERVAL)
+
+
+# A client that connects to a simulated pot. Has the same interface as
+# `bleak.BleakClient`.
+class Client:
+    def __init__(self, device, adapter=None, **kwargs):
+        self.address = device.address
+        self.is_connected = False
+        self._adapter = adapter
+        self._pot = simulated_pots[device.address]
+        self._disconnected_callback = None
+        self._tasks = []
+
+    def set_disconnected_callback(self, callback):
+        self._disconnected_callback = callback
+
+    async def connect(self, **kwargs):
+        await random_delay(CONNECT_LATENCY)
+        check_adapter(self._adapter)
+        if random.random() < FAILURE_RATE:
+            raise TransportError(f'Failed to connect to {self.address}')
+        if self._pot.client is not None:
+            raise TransportError(f'{self.address} is connected already')
+        self._pot.client = self
+        self.is_connected = True
+        self._tasks.append(asyncio.ensure_future(self._run_connection()))
+        return True
+
+    async def disconnect(self):
+        self._close()
+        return True
+
+    async def start_notify(self, uuid, callback, **kwargs):
+        self._check_connected()
+        if uuid == characteristics.MEASUREMENTS_UUID:
+            self._tasks.append(
+                asyncio.ensure_future(self._notify_measurements(callback)))
+
+    async def read_gatt_char(self, uuid, **kwargs):
+        self._check_connected()
+        return bytearray(self._pot.encode_measurements())
+
+    async def write_gatt_char(self, uuid, data, response=False, **kwargs):
+        self._check_connected()
+        await random_delay(WRITE_LATENCY)
+        if random.random() < FAILURE_RATE:
+            raise TransportError(f'Failed to write to {self.address}')
+        if uuid == characteristics.PUMP_AMOUNT_UUID:
+            self._pot.pumped_amount += data[0]
+            self._pot.water_level = clamp(self._pot.water_level - data[0])
+
+    def _check_connected(self):
+        if not self.is_connected:
+            raise TransportError(f'{self.address} is not connected')
+
+    # Drops the connection at random with a probability of `DISCONNECT_RATE`
+    # per second or when the adapter fails.
+    async def _run_connection(self):
+        while True:
+            await asyncio.sleep(1.0)
+            if (random.random() < DISCONNECT_RATE
+                    or has_adapter_failed(self._adapter)):
+                self._close()
+                if self._disconnected_callback is not None:
+                    self._disconnected_callback(self)
+                return
+
+    # Samples the measurements of the pot once per `MEASUREMENT_INTERVAL` and
+    # sends them to the given callback once per `SAMPLES_PER_FRAME` samples.
+    async def _notify_measurements(self, callback):
+        while True:
+            await asyncio.sleep(MEASUREMENT_INTERVAL * SAMPLES_PER_FRAME)
+            callback(characteristics.MEASUREMENTS_UUID,
+                     bytearray(self._pot.encode_measurement_frame()))
+
+    # Releases the pot and stops all background tasks of the connection.
+    def _close(self):
+        if self._pot.client is self:
+            self._pot.client = None
+        self.is_connected = False
+        current_task = asyncio.current_task()
+        for task in self._tasks:
+            if task is not current_task:
+                task.cancel()
+        self._tasks = []
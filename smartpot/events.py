@@ -0,0 +1,129 @@
+# This module implements an in-process publish/subscribe mechanism for changes
+# of the state of known pots (e.g., new measurements, completed pump tasks and
+# connection changes). It is used to push updates to clients of the REST API.
+#
+# Every subscriber has its own bounded buffer of pending events. Events are
+# coalesced: If a subscriber has not received the previous event of the same
+# type and pot yet, the pending event is replaced by the new one. Thus, slow
+# subscribers only receive the latest state and the buffer of a subscriber
+# never contains more than one event per type and pot. If the buffer is full
+# nevertheless, the oldest event is dropped and the subscriber is notified
+# that it missed events.
+#
+# Events can be published from any thread. Subscribers can wait for events
+# either by blocking (`Subscription.get`) or in an event loop
+# (`Subscription.aget`).
+
+import asyncio
+import collections
+import threading
+
+from typing import List
+
+# The maximum number of pending events of a subscriber.
+MAX_PENDING_EVENTS = 256
+
+# The maximum number of concurrent subscribers.
+MAX_SUBSCRIBERS = 32
+
+# A change of the state of a pot.
+#
+# The `type` is the name of the changed field of the state (`measurement`,
+# `watered` or `online`) and `value` the new value of the field.
+Event = collections.namedtuple('Event', ['type', 'pot_id', 'value'])
+
+
+# The subscription of a subscriber to the events of all pots or of the pots
+# with the given IDs.
+class Subscription:
+    def __init__(self, pot_ids=None):
+        self.pot_ids = pot_ids
+        self._condition = threading.Condition()
+        self._pending = collections.OrderedDict()
+        self._dropped = False
+        self._waker = None
+
+    # Adds the given event to the buffer of the subscriber or replaces the
+    # pending event of the same type and pot.
+    def put(self, event):
+        if self.pot_ids is not None and event.pot_id not in self.pot_ids:
+            return
+        with self._condition:
+            self._pending[(event.type, event.pot_id)] = event
+            if len(self._pending) > MAX_PENDING_EVENTS:
+                self._pending.popitem(last=False)
+                self._dropped = True
+            self._condition.notify()
+            waker = self._waker
+        if waker is not None:
+            loop, wake_up = waker
+            loop.call_soon_threadsafe(wake_up.set)
+
+    # Waits until there are pending events or the given timeout in seconds
+    # expires and removes all pending events from the buffer.
+    #
+    # Returns a tuple of the list of pending events and whether events have
+    # been dropped since the last call.
+    def get(self, timeout):
+        with self._condition:
+            if not self._pending:
+                self._condition.wait(timeout)
+            return self._take()
+
+    # Awaitable counterpart of `get`.
+    async def aget(self, timeout):
+        wake_up = asyncio.Event()
+        with self._condition:
+            if self._pending:
+                return self._take()
+            self._waker = (asyncio.get_running_loop(), wake_up)
+        try:
+            await asyncio.wait_for(wake_up.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        with self._condition:
+            self._waker = None
+            return self._take()
+
+    def _take(self):
+        events = list(self._pending.values())
+        dropped = self._dropped
+        self._pending.clear()
+        self._dropped = False
+        return events, dropped
+
+
+# The current subscriptions.
+subscriptions: List[Subscription] = []
+
+# Lock that serializes changes of `subscriptions`.
+subscriptions_lock = threading.Lock()
+
+
+# Creates a new subscription to the events of all pots or of the pots with the
+# given IDs.
+#
+# Returns `None` if there are `MAX_SUBSCRIBERS` subscriptions already.
+def subscribe(pot_ids=None):
+    global subscriptions
+    with subscriptions_lock:
+        if len(subscriptions) >= MAX_SUBSCRIBERS:
+            return None
+        subscription = Subscription(pot_ids)
+        subscriptions = subscriptions + [subscription]
+        return subscription
+
+
+# Cancels the given subscription.
+def unsubscribe(subscription):
+    global subscriptions
+    with subscriptions_lock:
+        subscriptions = [s for s in subscriptions if s is not subscription]
+
+
+# Publishes the new value of the given field of the state of the pot with the
+# given ID to all subscribers.
+def publish(type, pot_id, value):
+    event = Event(type, pot_id, value)
+    for subscription in subscriptions:
+        subscription.put(event)
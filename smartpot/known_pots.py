@@ -4,54 +4,175 @@
 # A known pot is a Smart Pot that has been connected to the Hub in the past.
 # There is a background thread that ensures that known pots connect
 # automatically as soon as they become available.
+#
+# The table is loaded into an in-memory index when this module is imported.
+# All lookups are served from the index without querying the database. The
+# index is immutable and replaced atomically whenever a known pot is added,
+# renamed or removed. Therefore, lookups do not need to acquire a lock.
 
 import smartpot.persistance as persistance
+import smartpot.pot_states as pot_states
+import threading
+
+
+# An immutable snapshot of the `known_pots` table that maps IDs to addresses
+# and names and addresses to IDs.
+#
+# The version is incremented whenever the index is replaced such that callers
+# can detect changes.
+class KnownPotIndex:
+    def __init__(self, addrs, names, version):
+        self.addrs = addrs
+        self.names = names
+        self.ids = {addr: id for id, addr in addrs.items()}
+        self.version = version
+
+
+# The current snapshot of the `known_pots` table.
+index = KnownPotIndex({}, {}, 0)
+
+# Lock that serializes updates of the `index`.
+index_lock = threading.Lock()
+
+
+# Replaces the `index` by a copy where the entry with the given ID is set to
+# the given address and name or removed if they are `None`.
+def update_index(id, addr=None, name=None):
+    global index
+    with index_lock:
+        addrs = index.addrs.copy()
+        names = index.names.copy()
+        if addr is None:
+            addrs.pop(id, None)
+            names.pop(id, None)
+        else:
+            addrs[id] = addr
+            names[id] = name
+        index = KnownPotIndex(addrs, names, index.version + 1)
+
+
+# Loads all known pots from the database into the `index`.
+def load_index():
+    global index
+    with index_lock:
+        rows = persistance.fetchall('SELECT id, addr, name FROM known_pots')
+        addrs = {id: addr for id, addr, _ in rows}
+        names = {id: name for id, _, name in rows}
+        index = KnownPotIndex(addrs, names, index.version + 1)
 
 
 # Gets the address of the known pot with the given ID.
 def lookup_known_pot_addr(id):
-    return persistance.fetchone('''
-        SELECT addr FROM known_pots WHERE id = ?
-    ''', (id,))[0]
+    return index.addrs[id]
 
 
 # Gets the id of the known pot with the given address.
 def lookup_known_pot_id(addr):
-    return persistance.fetchone('''
-        SELECT id FROM known_pots WHERE addr = ?
-    ''', (addr,))[0]
+    return index.ids[addr]
 
 
 # Tests whether the pot with the given address is known.
 def is_pot_known_addr(addr):
-    return persistance.fetchone('''
-        SELECT EXISTS (SELECT id FROM known_pots WHERE addr = ?)
-    ''', (addr,))[0] == 1
+    return addr in index.ids
+
+
+# Tests whether the pot with the given ID is known.
+def is_pot_known_id(id):
+    return id in index.addrs
+
+
+# Gets a list of the addresses of all known pots.
+def get_known_pot_addrs():
+    return list(index.addrs.values())
 
 
 # Gets a dictionary that maps the IDs of all known pots to their display name.
 def get_known_pot_names():
-    return dict(persistance.fetchall('SELECT id, name FROM known_pots'))
+    return index.names.copy()
+
+
+# Gets the version of the `index`. The version changes whenever a known pot is
+# added, renamed or removed.
+def get_known_pots_version():
+    return index.version
 
 
 # Adds a pot with the given BLE address and display name.
 #
 # Returns the ID of the added pot.
 def add_known_pot(addr, name):
-    return persistance.execute_insert('''
+    id = persistance.execute_insert(*add_known_pot_statement(addr, name))
+    update_index(id, addr, name)
+    return id
+
+
+# Awaitable counterpart of `add_known_pot`.
+async def aadd_known_pot(addr, name):
+    id = await persistance.aexecute_insert(
+        *add_known_pot_statement(addr, name))
+    update_index(id, addr, name)
+    return id
+
+
+# Gets the query and arguments that add a pot with the given BLE address and
+# display name.
+def add_known_pot_statement(addr, name):
+    return '''
         INSERT INTO known_pots ( addr, name ) VALUES ( ?, ? )
-    ''', (addr, name))
+    ''', (addr, name)
 
 
 # Renames the pot with the given ID.
 def rename_known_pot(id, name):
-    persistance.execute('''
+    persistance.execute(*rename_known_pot_statement(id, name))
+    on_known_pot_renamed(id, name)
+
+
+# Awaitable counterpart of `rename_known_pot`.
+async def arename_known_pot(id, name):
+    await persistance.aexecute(*rename_known_pot_statement(id, name))
+    on_known_pot_renamed(id, name)
+
+
+# Gets the query and arguments that rename the pot with the given ID.
+def rename_known_pot_statement(id, name):
+    return '''
         UPDATE known_pots SET name = ? WHERE id = ?
-    ''', (name, id))
+    ''', (name, id)
+
+
+# Updates the index and the cache after the pot with the given ID has been
+# renamed.
+def on_known_pot_renamed(id, name):
+    if is_pot_known_id(id):
+        update_index(id, lookup_known_pot_addr(id), name)
+        pot_states.update_pot_state(id)
 
 
 # Removes the pot with the given ID from the database.
 def remove_known_pot(id):
-    persistance.execute('''
+    persistance.execute(*remove_known_pot_statement(id))
+    on_known_pot_removed(id)
+
+
+# Awaitable counterpart of `remove_known_pot`.
+async def aremove_known_pot(id):
+    await persistance.aexecute(*remove_known_pot_statement(id))
+    on_known_pot_removed(id)
+
+
+# Gets the query and arguments that remove the pot with the given ID.
+def remove_known_pot_statement(id):
+    return '''
         DELETE FROM known_pots WHERE id = ?
-    ''', (id,))
+    ''', (id,)
+
+
+# Updates the index and the cache after the pot with the given ID has been
+# removed.
+def on_known_pot_removed(id):
+    update_index(id)
+    pot_states.remove_pot_state(id)
+
+
+load_index()
@@ -0,0 +1,258 @@
+# This module maintains an archive of old measurements in a compact binary
+# format.
+#
+# The archive contains one block file per pot and day (e.g.,
+# `measurement-archive/1/2021-06-01.bin`) next to the database file. Since old
+# measurements are never modified, they do not have to be stored in the
+# database where every row costs far more space than the measurement itself.
+# Use `measurements.archive_old_measurements` to move measurements from the
+# database into the archive.
+#
+# A block starts with a header (see `BLOCK_HEADER`) that contains the number
+# of measurements in the block and the timestamp of the first measurement in
+# milliseconds since the epoch. The header is followed by three arrays of
+# the same length. The first array contains the differences between the
+# timestamps of consecutive measurements in milliseconds as unsigned 32 bit
+# integers, where the first difference is always zero. The second and third
+# array contain the soil moisture and water level measurements as unsigned 16
+# bit integers. All integers are little-endian.
+#
+# Blocks are read via `mmap` such that the measurements can be accessed
+# without copying them.
+
+import array
+import datetime
+import mmap
+import os
+import smartpot.persistance as persistance
+import struct
+import sys
+
+# The directory that contains the archive.
+ARCHIVE_DIR = os.path.join(os.path.dirname(persistance.DATABASE_FILE),
+                           'measurement-archive')
+
+# The file extension of block files.
+BLOCK_EXTENSION = '.bin'
+
+# The magic number and format version at the start of every block file.
+BLOCK_MAGIC = b'SPMA'
+BLOCK_VERSION = 1
+
+# The header of a block file. Contains the magic number, the format version,
+# the number of measurements and the timestamp of the first measurement.
+# The size of the header is a multiple of four such that the arrays that
+# follow it are aligned.
+BLOCK_HEADER = struct.Struct('<4sHxxIxxxxq')
+
+# The start of the epoch that is used for the timestamps in block files.
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# The type codes of the arrays in block files.
+DELTA_TYPECODE = 'I'
+VALUE_TYPECODE = 'H'
+assert array.array(DELTA_TYPECODE).itemsize == 4
+assert array.array(VALUE_TYPECODE).itemsize == 2
+
+
+# A block file that has been mapped into memory.
+#
+# The `soil_moisture` and `water_level` fields are `memoryview`s of the mapped
+# file on little-endian machines. Blocks must be closed after use (e.g., by
+# using them in a `with` statement).
+class Block:
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, first_timestamp = \
+            BLOCK_HEADER.unpack_from(self._mmap)
+        if magic != BLOCK_MAGIC or version != BLOCK_VERSION:
+            self._mmap.close()
+            raise ValueError(f'{path} is not a valid block file')
+
+        self.first_timestamp = first_timestamp
+        buffer = memoryview(self._mmap)
+        offset = BLOCK_HEADER.size
+        self._deltas = read_array(buffer, offset, count, DELTA_TYPECODE)
+        offset += count * 4
+        self.soil_moisture = read_array(buffer, offset, count, VALUE_TYPECODE)
+        offset += count * 2
+        self.water_level = read_array(buffer, offset, count, VALUE_TYPECODE)
+        buffer.release()
+
+    def __len__(self):
+        return len(self._deltas)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # Iterates over the timestamps of the measurements in milliseconds since
+    # the epoch.
+    def iter_timestamps(self):
+        timestamp = self.first_timestamp
+        for delta in self._deltas:
+            timestamp += delta
+            yield timestamp
+
+    # Iterates over all measurements in the block as tuples of the timestamp
+    # in milliseconds since the epoch, the soil moisture and the water level.
+    def iter_rows(self):
+        return zip(self.iter_timestamps(), self.soil_moisture,
+                   self.water_level)
+
+    # Releases the arrays and unmaps the file.
+    def close(self):
+        for values in [self._deltas, self.soil_moisture, self.water_level]:
+            if isinstance(values, memoryview):
+                values.release()
+        self._mmap.close()
+
+
+# Gets an array of unsigned integers with the given type code from the given
+# buffer of little-endian integers.
+#
+# On little-endian machines, the array is a `memoryview` of the buffer.
+# Otherwise, the integers are copied into an `array`.
+def read_array(buffer, offset, count, typecode):
+    view = buffer[offset:offset + count * array.array(typecode).itemsize]
+    if sys.byteorder == 'little':
+        values = view.cast(typecode)
+    else:
+        values = array.array(typecode, view.tobytes())
+        values.byteswap()
+    view.release()
+    return values
+
+
+# Converts the given timestamp in the format of SQLite's `CURRENT_TIMESTAMP`
+# to milliseconds since the epoch.
+def to_milliseconds(timestamp):
+    delta = persistance.parse_timestamp(timestamp) - EPOCH
+    return delta // datetime.timedelta(milliseconds=1)
+
+
+# Converts the given number of milliseconds since the epoch to a timestamp in
+# the format of SQLite's `CURRENT_TIMESTAMP`. Milliseconds are only added if
+# they are not zero.
+def from_milliseconds(milliseconds):
+    value = EPOCH + datetime.timedelta(milliseconds=milliseconds)
+    timestamp = value.strftime('%Y-%m-%d %H:%M:%S')
+    if milliseconds % 1000 != 0:
+        timestamp += f'.{milliseconds % 1000:03d}'
+    return timestamp
+
+
+# Gets the path of the directory that contains the blocks of the given pot.
+def get_pot_dir(pot_id):
+    return os.path.join(ARCHIVE_DIR, str(pot_id))
+
+
+# Gets the path of the block file of the given pot and day (formatted as
+# `YYYY-MM-DD`).
+def get_block_path(pot_id, day):
+    return os.path.join(get_pot_dir(pot_id), day + BLOCK_EXTENSION)
+
+
+# Gets the IDs of all pots that have blocks in the archive in ascending order.
+def get_archived_pot_ids():
+    if not os.path.isdir(ARCHIVE_DIR):
+        return []
+    return sorted(int(name) for name in os.listdir(ARCHIVE_DIR)
+                  if name.isdigit())
+
+
+# Gets the days (formatted as `YYYY-MM-DD`) of all blocks of the given pot in
+# ascending order.
+def get_archived_days(pot_id):
+    pot_dir = get_pot_dir(pot_id)
+    if not os.path.isdir(pot_dir):
+        return []
+    return sorted(name[:-len(BLOCK_EXTENSION)] for name in os.listdir(pot_dir)
+                  if name.endswith(BLOCK_EXTENSION))
+
+
+# Writes the given measurements of the given pot and day into a block file.
+#
+# The measurements are `(timestamp, soil_moisture, water_level)` tuples in
+# ascending order of their timestamps. If there is a block for the pot and
+# day already, the measurements are merged with the existing ones.
+#
+# The file is replaced atomically such that a block is never observed
+# partially written.
+def write_block(pot_id, day, rows):
+    path = get_block_path(pot_id, day)
+    rows = [(to_milliseconds(timestamp), soil_moisture, water_level)
+            for timestamp, soil_moisture, water_level in rows]
+    if os.path.exists(path):
+        with Block(path) as block:
+            merged = {timestamp: (soil_moisture, water_level)
+                      for timestamp, soil_moisture, water_level
+                      in block.iter_rows()}
+        merged.update((timestamp, (soil_moisture, water_level))
+                      for timestamp, soil_moisture, water_level in rows)
+        rows = [(timestamp, *values)
+                for timestamp, values in sorted(merged.items())]
+    if not rows:
+        return
+
+    timestamps = [timestamp for timestamp, _, _ in rows]
+    deltas = array.array(DELTA_TYPECODE, [0] + [
+        timestamp - previous
+        for previous, timestamp in zip(timestamps, timestamps[1:])
+    ])
+    soil_moisture = array.array(VALUE_TYPECODE, [row[1] for row in rows])
+    water_level = array.array(VALUE_TYPECODE, [row[2] for row in rows])
+    if sys.byteorder != 'little':
+        for values in [deltas, soil_moisture, water_level]:
+            values.byteswap()
+
+    os.makedirs(get_pot_dir(pot_id), exist_ok=True)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as file:
+        file.write(BLOCK_HEADER.pack(BLOCK_MAGIC, BLOCK_VERSION, len(rows),
+                                     timestamps[0]))
+        file.write(deltas.tobytes())
+        file.write(soil_moisture.tobytes())
+        file.write(water_level.tobytes())
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+
+
+# Iterates over the archived measurements of the given pot between the given
+# start and end timestamps (inclusive) in ascending order.
+#
+# Yields `(timestamp, soil_moisture, water_level)` tuples.
+def iter_archived_measurements(pot_id, start, end):
+    start_ms = to_milliseconds(start)
+    end_ms = to_milliseconds(end)
+    for day in get_archived_days(pot_id):
+        if start[:10] <= day <= end[:10]:
+            with Block(get_block_path(pot_id, day)) as block:
+                for timestamp, soil_moisture, water_level in block.iter_rows():
+                    if start_ms <= timestamp <= end_ms:
+                        yield (from_milliseconds(timestamp),
+                               soil_moisture, water_level)
+
+
+# Gets the last archived measurement of the given pot as a
+# `(timestamp, soil_moisture, water_level)` tuple or `None` if there are no
+# archived measurements of the pot.
+def get_last_archived_measurement(pot_id):
+    days = get_archived_days(pot_id)
+    if not days:
+        return None
+    with Block(get_block_path(pot_id, days[-1])) as block:
+        *_, (timestamp, soil_moisture, water_level) = block.iter_rows()
+        return from_milliseconds(timestamp), soil_moisture, water_level
+
+
+# Removes all blocks of days before the given day (formatted as `YYYY-MM-DD`).
+def remove_blocks_before(day):
+    for pot_id in get_archived_pot_ids():
+        for archived_day in get_archived_days(pot_id):
+            if archived_day < day:
+                os.remove(get_block_path(pot_id, archived_day))
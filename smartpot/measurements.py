@@ -1,15 +1,99 @@
-# This module defines functions to interact with the persistant `measurements`
-# table.
+# This module defines functions to interact with the persistant measurements.
 #
-# The `measurements` table records the raw data recorded by the  soil moisture
-# and water level sensors. Measurements are keept track of for at most a year.
+# The measurements record the raw data recorded by the  soil moisture and
+# water level sensors. Measurements are keept track of for at most a year.
+#
+# Measurements are partitioned by month, i.e., there is one table per month
+# that contains all measurements of that month (e.g., `measurements_2021_06`).
+# Old measurements are removed by dropping whole partitions and queries only
+# read the partitions that overlap with the requested time range. Partitions
+# are created in advance by `create_upcoming_partitions`.
+#
+# Measurements that are older than `COLD_MEASUREMENT_AGE` days are moved from
+# the partitions into a compact archive outside of the database by
+# `archive_old_measurements` (see `measurement_archive`). Queries for raw
+# measurements read both the archive and the partitions.
+#
+# To query the history of a pot without reading all raw measurements, there
+# are rollup tables that contain the minimum, maximum, sum and number of
+# measurements per pot and minute, hour or day. The rollup tables are updated
+# by triggers whenever a measurement is inserted.
+#
+# Most consecutive readings of a pot are identical. Therefore, a reading is
+# only saved as a raw measurement if the soil moisture or water level changed
+# by more than `MEASUREMENT_DEADBAND` since the last saved reading of the pot
+# or if the last saved reading is older than `MEASUREMENT_HEARTBEAT` seconds.
+# Readings that are not saved still update the rollup tables such that the
+# counts and averages of the rollups cover every reading of the pot. They also
+# become the latest measurement of the pot in the cache (see `pot_states`).
 
+import asyncio
+import datetime
+import itertools
+import os
+import smartpot.events as events
+import smartpot.measurement_archive as measurement_archive
+import smartpot.metrics as metrics
 import smartpot.persistance as persistance
+import smartpot.pot_states as pot_states
+import threading
+import time
+
+from typing import Dict, Tuple
 
 # The maximum age of a measurement in days before it should be removed from the
-# database.
+# database. Since only whole partitions are removed, measurements are kept
+# until all measurements of the same month have reached the maximum age.
 MEASUREMENT_MAX_AGE = 365
 
+# The age of a measurement in days before it should be moved into the archive.
+COLD_MEASUREMENT_AGE = 30
+
+# The prefix of the names of the tables that contain the partitions.
+PARTITION_PREFIX = 'measurements_'
+
+# Dictionary that maps the resolutions of the rollup tables to the format
+# string that is used to compute the start of the bucket of a timestamp.
+ROLLUP_BUCKET_FORMATS = {
+    'minute': '%Y-%m-%d %H:%M:00',
+    'hour': '%Y-%m-%d %H:00:00',
+    'day': '%Y-%m-%d 00:00:00',
+}
+
+# Dictionary that maps the resolutions of the rollup tables to the duration of
+# a bucket in seconds.
+ROLLUP_BUCKET_SECONDS = {
+    'minute': 60,
+    'hour': 60 * 60,
+    'day': 24 * 60 * 60,
+}
+
+# Dictionary that maps the resolutions of the rollup tables to the maximum age
+# of a bucket in days before it should be removed from the database.
+ROLLUP_MAX_AGES = {
+    'minute': 7,
+    'hour': MEASUREMENT_MAX_AGE,
+    'day': MEASUREMENT_MAX_AGE,
+}
+
+# The maximum change of the soil moisture and water level since the last
+# saved reading of a pot for which a new reading is not saved.
+MEASUREMENT_DEADBAND = int(
+    os.environ.get('SMART_POT_MEASUREMENT_DEADBAND', '0'))
+
+# The maximum time in seconds between two saved readings of a pot whose
+# readings do not change.
+MEASUREMENT_HEARTBEAT = float(
+    os.environ.get('SMART_POT_MEASUREMENT_HEARTBEAT', str(15 * 60)))
+
+# The resolutions of the history from finest to coarsest. The `raw` resolution
+# returns the measurements without aggregation.
+RESOLUTIONS = ['raw', 'minute', 'hour', 'day']
+
+# The maximum number of entries returned by `get_measurement_history` unless
+# even the coarsest resolution does not fit into the requested range.
+MAX_HISTORY_ENTRIES = 500
+
 
 # The result type of `get_last_measurement`.
 class Measurement:
@@ -19,29 +103,603 @@ class Measurement:
         self.timestamp = timestamp
 
 
-# Inserts a measurement into the database.
+# The result type of `get_measurement_history`.
+#
+# A summary aggregates all measurements of a pot from the bucket that starts
+# at the given timestamp. Summaries of raw measurements have a count of one.
+class MeasurementSummary:
+    def __init__(self, timestamp, count,
+                 min_soil_moisture, max_soil_moisture, avg_soil_moisture,
+                 min_water_level, max_water_level, avg_water_level):
+        self.timestamp = timestamp
+        self.count = count
+        self.min_soil_moisture = min_soil_moisture
+        self.max_soil_moisture = max_soil_moisture
+        self.avg_soil_moisture = avg_soil_moisture
+        self.min_water_level = min_water_level
+        self.max_water_level = max_water_level
+        self.avg_water_level = avg_water_level
+
+
+# The months (formatted as `YYYY-MM`) for which a partition exists in
+# ascending order.
+#
+# The tuple is replaced atomically whenever a partition is created or dropped
+# such that it can be read without locking.
+partitions = ()
+
+# Lock that serializes the creation and removal of partitions.
+partitions_lock = threading.Lock()
+
+# The months for which the creation of a partition has been enqueued by
+# `ensure_partition` but not completed yet.
+requested_partitions = set()
+
+# Dictionary that maps the IDs of pots to the soil moisture and water level of
+# their last saved reading, the time (see `time.monotonic`) it was taken and
+# its timestamp.
+saved_readings: Dict[int, Tuple[int, int, float, str]] = {}
+
+# The number of readings per pot that have been saved or dropped by the
+# deadband and heartbeat filter (see `metrics`).
+saved_readings_total = metrics.Counter(
+    'smartpot_measurements_saved_total',
+    'Number of measurement readings that have been saved.', ['pot_id'])
+dropped_readings_total = metrics.Counter(
+    'smartpot_measurements_dropped_total',
+    'Number of measurement readings that have not been saved since they '
+    'did not change.', ['pot_id'])
+
+
+# Inserts a measurement into the database unless it is filtered by the
+# deadband and heartbeat filter (see `should_save_reading`).
+#
+# This function does not block. The measurement is buffered and saved
+# together with other measurements (see `persistance.buffer_insert`). The
+# cached last measurement of the pot is updated immediately even if the
+# measurement is not saved.
 def add_measurement(pot_id, soil_moisture, water_level):
-    persistance.execute_insert('''
-        INSERT INTO measurements ( pot_id, soil_moisture, water_level )
-                          VALUES ( ?, ?, ? )
-    ''', (pot_id, soil_moisture, water_level))
+    add_measurements(pot_id, [(soil_moisture, water_level)], 0)
+
+
+# Inserts the given `(soil_moisture, water_level)` samples of a pot into the
+# database like `add_measurement`.
+#
+# The samples are ordered from the oldest to the latest and have been taken
+# the given number of seconds apart. The latest sample has been taken now.
+# Since timestamps have a resolution of one second, the interval of multiple
+# samples must be at least one second. Otherwise, a `ValueError` is raised.
+# The samples that pass the filter are buffered as a single batch per
+# partition. The samples that do not pass the filter are only added to the
+# rollup tables. Samples that have the same timestamp as the last saved
+# measurement of the pot (e.g., two readings in the same second) do not pass
+# the filter since there can only be one measurement per pot and timestamp.
+def add_measurements(pot_id, samples, interval):
+    if len(samples) > 1 and interval < 1:
+        raise ValueError(f'Samples of pot {pot_id} are less than a second '
+                         f'apart: {interval}')
+    now = datetime.datetime.now(datetime.timezone.utc)
+    monotonic_now = time.monotonic()
+    batches = {}
+    dropped_rows = []
+    for i, (soil_moisture, water_level) in enumerate(samples):
+        age = (len(samples) - 1 - i) * interval
+        timestamp = persistance.format_timestamp(
+            now - datetime.timedelta(seconds=age))
+        row = (pot_id, soil_moisture, water_level, timestamp)
+        if should_save_reading(pot_id, soil_moisture, water_level,
+                               monotonic_now - age, timestamp):
+            batches.setdefault(ensure_partition(timestamp), []).append(row)
+        else:
+            dropped_rows.append(row)
+    for table, rows in batches.items():
+        persistance.buffer_insert_many(f'''
+            INSERT OR IGNORE INTO {table} (
+                pot_id, soil_moisture, water_level, timestamp
+            ) VALUES ( ?, ?, ?, ? )
+        ''', rows)
+    if dropped_rows:
+        for resolution in ROLLUP_BUCKET_FORMATS:
+            persistance.buffer_insert_many(
+                get_rollup_upsert(resolution, '?1', '?2', '?3', '?4'),
+                dropped_rows)
+    measurement = Measurement(*samples[-1], persistance.format_timestamp(now))
+    pot_states.update_pot_state(pot_id, measurement=measurement)
+    events.publish('measurement', pot_id, measurement)
+
+
+# Tests whether the given reading of the given pot that has been taken at the
+# given time (see `time.monotonic`) with the given timestamp should be saved,
+# i.e., whether it differs by more than `MEASUREMENT_DEADBAND` from the last
+# saved reading of the pot or the last saved reading is at least
+# `MEASUREMENT_HEARTBEAT` seconds old. Readings with the same timestamp as
+# the last saved reading are never saved.
+#
+# If the reading should be saved, it becomes the last saved reading of the
+# pot.
+def should_save_reading(pot_id, soil_moisture, water_level, taken_at,
+                        timestamp):
+    saved_reading = saved_readings.get(pot_id)
+    if saved_reading is not None:
+        (saved_soil_moisture, saved_water_level, saved_at,
+         saved_timestamp) = saved_reading
+        if (timestamp == saved_timestamp
+                or (taken_at - saved_at < MEASUREMENT_HEARTBEAT
+                    and abs(soil_moisture - saved_soil_moisture)
+                    <= MEASUREMENT_DEADBAND
+                    and abs(water_level - saved_water_level)
+                    <= MEASUREMENT_DEADBAND)):
+            if metrics.ENABLED:
+                dropped_readings_total.inc(pot_id)
+            return False
+    saved_readings[pot_id] = (soil_moisture, water_level, taken_at, timestamp)
+    if metrics.ENABLED:
+        saved_readings_total.inc(pot_id)
+    return True
 
 
 # Finds the latest recorded measurement of the given pot.
+#
+# The measurement is looked up in the cache (see `pot_states`).
 def get_last_measurement(pot_id):
-    result = persistance.fetchone('''
-        SELECT soil_moisture, water_level, timestamp
-        FROM measurements
-        WHERE pot_id = ?
-        ORDER BY timestamp DESC
-        LIMIT 1
-    ''', (pot_id,))
-    return None if result is None else Measurement(*result)
-
-
-# Removes all measurements from the database that are older than
-# `MEASUREMENT_MAX_AGE` days.
+    return pot_states.get_pot_state(pot_id).measurement
+
+
+# Loads the latest recorded measurement of all known pots from the database
+# into the cache.
+#
+# The partitions are searched from the newest to the oldest such that the
+# measurements of most pots are found in the first partition. The archive is
+# only searched for pots without measurements in the partitions.
+def load_last_measurements():
+    last_measurements = {}
+    for month in reversed(partitions):
+        table = get_partition_table(month)
+        for pot_id, *measurement in persistance.fetchall(f'''
+            SELECT m.pot_id, m.soil_moisture, m.water_level, m.timestamp
+            FROM known_pots AS p
+            JOIN {table} AS m
+              ON m.pot_id = p.id
+             AND m.timestamp = ( SELECT MAX(timestamp) FROM {table}
+                                 WHERE pot_id = p.id )
+        '''):
+            last_measurements.setdefault(pot_id, Measurement(*measurement))
+    for pot_id, in persistance.fetchall('SELECT id FROM known_pots'):
+        if pot_id not in last_measurements:
+            row = measurement_archive.get_last_archived_measurement(pot_id)
+            if row is not None:
+                timestamp, soil_moisture, water_level = row
+                last_measurements[pot_id] = Measurement(
+                    soil_moisture, water_level, timestamp)
+    for pot_id, measurement in last_measurements.items():
+        pot_states.update_pot_state(pot_id, measurement=measurement)
+
+
+# Gets the history of measurements of the given pot between the given start
+# and end timestamps (inclusive).
+#
+# The history is returned at the given resolution or the next coarser one
+# whose number of buckets in the range does not exceed `MAX_HISTORY_ENTRIES`
+# and that has not been removed from the database for the start of the range
+# yet. Returns a tuple of the chosen resolution and a list of
+# `MeasurementSummary`s ordered by timestamp.
+def get_measurement_history(pot_id, start, end, resolution='minute'):
+    # Use raw measurements if there are not too many.
+    if resolution == 'raw':
+        summaries = get_raw_measurement_history(pot_id, start, end)
+        if len(summaries) <= MAX_HISTORY_ENTRIES:
+            return resolution, summaries
+        resolution = 'minute'
+
+    # Find a rollup table that fits into the range.
+    duration = (persistance.parse_timestamp(end)
+                - persistance.parse_timestamp(start)).total_seconds()
+    candidates = RESOLUTIONS[RESOLUTIONS.index(resolution):]
+    for candidate in candidates:
+        max_age_start = persistance.timestamp_days_ago(
+            ROLLUP_MAX_AGES[candidate])
+        buckets = duration // ROLLUP_BUCKET_SECONDS[candidate] + 1
+        if buckets <= MAX_HISTORY_ENTRIES and start >= max_age_start:
+            resolution = candidate
+            break
+    else:
+        resolution = candidates[-1]
+    return resolution, get_rollup_history(pot_id, start, end, resolution)
+
+
+# Awaitable counterpart of `get_measurement_history`.
+#
+# The history is assembled in a thread of the default executor since it may
+# read from the archive in addition to the database.
+async def aget_measurement_history(pot_id, start, end, resolution='minute'):
+    return await asyncio.get_running_loop().run_in_executor(
+        None, get_measurement_history, pot_id, start, end, resolution)
+
+
+# Gets the raw measurements of the given pot between the given start and end
+# timestamps as `MeasurementSummary`s. At most `MAX_HISTORY_ENTRIES + 1`
+# measurements are returned.
+def get_raw_measurement_history(pot_id, start, end):
+    archived = measurement_archive.iter_archived_measurements(
+        pot_id, start, end)
+    summaries = [
+        MeasurementSummary(timestamp, 1,
+                           soil_moisture, soil_moisture, soil_moisture,
+                           water_level, water_level, water_level)
+        for timestamp, soil_moisture, water_level
+        in itertools.islice(archived, MAX_HISTORY_ENTRIES + 1)
+    ]
+    for month in get_partitions_between(start, end):
+        limit = MAX_HISTORY_ENTRIES + 1 - len(summaries)
+        if limit <= 0:
+            break
+        rows = persistance.fetchall(f'''
+            SELECT timestamp, 1, soil_moisture, soil_moisture, soil_moisture,
+                                 water_level, water_level, water_level
+            FROM {get_partition_table(month)}
+            WHERE pot_id = ? AND timestamp BETWEEN ? AND ?
+            ORDER BY timestamp ASC
+            LIMIT ?
+        ''', (pot_id, start, end, limit))
+        summaries += [MeasurementSummary(*row) for row in rows]
+    summaries.sort(key=lambda summary: summary.timestamp)
+    return summaries
+
+
+# Gets the buckets of the given pot's rollup table with the given resolution
+# that overlap with the given start and end timestamps.
+def get_rollup_history(pot_id, start, end, resolution):
+    bucket_format = ROLLUP_BUCKET_FORMATS[resolution]
+    return [MeasurementSummary(*row) for row in persistance.fetchall(f'''
+        SELECT bucket, count,
+               min_soil_moisture, max_soil_moisture,
+               CAST(sum_soil_moisture AS REAL) / count,
+               min_water_level, max_water_level,
+               CAST(sum_water_level AS REAL) / count
+        FROM measurement_rollups_{resolution}
+        WHERE pot_id = ? AND bucket BETWEEN strftime(?, ?) AND ?
+        ORDER BY bucket ASC
+    ''', (pot_id, bucket_format, start, end))]
+
+
+# Iterates over all raw measurements between the given start and end
+# timestamps (inclusive) in chunks (see `persistance.fetch_chunks`).
+#
+# If a pot ID is given, only the measurements of that pot are returned.
+# Each chunk is a list of `(pot_id, timestamp, soil_moisture, water_level)`
+# tuples. The archived measurements are returned first ordered by pot ID and
+# timestamp. They are followed by the measurements from the partitions
+# ordered by month, pot ID and timestamp.
+def iter_measurement_chunks(start, end, pot_id=None):
+    return itertools.chain(iter_archived_chunks(start, end, pot_id),
+                           iter_partition_chunks(start, end, pot_id))
+
+
+# Iterates over the archived measurements between the given start and end
+# timestamps in chunks of at most `persistance.FETCH_CHUNK_SIZE` measurements
+# (see `iter_measurement_chunks`).
+def iter_archived_chunks(start, end, pot_id=None):
+    pot_ids = ([pot_id] if pot_id is not None
+               else measurement_archive.get_archived_pot_ids())
+    for pot_id in pot_ids:
+        rows = measurement_archive.iter_archived_measurements(
+            pot_id, start, end)
+        while True:
+            chunk = [(pot_id, *row) for row in
+                     itertools.islice(rows, persistance.FETCH_CHUNK_SIZE)]
+            if not chunk:
+                break
+            yield chunk
+
+
+# Iterates over the measurements in the partitions between the given start and
+# end timestamps in chunks (see `iter_measurement_chunks`).
+def iter_partition_chunks(start, end, pot_id=None):
+    min_pot_id, max_pot_id = ((pot_id, pot_id) if pot_id is not None
+                              else (-1, persistance.MAX_ROWID))
+    return itertools.chain.from_iterable(persistance.fetch_chunks(f'''
+        SELECT pot_id, timestamp, soil_moisture, water_level
+        FROM {get_partition_table(month)}
+        WHERE ( pot_id, timestamp ) > ( ?, ? )
+          AND pot_id <= ? AND timestamp BETWEEN ? AND ?
+        ORDER BY pot_id ASC, timestamp ASC
+        LIMIT ?
+    ''', (min_pot_id, ''), (max_pot_id, start, end))
+        for month in get_partitions_between(start, end))
+
+
+# Gets the name of the table that contains the partition for the given month.
+def get_partition_table(month):
+    return PARTITION_PREFIX + month.replace('-', '_')
+
+
+# Gets the months of all partitions that may contain measurements between the
+# given start and end timestamps (inclusive) in ascending order.
+def get_partitions_between(start, end):
+    return [month for month in partitions if start[:7] <= month <= end[:7]]
+
+
+# Gets the name of the table that contains the partition for the given
+# timestamp and enqueues the creation of the partition if it does not exist
+# yet.
+#
+# This function does not block. Since the worker thread executes its tasks in
+# order, the partition is created before any row that is inserted into it
+# afterwards.
+def ensure_partition(timestamp):
+    month = timestamp[:7]
+    if month not in partitions and month not in requested_partitions:
+        requested_partitions.add(month)
+        persistance.enqueue_transaction(
+            lambda cursor: create_requested_partition(cursor, month))
+    return get_partition_table(month)
+
+
+# Creates the partition of the given month that has been requested by
+# `ensure_partition`.
+def create_requested_partition(cursor, month):
+    try:
+        create_partitions(cursor, [month])
+    finally:
+        requested_partitions.discard(month)
+
+
+# Creates the partitions for the current and the next month if they do not
+# exist yet.
+#
+# This function should be called periodically such that the partitions
+# exist before `add_measurements` is called for the first time in a month.
+def create_upcoming_partitions():
+    now = datetime.datetime.now(datetime.timezone.utc)
+    next_month = now.replace(day=1) + datetime.timedelta(days=32)
+    months = [now.strftime('%Y-%m'), next_month.strftime('%Y-%m')]
+    persistance.transaction(lambda cursor: create_partitions(cursor, months))
+
+
+# Creates the partitions for the given months and their triggers if they do
+# not exist yet.
+def create_partitions(cursor, months):
+    global partitions
+    with partitions_lock:
+        for month in months:
+            create_partition_table(cursor, month)
+            create_partition_triggers(cursor, month)
+        partitions = tuple(sorted(set(partitions) | set(months)))
+
+
+# Creates the table for the partition of the given month if it does not exist.
+def create_partition_table(cursor, month):
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {get_partition_table(month)} (
+            pot_id         INTEGER    NOT NULL,
+            soil_moisture  INTEGER    NOT NULL,
+            water_level    INTEGER    NOT NULL,
+            timestamp      TIMESTAMP  NOT NULL  DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY ( pot_id, timestamp ),
+            FOREIGN KEY ( pot_id ) REFERENCES known_pots ( id )
+        )
+    ''')
+
+
+# Creates the triggers that update the rollup tables when a measurement is
+# inserted into the partition of the given month if they do not exist.
+def create_partition_triggers(cursor, month):
+    table = get_partition_table(month)
+    for resolution in ROLLUP_BUCKET_FORMATS:
+        upsert = get_rollup_upsert(resolution, 'NEW.pot_id',
+                                   'NEW.soil_moisture', 'NEW.water_level',
+                                   'NEW.timestamp')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS update_rollups_{resolution}_of_{table}
+            AFTER INSERT ON {table}
+            BEGIN
+                {upsert};
+            END
+        ''')
+
+
+# Gets a statement that adds a reading to its bucket in the rollup table of
+# the given resolution.
+#
+# The pot ID, soil moisture, water level and timestamp of the reading are
+# given as SQL expressions (e.g., columns of the `NEW` row of a trigger or
+# parameters).
+def get_rollup_upsert(resolution, pot_id, soil_moisture, water_level,
+                      timestamp):
+    bucket_format = ROLLUP_BUCKET_FORMATS[resolution]
+    return f'''
+        INSERT INTO measurement_rollups_{resolution} VALUES (
+            {pot_id}, strftime('{bucket_format}', {timestamp}), 1,
+            {soil_moisture}, {soil_moisture}, {soil_moisture},
+            {water_level}, {water_level}, {water_level}
+        )
+        ON CONFLICT ( pot_id, bucket ) DO UPDATE SET
+            count = count + 1,
+            min_soil_moisture = min(min_soil_moisture,
+                                    excluded.min_soil_moisture),
+            max_soil_moisture = max(max_soil_moisture,
+                                    excluded.max_soil_moisture),
+            sum_soil_moisture = sum_soil_moisture
+                                + excluded.sum_soil_moisture,
+            min_water_level = min(min_water_level,
+                                  excluded.min_water_level),
+            max_water_level = max(max_water_level,
+                                  excluded.max_water_level),
+            sum_water_level = sum_water_level
+                              + excluded.sum_water_level
+    '''
+
+
+# Drops the partitions of the given months.
+def drop_partitions(months):
+    global partitions
+    with partitions_lock:
+        partitions = tuple(month for month in partitions
+                           if month not in months)
+
+    def task(cursor):
+        for month in months:
+            table = get_partition_table(month)
+            cursor.execute(f'DROP TABLE IF EXISTS {table}')
+    persistance.transaction(task)
+
+
+# Gets the days (formatted as `YYYY-MM-DD`) of the given month in ascending
+# order.
+def get_days_of_month(month):
+    day = datetime.date.fromisoformat(month + '-01')
+    while day.strftime('%Y-%m') == month:
+        yield day.isoformat()
+        day += datetime.timedelta(days=1)
+
+
+# Moves all measurements of days that are older than `COLD_MEASUREMENT_AGE`
+# days from the partitions into the archive (see `measurement_archive`).
+#
+# The measurements are archived per pot and day. Partitions whose
+# measurements have all been archived are dropped. From the remaining
+# partition, the archived measurements are deleted per day.
+def archive_old_measurements():
+    cutoff_day = persistance.timestamp_days_ago(COLD_MEASUREMENT_AGE)[:10]
+    for month in partitions:
+        if month > cutoff_day[:7]:
+            break
+        table = get_partition_table(month)
+        pot_ids = [pot_id for pot_id, in persistance.fetchall(f'''
+            SELECT DISTINCT pot_id FROM {table}
+        ''')]
+
+        for day in get_days_of_month(month):
+            if day >= cutoff_day:
+                break
+            next_day = datetime.date.fromisoformat(day) \
+                + datetime.timedelta(days=1)
+            day_range = (day + ' 00:00:00', next_day.isoformat() + ' 00:00:00')
+
+            # Write blocks before deleting the measurements such that no
+            # measurements are lost if the hub crashes in between.
+            for pot_id in pot_ids:
+                rows = persistance.fetchall(f'''
+                    SELECT timestamp, soil_moisture, water_level FROM {table}
+                    WHERE pot_id = ? AND timestamp >= ? AND timestamp < ?
+                    ORDER BY timestamp ASC
+                ''', (pot_id, *day_range))
+                if rows:
+                    measurement_archive.write_block(pot_id, day, rows)
+
+            if month == cutoff_day[:7]:
+                def delete_day(cursor):
+                    for pot_id in pot_ids:
+                        cursor.execute(f'''
+                            DELETE FROM {table}
+                            WHERE pot_id = ? AND timestamp >= ?
+                                             AND timestamp < ?
+                        ''', (pot_id, *day_range))
+                persistance.transaction(delete_day)
+
+        if month < cutoff_day[:7]:
+            drop_partitions([month])
+
+
+# Removes all measurements that are older than `MEASUREMENT_MAX_AGE` days and
+# all buckets of the rollup tables that are older than their maximum age (see
+# `ROLLUP_MAX_AGES`).
+#
+# Archived measurements are removed by deleting the block files of old days.
+# Measurements that have not been archived yet are removed by dropping whole
+# partitions, which is much faster than deleting the measurements one by one.
 def remove_old_measurements():
-    persistance.execute('''
-        DELETE FROM measurements WHERE timestamp < datetime('now', ?)
-    ''', (f'-{MEASUREMENT_MAX_AGE} days',))
+    timestamp = persistance.timestamp_days_ago(MEASUREMENT_MAX_AGE)
+    drop_partitions([month for month in partitions if month < timestamp[:7]])
+    measurement_archive.remove_blocks_before(timestamp[:10])
+    pot_states.expire_pot_states('measurement', lambda m: m.timestamp,
+                                 timestamp[:10] + ' 00:00:00')
+
+    for resolution, max_age in ROLLUP_MAX_AGES.items():
+        persistance.execute(f'''
+            DELETE FROM measurement_rollups_{resolution} WHERE bucket < ?
+        ''', (persistance.timestamp_days_ago(max_age),))
+
+
+# Creates the rollup tables and the partitions of all measurements if they do
+# not exist yet.
+#
+# Measurements from the unpartitioned `measurements` table of previous
+# versions are moved into partitions. When a rollup table is created, it is
+# initialized with the measurements that have been recorded before.
+def create_tables(cursor):
+    global partitions
+
+    # Create rollup tables.
+    new_rollup_tables = []
+    for resolution in ROLLUP_BUCKET_FORMATS:
+        table = f'measurement_rollups_{resolution}'
+        if not table_exists(cursor, table):
+            new_rollup_tables.append(resolution)
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                pot_id             INTEGER    NOT NULL,
+                bucket             TIMESTAMP  NOT NULL,
+                count              INTEGER    NOT NULL,
+                min_soil_moisture  INTEGER    NOT NULL,
+                max_soil_moisture  INTEGER    NOT NULL,
+                sum_soil_moisture  INTEGER    NOT NULL,
+                min_water_level    INTEGER    NOT NULL,
+                max_water_level    INTEGER    NOT NULL,
+                sum_water_level    INTEGER    NOT NULL,
+                PRIMARY KEY ( pot_id, bucket ),
+                FOREIGN KEY ( pot_id ) REFERENCES known_pots ( id )
+            )
+        ''')
+
+    # Move measurements from the unpartitioned table. The triggers are
+    # created afterwards since the rollup tables contain these measurements
+    # already unless they have just been created.
+    if table_exists(cursor, 'measurements'):
+        for month, in cursor.execute('''
+            SELECT DISTINCT substr(timestamp, 1, 7) FROM measurements
+        ''').fetchall():
+            create_partition_table(cursor, month)
+            cursor.execute(f'''
+                INSERT INTO {get_partition_table(month)}
+                SELECT * FROM measurements WHERE substr(timestamp, 1, 7) = ?
+            ''', (month,))
+        cursor.execute('DROP TABLE measurements')
+
+    # Find existing partitions and create missing triggers.
+    months = [table[len(PARTITION_PREFIX):].replace('_', '-')
+              for table, in cursor.execute('''
+                  SELECT name FROM sqlite_master
+                  WHERE type = 'table' AND name GLOB ?
+              ''', (PARTITION_PREFIX + '[0-9][0-9][0-9][0-9]_[0-9][0-9]',))]
+    for month in months:
+        create_partition_triggers(cursor, month)
+    partitions = tuple(sorted(months))
+
+    # Initialize new rollup tables.
+    for resolution in new_rollup_tables:
+        bucket_format = ROLLUP_BUCKET_FORMATS[resolution]
+        for month in partitions:
+            cursor.execute(f'''
+                INSERT INTO measurement_rollups_{resolution}
+                SELECT pot_id, strftime('{bucket_format}', timestamp),
+                       COUNT(*),
+                       MIN(soil_moisture), MAX(soil_moisture),
+                       SUM(soil_moisture),
+                       MIN(water_level), MAX(water_level), SUM(water_level)
+                FROM {get_partition_table(month)}
+                GROUP BY 1, 2
+            ''')
+
+
+# Tests whether a table with the given name exists.
+def table_exists(cursor, table):
+    return cursor.execute('''
+        SELECT EXISTS (SELECT name FROM sqlite_master
+                       WHERE type = 'table' AND name = ?)
+    ''', (table,)).fetchone()[0] == 1
+
+
+persistance.transaction(create_tables)
+create_upcoming_partitions()
+load_last_measurements()
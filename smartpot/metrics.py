@@ -0,0 +1,165 @@
+# This module collects metrics about the Smart Pot Hub (e.g., database queue
+# depth, connection attempts and REST API latency) and renders them in the
+# Prometheus text format (see `GET /metrics` in `rest_api`).
+#
+# Metrics are only collected if the `SMART_POT_METRICS` environment variable
+# is set to `1`. Code that records metrics on a hot path must check `ENABLED`
+# first such that the instrumentation costs nothing but a single check when
+# metrics are disabled, e.g.,
+#
+#     if metrics.ENABLED:
+#         start = time.perf_counter()
+#
+# Metrics are defined at module level in the modules that record them. Every
+# metric registers itself when it is created. Values can be recorded from any
+# thread.
+
+import os
+import threading
+
+from typing import List
+
+# Whether metrics are collected.
+ENABLED = os.environ.get('SMART_POT_METRICS', '0') == '1'
+
+# The default upper bounds of the buckets of histograms in seconds.
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0,
+                   5.0, 10.0, 30.0)
+
+
+# Base class of all metrics.
+#
+# A metric has a name, a help text and the names of its labels. A value is
+# recorded for every combination of label values that has been used.
+class Metric:
+    type = None
+
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    # Renders the metric in the Prometheus text format.
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}',
+                 f'# TYPE {self.name} {self.type}']
+        for labels, value in self.collect():
+            lines.append(self.render_sample(self.name, labels, value))
+        return '\n'.join(lines)
+
+    # Renders a single sample of the metric with the given label values.
+    def render_sample(self, name, labels, value, extra_labels=()):
+        pairs = list(zip(self.label_names, labels)) + list(extra_labels)
+        if not pairs:
+            return f'{name} {format_value(value)}'
+        label_text = ','.join(f'{label}="{escape_label(value)}"'
+                              for label, value in pairs)
+        return f'{name}{{{label_text}}} {format_value(value)}'
+
+    # Gets a list of tuples of the label values and the value of the metric.
+    def collect(self):
+        raise NotImplementedError
+
+
+# A metric whose value only increases (e.g., the number of failed
+# connection attempts).
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name, help, label_names=()):
+        Metric.__init__(self, name, help, label_names)
+        self._values = {}
+
+    # Increments the counter with the given label values by the given amount.
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def collect(self):
+        with self._lock:
+            return sorted(self._values.items())
+
+
+# A metric whose value is computed by calling the given function when the
+# metric is rendered (e.g., the length of a queue).
+#
+# The function returns a list of tuples of the label values and the value.
+class CallbackGauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name, help, label_names, callback):
+        Metric.__init__(self, name, help, label_names)
+        self._callback = callback
+
+    def collect(self):
+        return self._callback()
+
+
+# A metric that counts observed values (e.g., durations) in buckets.
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, label_names=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, help, label_names)
+        self.buckets = tuple(buckets)
+        self._values = {}
+
+    # Records the given value for the given label values.
+    def observe(self, value, *labels):
+        with self._lock:
+            counts, total = self._values.get(labels, (None, 0))
+            if counts is None:
+                counts = [0] * (len(self.buckets) + 1)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+            self._values[labels] = (counts, total + value)
+
+    def collect(self):
+        with self._lock:
+            return sorted((labels, (list(counts), total))
+                          for labels, (counts, total) in self._values.items())
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}',
+                 f'# TYPE {self.name} {self.type}']
+        for labels, (counts, total) in self.collect():
+            cumulative = 0
+            bounds = [format_value(bound) for bound in self.buckets] + ['+Inf']
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                lines.append(self.render_sample(
+                    f'{self.name}_bucket', labels, cumulative,
+                    [('le', bound)]))
+            lines.append(self.render_sample(
+                f'{self.name}_sum', labels, total))
+            lines.append(self.render_sample(
+                f'{self.name}_count', labels, cumulative))
+        return '\n'.join(lines)
+
+
+# All metrics that have been created.
+registry: List[Metric] = []
+
+
+# Formats the value of a sample.
+def format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+# Escapes the value of a label.
+def escape_label(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+# Renders all metrics in the Prometheus text format.
+def render():
+    return ''.join(metric.render() + '\n' for metric in list(registry))
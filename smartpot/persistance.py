@@ -4,35 +4,215 @@
 # is running scripts including this module will not terminate.
 # To savely terminate the worker thread run `persistance.worker.shutdown()`.
 #
+# The database is opened in WAL mode such that readers do not block the worker
+# thread and vice versa. Queries that only read data (`fetchone` and
+# `fetchall`) are processed in parallel by a pool of reader threads with
+# read-only connections. All changes are made by the worker thread in the
+# order in which they have been enqueued.
+#
 # All operations in this module synchronize with the worker thread, i.e., they
 # enqueue a task and block until it has been processed by the worker thread.
+# The only exceptions are `buffer_insert` and `buffer_insert_many`, which
+# enqueue rows without waiting. Buffered rows are saved in groups to reduce the
+# number of commits.
+#
+# Code that runs in an event loop must not block. Therefore, there are
+# awaitable counterparts of most operations whose names are prefixed with `a`
+# (e.g., `afetchone`). They do not block the event loop while the task is
+# waiting in the queue or being processed by the worker thread.
 
+import asyncio
+import datetime
 import mvar
+import os
 import queue
+import smartpot.metrics as metrics
+import smartpot.query_log as query_log
 import sqlite3
 import threading
+import time
 
+# The path of the SQLite database file.
+DATABASE_FILE = os.environ.get('SMART_POT_DB', 'smart-pot.db')
 
-# A thread that performs all database operations.
-class WorkerThread(threading.Thread):
-    def __init__(self):
-        threading.Thread.__init__(self)
-        self.deamon = True
-        self.name = 'Database Worker Thread'
+# The number of reader threads that process `fetchone` and `fetchall` queries.
+# If set to zero, all queries are processed by the worker thread.
+READER_COUNT = int(os.environ.get('SMART_POT_DB_READERS', '2'))
+
+# The maximum number of rows that are fetched at once by `fetch_chunks`.
+FETCH_CHUNK_SIZE = 1000
+
+# The largest integer that can be stored by SQLite (e.g., the largest row ID).
+MAX_ROWID = 2 ** 63 - 1
+
+# The maximum number of rows that are buffered by `buffer_insert` before they
+# are saved in a single transaction.
+GROUP_COMMIT_MAX_ROWS = int(
+    os.environ.get('SMART_POT_GROUP_COMMIT_MAX_ROWS', '100'))
+
+# The maximum time in milliseconds a row that has been buffered by
+# `buffer_insert` is kept in memory before it is saved. This is the maximum
+# amount of data that is lost if the hub crashes.
+GROUP_COMMIT_MAX_DELAY_MS = float(
+    os.environ.get('SMART_POT_GROUP_COMMIT_MAX_DELAY_MS', '1000'))
+
+# Metrics of the tasks of the task queues (see `metrics`).
+task_wait_seconds = metrics.Histogram(
+    'smartpot_db_task_wait_seconds',
+    'Time database tasks wait in the queue.', ['queue'])
+task_execute_seconds = metrics.Histogram(
+    'smartpot_db_task_execute_seconds',
+    'Time database threads spend executing tasks.', ['queue'])
+
+
+# A queue of tasks that are processed by one or more database threads.
+#
+# The given name identifies the queue in metrics.
+class TaskQueue:
+    def __init__(self, queue_name):
+        self.queue_name = queue_name
         self._queue = queue.Queue()
-        self._isRunning = True
 
-    # Enqueues a task to be executed by the worker thread and blocks until
+    # Enqueues a task to be executed by a database thread.
+    #
+    # When the task completes, the database thread invokes the given callback
+    # with the result of the task and a flag that indicates whether the
+    # result is an exception that has been thrown by the task.
+    def submit_task(self, task, on_result):
+        if (metrics.ENABLED or query_log.ENABLED) and task is not None:
+            task = self._timed_task(task)
+        self._queue.put((task, on_result))
+
+    # Wraps the given task such that the time it waits in the queue and the
+    # time it takes to execute are recorded (see `metrics`) as well as the
+    # statements it executes (see `query_log`).
+    def _timed_task(self, task):
+        enqueued_at = time.perf_counter()
+        call_site = query_log.get_call_site() if query_log.ENABLED else None
+
+        def timed_task(cursor):
+            started_at = time.perf_counter()
+            if query_log.ENABLED:
+                cursor = query_log.TracingCursor(cursor)
+            try:
+                return task(cursor)
+            finally:
+                finished_at = time.perf_counter()
+                if metrics.ENABLED:
+                    task_wait_seconds.observe(started_at - enqueued_at,
+                                              self.queue_name)
+                    task_execute_seconds.observe(finished_at - started_at,
+                                                 self.queue_name)
+                if query_log.ENABLED:
+                    query_log.record(cursor, call_site,
+                                     started_at - enqueued_at,
+                                     finished_at - started_at)
+        return timed_task
+
+    # Enqueues a task to be executed by a database thread and blocks until
     # the task completes.
     def await_task(self, task):
         result_var = mvar.MVar()
-        self._queue.put((task, result_var))
+        self.submit_task(task, lambda *result: result_var.put(result))
         result, is_error = result_var.take()
         if is_error:
             raise result
         return result
 
+    # Enqueues a task to be executed by a database thread and returns a future
+    # that is resolved in the running event loop when the task completes.
+    def async_task(self, task):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        # The event loop may have been closed while the task was pending.
+        def on_result(result, is_error):
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(
+                    resolve_future, future, result, is_error)
+        self.submit_task(task, on_result)
+        return future
+
+
+# A thread that performs all database operations that modify the database.
+class WorkerThread(TaskQueue, threading.Thread):
+    def __init__(self):
+        TaskQueue.__init__(self, 'worker')
+        threading.Thread.__init__(self)
+        self.deamon = True
+        self.name = 'Database Worker Thread'
+        self._isRunning = True
+
+        # Rows that have been buffered by `buffer_insert` but not saved yet.
+        # The dictionary maps insert queries to lists of arguments and is only
+        # accessed by the worker thread.
+        self._buffer = {}
+        self._buffered_rows = 0
+        self._flush_deadline = None
+
+    # Enqueues a row to be inserted with the given query without blocking.
+    #
+    # The row is saved once `GROUP_COMMIT_MAX_ROWS` rows have been buffered,
+    # `GROUP_COMMIT_MAX_DELAY_MS` milliseconds have passed or before the next
+    # task that is not a buffered row runs.
+    def buffer_insert(self, query, args):
+        self.buffer_insert_many(query, (args,))
+
+    # Enqueues multiple rows to be inserted with the given query as a single
+    # task without blocking (see `buffer_insert`).
+    def buffer_insert_many(self, query, rows):
+        self.submit_task(lambda _: self._buffer_rows(query, rows), None)
+
+    # Adds rows to the buffer. Called by the worker thread only.
+    def _buffer_rows(self, query, rows):
+        if self._flush_deadline is None:
+            delay = GROUP_COMMIT_MAX_DELAY_MS / 1000
+            self._flush_deadline = time.monotonic() + delay
+        self._buffer.setdefault(query, []).extend(rows)
+        self._buffered_rows += len(rows)
+
+    # Gets the number of seconds until the buffered rows must be saved or
+    # `None` if there are no buffered rows.
+    def _time_until_flush(self):
+        if self._flush_deadline is None:
+            return None
+        return max(0, self._flush_deadline - time.monotonic())
+
+    # Saves all buffered rows in a single transaction.
+    #
+    # If the transaction fails, the rows are inserted one by one such that a
+    # single invalid row (e.g., a duplicate key) does not discard all others.
+    def _flush_buffer(self, cursor):
+        if not self._buffer:
+            return
+        buffer = self._buffer
+        self._buffer = {}
+        self._buffered_rows = 0
+        self._flush_deadline = None
+        if query_log.ENABLED:
+            started_at = time.perf_counter()
+            cursor = query_log.TracingCursor(cursor)
+        try:
+            for query, rows in buffer.items():
+                cursor.executemany(query, rows)
+            cursor.connection.commit()
+        except sqlite3.Error:
+            cursor.connection.rollback()
+            for query, rows in buffer.items():
+                for args in rows:
+                    try:
+                        cursor.execute(query, args)
+                    except sqlite3.Error as e:
+                        print(f'Error: Dropped buffered row {args}: {e}')
+            cursor.connection.commit()
+        if query_log.ENABLED:
+            query_log.record(cursor, 'group commit', 0.0,
+                             time.perf_counter() - started_at)
+
     # Savely terminates the worker thread.
+    #
+    # Rows that have been buffered by `buffer_insert` are saved before the
+    # thread terminates.
     def shutdown(self):
         def task(_):
             print(f'Shutting down {self.name}...')
@@ -44,27 +224,125 @@ class WorkerThread(threading.Thread):
     def run(self):
         # Connect to database.
         print(f'Started {self.name}')
-        with sqlite3.connect('smart-pot.db') as connection:
+        with sqlite3.connect(DATABASE_FILE) as connection:
             cursor = connection.cursor()
+            cursor.execute('PRAGMA journal_mode = WAL')
 
-            # Execute enqueued tasks.
+            # Execute enqueued tasks. Buffered rows are saved before all other
+            # tasks such that they observe the buffered changes.
             while self._isRunning:
                 try:
-                    task, result_var = self._queue.get()
+                    timeout = self._time_until_flush()
+                    task, on_result = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    task, on_result = None, None
+
+                # Errors of tasks without callback (i.e., buffered rows and
+                # flushes) are logged such that the thread keeps running.
+                if on_result is None:
+                    try:
+                        if task is not None:
+                            task(cursor)
+                        if (task is None or self._buffered_rows
+                                >= GROUP_COMMIT_MAX_ROWS):
+                            self._flush_buffer(cursor)
+                    except Exception as e:
+                        print(f'Error: Failed to save buffered rows: {e}')
+                    continue
+
+                try:
+                    self._flush_buffer(cursor)
                     result = task(cursor)
-                    result_var.put((result, False))
+                    on_result(result, False)
                 except Exception as e:
-                    result_var.put((e, True))
+                    on_result(e, True)
+
+
+# A thread that processes read-only queries of a `ReaderPool`.
+#
+# Reader threads are daemon threads since they do not have to save any
+# changes before the program terminates.
+class ReaderThread(threading.Thread):
+    def __init__(self, task_queue, index):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.name = f'Database Reader Thread {index}'
+        self._queue = task_queue
+
+    # Main loop of the thread.
+    def run(self):
+        # Connect to database.
+        uri = f'file:{DATABASE_FILE}?mode=ro'
+        with sqlite3.connect(uri, uri=True) as connection:
+            cursor = connection.cursor()
+
+            # Execute enqueued tasks until a `None` task is dequeued.
+            while True:
+                task, on_result = self._queue.get()
+                if task is None:
+                    break
+                try:
+                    result = task(cursor)
+                    on_result(result, False)
+                except Exception as e:
+                    on_result(e, True)
+
+
+# A pool of reader threads that share a single queue of read-only tasks.
+class ReaderPool(TaskQueue):
+    def __init__(self, size):
+        TaskQueue.__init__(self, 'readers')
+        self._threads = [ReaderThread(self._queue, i) for i in range(size)]
+
+    # Starts all reader threads.
+    #
+    # The threads must not be started before the database file exists.
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    # Terminates all reader threads after the pending tasks are processed.
+    def shutdown(self):
+        for _ in self._threads:
+            self.submit_task(None, None)
+        for thread in self._threads:
+            thread.join()
+
+
+# Sets the result or exception of the given future unless it has been
+# cancelled in the meantime.
+def resolve_future(future, result, is_error):
+    if future.cancelled():
+        return
+    if is_error:
+        future.set_exception(result)
+    else:
+        future.set_result(result)
 
 
 worker = WorkerThread()
 worker.start()
 
+# The task queue for read-only queries.
+readers = ReaderPool(READER_COUNT) if READER_COUNT > 0 else worker
 
-# Calls the given callback with a new cursor and saves the changes if the
-# callback completes without throwing an exception. Otherwise, the transaction
-# is rolled back and the exception is rethrown.
-def transaction(callback):
+
+# Gets the number of pending tasks of the task queues.
+def get_queue_depths():
+    task_queues = [worker] if readers is worker else [worker, readers]
+    return [((task_queue.queue_name,), task_queue._queue.qsize())
+            for task_queue in task_queues]
+
+
+metrics.CallbackGauge('smartpot_db_queue_depth',
+                      'Number of pending database tasks.', ['queue'],
+                      get_queue_depths)
+
+
+# Creates a task that calls the given callback with a cursor and saves the
+# changes if the callback completes without throwing an exception. Otherwise,
+# the transaction is rolled back and the exception is rethrown.
+def transaction_task(callback):
     def task(cursor):
         try:
             result = callback(cursor)
@@ -73,17 +351,80 @@ def transaction(callback):
         except Exception:
             cursor.connection.rollback()
             raise
-    return worker.await_task(task)
+    return task
 
 
-# Executes the given query and fetches the first result.
+# Calls the given callback with a new cursor and saves the changes if the
+# callback completes without throwing an exception. Otherwise, the transaction
+# is rolled back and the exception is rethrown.
+def transaction(callback):
+    return worker.await_task(transaction_task(callback))
+
+
+# Awaitable counterpart of `transaction`.
+async def atransaction(callback):
+    return await worker.async_task(transaction_task(callback))
+
+
+# Enqueues a transaction (see `transaction`) without waiting for it to be
+# executed.
+#
+# The transaction is executed in order with all other tasks of the worker
+# thread, e.g., before rows that are buffered afterwards. Errors are logged
+# but not reported to the caller.
+def enqueue_transaction(callback):
+    worker.submit_task(transaction_task(callback), None)
+
+
+# Executes the given read-only query and fetches the first result.
+#
+# Rows that have been buffered by `buffer_insert` but not saved yet are not
+# visible to the query.
 def fetchone(query, args=()):
-    return worker.await_task(lambda c: c.execute(query, args).fetchone())
+    return readers.await_task(lambda c: c.execute(query, args).fetchone())
+
 
+# Awaitable counterpart of `fetchone`.
+async def afetchone(query, args=()):
+    return await readers.async_task(
+        lambda c: c.execute(query, args).fetchone())
 
-# Executes the given query and fetches all results.
+
+# Executes the given read-only query and fetches all results.
+#
+# Rows that have been buffered by `buffer_insert` but not saved yet are not
+# visible to the query.
 def fetchall(query, args=()):
-    return worker.await_task(lambda c: c.execute(query, args).fetchall())
+    return readers.await_task(lambda c: c.execute(query, args).fetchall())
+
+
+# Awaitable counterpart of `fetchall`.
+async def afetchall(query, args=()):
+    return await readers.async_task(
+        lambda c: c.execute(query, args).fetchall())
+
+
+# Iterates over the result of the given read-only query in chunks of at most
+# `FETCH_CHUNK_SIZE` rows.
+#
+# The rows are fetched using keyset pagination, i.e., the query is executed
+# once per chunk and no read transaction is kept open between chunks.
+# Therefore, iterating over a large result neither keeps a reader thread busy
+# nor needs to hold all rows in memory.
+#
+# The first columns of each row are its key. The query must select only rows
+# whose key is greater than the key passed as the first arguments, order them
+# by their key and end with `LIMIT ?`. The remaining arguments are passed
+# after the key. The given key is the exclusive lower bound of the first
+# chunk.
+def fetch_chunks(query, key, args=()):
+    while True:
+        rows = fetchall(query, (*key, *args, FETCH_CHUNK_SIZE))
+        if rows:
+            yield rows
+        if len(rows) < FETCH_CHUNK_SIZE:
+            return
+        key = rows[-1][:len(key)]
 
 
 # Executes the given query and saves the changes if it completes sucessfully.
@@ -91,12 +432,74 @@ def execute(query, args=()):
     return transaction(lambda c: c.execute(query, args))
 
 
+# Awaitable counterpart of `execute`.
+async def aexecute(query, args=()):
+    return await atransaction(lambda c: c.execute(query, args))
+
+
 # Executes the given insert query, saves the changes and returns the ID of the
 # inserted row.
 def execute_insert(query, args=()):
     return execute(query, args).lastrowid
 
 
+# Awaitable counterpart of `execute_insert`.
+async def aexecute_insert(query, args=()):
+    return (await aexecute(query, args)).lastrowid
+
+
+# Enqueues the given insert query without waiting for it to be executed.
+#
+# The changes are saved together with other buffered rows after at most
+# `GROUP_COMMIT_MAX_DELAY_MS` milliseconds. Errors are logged but not reported
+# to the caller.
+def buffer_insert(query, args=()):
+    worker.buffer_insert(query, args)
+
+
+# Like `buffer_insert` but enqueues a list of rows at once.
+def buffer_insert_many(query, rows):
+    worker.buffer_insert_many(query, rows)
+
+
+# Blocks until all rows that have been buffered by `buffer_insert` are saved.
+def flush():
+    worker.await_task(lambda _: None)
+
+
+# Gets the current UTC time as a naive `datetime` (see `format_timestamp`).
+def utc_now():
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+# Gets the current UTC time in the format of SQLite's `CURRENT_TIMESTAMP`.
+#
+# Timestamps have to be generated when a row is buffered and not by the
+# database, since buffered rows may be saved later.
+def current_timestamp():
+    return timestamp_days_ago(0)
+
+
+# Gets the UTC time the given number of days ago in the format of SQLite's
+# `CURRENT_TIMESTAMP`.
+def timestamp_days_ago(days):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return format_timestamp(now - datetime.timedelta(days=days))
+
+
+# Converts the given `datetime` to UTC and formats it like SQLite's
+# `CURRENT_TIMESTAMP`. Naive `datetime`s are assumed to be in UTC already.
+def format_timestamp(value):
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc)
+    return value.strftime('%Y-%m-%d %H:%M:%S')
+
+
+# Parses a timestamp that has been formatted by `format_timestamp` or SQLite.
+def parse_timestamp(timestamp):
+    return datetime.datetime.fromisoformat(timestamp)
+
+
 # Initializes the database if the tables do not exist.
 def create_tables(cursor):
     cursor.execute('''
@@ -106,16 +509,6 @@ def create_tables(cursor):
             name  TEXT     NOT NULL
         )
     ''')
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS measurements (
-            pot_id         INTEGER    NOT NULL,
-            soil_moisture  INTEGER    NOT NULL,
-            water_level    INTEGER    NOT NULL,
-            timestamp      TIMESTAMP  NOT NULL  DEFAULT CURRENT_TIMESTAMP,
-            PRIMARY KEY ( pot_id, timestamp ),
-            FOREIGN KEY ( pot_id ) REFERENCES known_pots ( id )
-        )
-    ''')
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS pump_history (
             pot_id       INTEGER    NOT NULL,
@@ -129,3 +522,5 @@ def create_tables(cursor):
 
 
 transaction(create_tables)
+if readers is not worker:
+    readers.start()
@@ -0,0 +1,89 @@
+# This module maintains an in-memory cache of the latest state of each known
+# pot, i.e., its last measurement and its last pump task. The addresses of
+# known pots are cached by `known_pots`.
+#
+# The cache is written through by the modules that modify the corresponding
+# tables (`measurements` and `pump_tasks`). These modules also
+# load their part of the cache from the database when they are imported.
+# Thus, the latest state of a pot can be looked up without a database query.
+#
+# States are immutable and replaced atomically. Therefore, they can be read
+# without locking.
+#
+# Every update of a state increments a global version counter. The version of
+# a state is the value of the counter when the state was updated last. Thus,
+# the version of a state changes whenever the state changes and the global
+# version changes whenever any state changes. Other changes of a pot (e.g.,
+# its connection status) can be signalled by calling `update_pot_state`
+# without fields.
+
+import collections
+import threading
+
+from typing import Dict
+
+# The latest state of a known pot.
+#
+# The `measurement` and `last_pump_task` fields are `None` if there is no
+# measurement or pump task for the pot yet. The `version` is the value of the
+# global version counter when the state was updated last.
+PotState = collections.namedtuple('PotState', [
+    'measurement',
+    'last_pump_task',
+    'version',
+])
+
+# The state of a pot that has not been added to the cache yet.
+EMPTY_POT_STATE = PotState(None, None, 0)
+
+# Dictionary that maps the IDs of known pots to their latest state.
+pot_states: Dict[int, PotState] = {}
+
+# Lock that serializes updates of `pot_states`.
+update_lock = threading.Lock()
+
+# The version of the last update of any state.
+version = 0
+
+
+# Gets the latest state of the pot with the given ID.
+def get_pot_state(pot_id):
+    return pot_states.get(pot_id, EMPTY_POT_STATE)
+
+
+# Gets the version of the last update of any state.
+def get_version():
+    return version
+
+
+# Replaces the given fields of the state of the pot with the given ID and
+# increments the version of the state.
+def update_pot_state(pot_id, **fields):
+    global version
+    with update_lock:
+        version += 1
+        state = pot_states.get(pot_id, EMPTY_POT_STATE)
+        pot_states[pot_id] = state._replace(version=version, **fields)
+
+
+# Removes the state of the pot with the given ID from the cache.
+def remove_pot_state(pot_id):
+    with update_lock:
+        pot_states.pop(pot_id, None)
+
+
+# Sets the given field of all states to `None` if the timestamp of its value
+# is older than the given timestamp. The timestamp of a value is obtained by
+# calling the given function.
+#
+# This function is used to forget values that have been removed from the
+# database because they are too old.
+def expire_pot_states(field, get_timestamp, timestamp):
+    global version
+    with update_lock:
+        for pot_id, state in list(pot_states.items()):
+            value = getattr(state, field)
+            if value is not None and get_timestamp(value) < timestamp:
+                version += 1
+                pot_states[pot_id] = state._replace(version=version,
+                                                    **{field: None})
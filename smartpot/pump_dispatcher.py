@@ -0,0 +1,132 @@
+# This module executes pump tasks on the connected Smart Pots.
+#
+# Every connected pot has its own queue of pump tasks and a worker coroutine
+# that executes the tasks of the queue one after another. Thus, pump tasks of
+# different pots are executed in parallel while the writes to the same pot
+# never interleave. The queue and worker of a pot live in the event loop of
+# the shard that connected the pot (see `connected_pots`), but tasks can be
+# dispatched from any thread.
+#
+# A pump task is identified by its pot ID and creation timestamp. The keys of
+# all queued tasks are kept in memory such that a task is never queued twice
+# (for example, because it was dispatched by the REST API while its pot
+# connected and restored the pending tasks from the database).
+#
+# Tasks of pots that are not connected are not queued. They remain pending in
+# the database and are queued when the pot connects.
+
+import asyncio
+import smartpot.characteristics as characteristics
+import smartpot.metrics as metrics
+import smartpot.pump_tasks as pump_tasks
+import time
+
+from typing import Dict, Set, Tuple
+
+# Dictionary that maps the IDs of connected pots to the event loop that runs
+# their worker.
+worker_loops: Dict[int, asyncio.AbstractEventLoop] = {}
+
+# Dictionary that maps the IDs of connected pots to their queue of pump tasks.
+pump_queues: Dict[int, asyncio.Queue] = {}
+
+# Dictionary that maps the IDs of connected pots to their worker.
+workers: Dict[int, asyncio.Task] = {}
+
+# The `(pot_id, created_at)` keys of all queued tasks that have not been
+# executed yet.
+pending_keys: Set[Tuple[int, str]] = set()
+
+# Dictionary that maps the keys of queued tasks to the time they have been
+# queued. Only maintained if metrics are enabled.
+enqueue_times: Dict[Tuple[int, str], float] = {}
+
+# The time from queuing a task until it has been written to its pot (see
+# `metrics`).
+task_latency_seconds = metrics.Histogram(
+    'smartpot_pump_task_latency_seconds',
+    'Time from queuing a pump task until it is written to its pot.')
+
+
+# Dispatches the given pump task to the worker of its pot.
+#
+# This function can be called from any thread. If the pot is not connected,
+# the task is ignored.
+def dispatch(task):
+    loop = worker_loops.get(task.pot_id)
+    if loop is not None:
+        loop.call_soon_threadsafe(enqueue, task)
+
+
+# Puts the given pump task into the queue of its pot unless it has been queued
+# already or the pot is not connected.
+#
+# This function must be called in the event loop of the worker of the pot.
+def enqueue(task):
+    key = (task.pot_id, task.created_at)
+    if task.pot_id in pump_queues and key not in pending_keys:
+        pending_keys.add(key)
+        if metrics.ENABLED:
+            enqueue_times[key] = time.perf_counter()
+        pump_queues[task.pot_id].put_nowait(task)
+
+
+# Starts the worker of the pot with the given ID that has been connected via
+# the given client in the running event loop and queues the pending tasks of
+# the pot.
+#
+# The worker is started after the pending tasks have been queued such that a
+# task that is dispatched while the pending tasks are loaded cannot be
+# executed before it is deduplicated.
+async def start_worker(pot_id, client):
+    stop_worker(pot_id)
+    queue = asyncio.Queue()
+    worker_loops[pot_id] = asyncio.get_running_loop()
+    pump_queues[pot_id] = queue
+    for task in await pump_tasks.aget_pending_tasks_of(pot_id):
+        enqueue(task)
+    if pump_queues.get(pot_id) is queue:
+        workers[pot_id] = asyncio.ensure_future(
+            run_worker(pot_id, client, queue))
+
+
+# Stops the worker of the pot with the given ID and discards its queue.
+#
+# The discarded tasks remain pending in the database.
+def stop_worker(pot_id):
+    worker_loops.pop(pot_id, None)
+    queue = pump_queues.pop(pot_id, None)
+    worker = workers.pop(pot_id, None)
+    if worker is not None:
+        worker.cancel()
+    while queue is not None and not queue.empty():
+        task = queue.get_nowait()
+        pending_keys.discard((task.pot_id, task.created_at))
+        enqueue_times.pop((task.pot_id, task.created_at), None)
+
+
+# Executes the pump tasks from the given queue of the given pot.
+#
+# If a task fails, it remains pending in the database and is retried when the
+# pot reconnects.
+async def run_worker(pot_id, client, queue):
+    while True:
+        task = await queue.get()
+        try:
+            await characteristics.write_pump_amount(client, task.amount)
+            if metrics.ENABLED:
+                record_task_latency(task)
+            await pump_tasks.aset_task_execution_date(task)
+        except Exception as e:
+            print(f'Error: Failed to execute pump task of pot {pot_id}: {e}')
+        finally:
+            pending_keys.discard((task.pot_id, task.created_at))
+            enqueue_times.pop((task.pot_id, task.created_at), None)
+
+
+# Records the time from queuing the given task until it has been written to its
+# pot.
+def record_task_latency(task):
+    enqueue_time = enqueue_times.get((task.pot_id, task.created_at))
+    if enqueue_time is not None:
+        task_latency_seconds.observe(time.perf_counter() - enqueue_time)
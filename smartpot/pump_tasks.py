@@ -1,16 +1,18 @@
-# This module maintains a queue and persistant history of tasks to pump water
-# into a Smart Pot.
+# This module maintains a persistant history of tasks to pump water into a
+# Smart Pot.
 #
-# The queue contains `PumpTask`s that have not been completed yet.
-# The REST API enqueues new task. There is a background thread that
-# dequeues and executes the tasks.
+# The history contains both completed and pending tasks. The REST API creates
+# new tasks and dispatches them to the connected pot (see `pump_dispatcher`).
+# When a known pot connects, all of its pending pump tasks are dispatched.
+# History entries are retained for at most a year.
 #
-# The history is persistent and contains both completed and pending tasks.
-# When a known pot connects, all pending pump tasks are enqueued. History
-# entries are retained for at most a year.
+# Every state transition of a task (creation and execution) is a single
+# database statement. Timestamps are generated in Python such that they do not
+# have to be read back from the database.
 
-import queue
+import smartpot.events as events
 import smartpot.persistance as persistance
+import smartpot.pot_states as pot_states
 
 # The maximum amount of water that can be pumped in a single task.
 MAX_AMOUNT = 255
@@ -19,14 +21,11 @@ MAX_AMOUNT = 255
 # the database.
 HISTORY_ENTRY_MAX_AGE = 365
 
-# A Queue that contains the pending pump tasks.
-pump_tasks = queue.Queue()
-
 
 # A task for pumping water into a smart pot.
 #
 # This class is used both to represent a history entry that was fetched from
-# the database and as a queue enetry.
+# the database and a task that is dispatched to a pot.
 #
 # Usually you should not create an instance of this class directly.
 # Use the functions defined in this module to fetch instances from the
@@ -34,7 +33,8 @@ pump_tasks = queue.Queue()
 #
 # A pending task has no `executed_at` timestamp.
 # The `created_at` timestamp is automatically filled in by `add_history_entry`
-# when the history entry for the task is created.
+# when the history entry for the task is created. The `executed_at` timestamp
+# is filled in by `set_task_execution_date`.
 class PumpTask:
     def __init__(self, pot_id, amount, created_at=None, executed_at=None):
         self.pot_id = pot_id
@@ -43,100 +43,169 @@ class PumpTask:
         self.executed_at = executed_at
 
 
-# Enqueues a new task for pumping the given amount of water into the smart pot
+# Creates a new task for pumping the given amount of water into the smart pot
 # with the given ID.
 #
 # A history entry for the task is automatically added to the database.
-def enqueue_new_pump_task(pot_id, amount):
+def create_pump_task(pot_id, amount):
     task = PumpTask(pot_id, amount)
     add_history_entry(task)
-    enqueue_pump_task(task)
+    return task
 
 
-# Enqueues a the a pump task that already has a history entry.
-#
-# This function is used for exmaple to put a pending task back into the queue
-# after it has been restored from the database using `get_pending_tasks_of`.
-def enqueue_pump_task(task):
-    pump_tasks.put(task)
+# Awaitable counterpart of `create_pump_task`.
+async def acreate_pump_task(pot_id, amount):
+    task = PumpTask(pot_id, amount)
+    await aadd_history_entry(task)
+    return task
 
 
-# Dequeues a task for pumping water into a smart pot that has not been executed
-# yet.
+# Gets the last pump task of the pot with the given id.
 #
-# This method blocks until a pending task is available.
-def dequeue_pump_task():
-    while True:
-        task = pump_tasks.get()
-
-        # Do not execute tasks twice if they are enqueed twice (for example,
-        # because the pot reconnected twice before the task was executed).
-        if not has_executed_task(task):
-            return task
+# The task is looked up in the cache (see `pot_states`).
+def get_last_task_of(pot_id):
+    return pot_states.get_pot_state(pot_id).last_pump_task
 
 
-# Gets the last pump task of the pot with the given id.
-def get_last_task_of(pot_id):
-    result = persistance.fetchone('''
-        SELECT amount, created_at, executed_at FROM pump_history
-        WHERE pot_id = ?
-        ORDER BY created_at DESC
-        LIMIT 1
-    ''', (pot_id,))
-    return None if result is None else PumpTask(pot_id, *result)
+# Tests whether the pot with the given id has a pump task that has not been
+# executed yet.
+#
+# Only the cached last task of the pot is tested. Older tasks that failed
+# while a newer task has been executed are not taken into account.
+def has_pending_task(pot_id):
+    last_task = get_last_task_of(pot_id)
+    return last_task is not None and last_task.executed_at is None
+
+
+# Replaces the cached last pump task of the pot of the given task if the given
+# task is not older than the cached one and notifies subscribers (see
+# `events`).
+def update_last_task(task):
+    last_task = get_last_task_of(task.pot_id)
+    if last_task is None or last_task.created_at <= task.created_at:
+        pot_states.update_pot_state(task.pot_id, last_pump_task=task)
+        events.publish('watered', task.pot_id, task)
+
+
+# Loads the last pump task of all known pots from the database into the cache.
+def load_last_tasks():
+    for pot_id, *task in persistance.fetchall('''
+        SELECT h.pot_id, h.amount, h.created_at, h.executed_at
+        FROM known_pots AS p
+        JOIN pump_history AS h
+          ON h.pot_id = p.id
+         AND h.created_at = ( SELECT MAX(created_at) FROM pump_history
+                              WHERE pot_id = p.id )
+    '''):
+        pot_states.update_pot_state(pot_id,
+                                    last_pump_task=PumpTask(pot_id, *task))
 
 
 # Gets all pump task of the pot with the given id that have not been executed
 # yet.
 def get_pending_tasks_of(pot_id):
-    tasks = persistance.fetchall('''
+    rows = persistance.fetchall(*pending_tasks_statement(pot_id))
+    return to_pending_tasks(pot_id, rows)
+
+
+# Awaitable counterpart of `get_pending_tasks_of`.
+async def aget_pending_tasks_of(pot_id):
+    rows = await persistance.afetchall(*pending_tasks_statement(pot_id))
+    return to_pending_tasks(pot_id, rows)
+
+
+# Gets the query and arguments that select the pending pump tasks of the pot
+# with the given id.
+def pending_tasks_statement(pot_id):
+    return '''
         SELECT amount, created_at FROM pump_history
         WHERE pot_id = ? AND executed_at IS NULL
         ORDER BY created_at ASC
-    ''', (pot_id,))
-    return [PumpTask(pot_id, amount, created_at) for amount, created_at in tasks]
+    ''', (pot_id,)
+
+
+# Converts the rows selected by `pending_tasks_statement` into pump tasks of
+# the pot with the given id.
+def to_pending_tasks(pot_id, rows):
+    return [PumpTask(pot_id, amount, created_at)
+            for amount, created_at in rows]
 
 
 # Adds a history entry for the given task.
 #
 # The `created_at` field of the pump task will be set to the current timestamp.
 def add_history_entry(task):
-    rowid = persistance.execute_insert('''
-        INSERT INTO pump_history ( pot_id, amount )
-        VALUES ( ?, ? )
-    ''', (task.pot_id, task.amount))
-    task.created_at = persistance.fetchone('''
-        SELECT created_at FROM pump_history WHERE rowid = ?
-    ''', (rowid,))[0]
+    persistance.execute(*history_entry_statement(task))
+    update_last_task(task)
+
+
+# Awaitable counterpart of `add_history_entry`.
+async def aadd_history_entry(task):
+    await persistance.aexecute(*history_entry_statement(task))
+    update_last_task(task)
+
+
+# Sets the `created_at` field of the given task to the current timestamp and
+# gets the query and arguments that add a history entry for the task.
+def history_entry_statement(task):
+    task.created_at = persistance.current_timestamp()
+    return '''
+        INSERT INTO pump_history ( pot_id, amount, created_at )
+        VALUES ( ?, ?, ? )
+    ''', (task.pot_id, task.amount, task.created_at)
 
 
 # Sets the execution date of the given task to the current timestamp.
 def set_task_execution_date(task):
-    persistance.execute('''
-        UPDATE pump_history SET executed_at = CURRENT_TIMESTAMP
-        WHERE pot_id = ? AND created_at = ?
-    ''', (task.pot_id, task.created_at))
-    fetch_task_execution_date(task)
+    persistance.execute(*task_execution_date_statement(task))
+    update_last_task(task)
+
+
+# Awaitable counterpart of `set_task_execution_date`.
+async def aset_task_execution_date(task):
+    await persistance.aexecute(*task_execution_date_statement(task))
+    update_last_task(task)
 
 
-# Fetches the timestamp when the given task has been executed.
-def fetch_task_execution_date(task):
-    task.executed_at = persistance.fetchone('''
-        SELECT executed_at FROM pump_history
+# Sets the `executed_at` field of the given task to the current timestamp and
+# gets the query and arguments that save it.
+def task_execution_date_statement(task):
+    task.executed_at = persistance.current_timestamp()
+    return '''
+        UPDATE pump_history SET executed_at = ?
         WHERE pot_id = ? AND created_at = ?
-    ''', (task.pot_id, task.created_at))[0]
+    ''', (task.executed_at, task.pot_id, task.created_at)
 
 
-# Tests whether the database contains a history entry for the given task
-# whose execution time has been set.
-def has_executed_task(task):
-    fetch_task_execution_date(task)
-    return task.executed_at is not None
+# Iterates over all history entries that have been created between the given
+# start and end timestamps (inclusive) in chunks (see
+# `persistance.fetch_chunks`).
+#
+# If a pot ID is given, only the history entries of that pot are returned.
+# Each chunk is a list of `(pot_id, created_at, amount, executed_at)` tuples
+# ordered by pot ID and creation time.
+def iter_history_chunks(start, end, pot_id=None):
+    min_pot_id, max_pot_id = ((pot_id, pot_id) if pot_id is not None
+                              else (-1, persistance.MAX_ROWID))
+    return persistance.fetch_chunks('''
+        SELECT pot_id, created_at, amount, executed_at
+        FROM pump_history
+        WHERE ( pot_id, created_at ) > ( ?, ? )
+          AND pot_id <= ? AND created_at BETWEEN ? AND ?
+        ORDER BY pot_id ASC, created_at ASC
+        LIMIT ?
+    ''', (min_pot_id, ''), (max_pot_id, start, end))
 
 
 # Removes all history entries from the database that are older than
 # `HISTORY_ENTRY_MAX_AGE` days.
 def remove_old_history_entries():
+    timestamp = persistance.timestamp_days_ago(HISTORY_ENTRY_MAX_AGE)
     persistance.execute('''
-        DELETE FROM pump_history WHERE created_at < datetime('now', ?)
-    ''', (f'-{HISTORY_ENTRY_MAX_AGE} days',))
+        DELETE FROM pump_history WHERE created_at < ?
+    ''', (timestamp,))
+    pot_states.expire_pot_states('last_pump_task',
+                                 lambda task: task.created_at, timestamp)
+
+
+load_last_tasks()
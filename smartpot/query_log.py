@@ -0,0 +1,253 @@
+# This module records the SQL statements that are executed by the database
+# threads (see `persistance`) to find out which statement stalls the hub.
+#
+# For every task of a database thread, the call site that enqueued the task,
+# the time the task waited in the queue and the time it took to execute are
+# recorded together with the SQL text, duration and number of touched rows of
+# every statement that the task executed. Statements that take longer than
+# `SLOW_QUERY_THRESHOLD_MS` milliseconds are added to a slow query log with
+# their query plan. The slow query log only keeps the latest
+# `SLOW_QUERY_LOG_SIZE` entries.
+#
+# Statements are only recorded if the `SMART_POT_QUERY_LOG` environment
+# variable is set to `1`. The log and a summary of all statements can be
+# inspected via `GET /api/debug/queries` (see `rest_api`).
+
+import collections
+import datetime
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+# Whether statements are recorded.
+ENABLED = os.environ.get('SMART_POT_QUERY_LOG', '0') == '1'
+
+# The minimum duration in milliseconds of a statement in the slow query log.
+SLOW_QUERY_THRESHOLD_MS = float(
+    os.environ.get('SMART_POT_SLOW_QUERY_MS', '100'))
+
+# The maximum number of entries of the slow query log.
+SLOW_QUERY_LOG_SIZE = 100
+
+# The number of the latest durations per statement that percentiles are
+# computed from.
+STATEMENT_SAMPLE_SIZE = 1000
+
+# The names of the modules whose functions are skipped when the call site of a
+# task is determined.
+INTERNAL_MODULES = {__name__, 'smartpot.persistance'}
+
+
+# A statement that has been executed by a task.
+#
+# The `args` are the arguments of the statement or the arguments of the first
+# row if the statement has been executed with `executemany`.
+class Statement:
+    def __init__(self, sql, args):
+        self.sql = sql
+        self.args = args
+        self.duration = 0.0
+        self.rows = 0
+
+
+# A cursor that records all statements that are executed with it.
+#
+# Rows that are fetched and the time it takes to fetch them are attributed to
+# the last executed statement. All other attributes are delegated to the
+# wrapped `sqlite3.Cursor`.
+class TracingCursor:
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self.statements = []
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        while True:
+            row = self.fetchone()
+            if row is None:
+                return
+            yield row
+
+    def execute(self, sql, args=()):
+        statement = Statement(sql, args)
+        self.statements.append(statement)
+        start_time = time.perf_counter()
+        try:
+            self._cursor.execute(sql, args)
+        finally:
+            self._finish(statement, start_time)
+        return self
+
+    def executemany(self, sql, rows):
+        rows = list(rows)
+        statement = Statement(sql, rows[0] if rows else ())
+        self.statements.append(statement)
+        start_time = time.perf_counter()
+        try:
+            self._cursor.executemany(sql, rows)
+        finally:
+            self._finish(statement, start_time)
+        return self
+
+    def fetchone(self):
+        return self._fetch(lambda: self._cursor.fetchone())
+
+    def fetchmany(self, size=None):
+        size = self._cursor.arraysize if size is None else size
+        return self._fetch(lambda: self._cursor.fetchmany(size))
+
+    def fetchall(self):
+        return self._fetch(lambda: self._cursor.fetchall())
+
+    # Records the duration and the number of rows changed by the given
+    # statement.
+    def _finish(self, statement, start_time):
+        statement.duration += time.perf_counter() - start_time
+        statement.rows += max(0, self._cursor.rowcount)
+
+    # Fetches rows with the given function and attributes them to the last
+    # executed statement.
+    def _fetch(self, fetch):
+        start_time = time.perf_counter()
+        result = fetch()
+        if self.statements:
+            statement = self.statements[-1]
+            statement.duration += time.perf_counter() - start_time
+            if isinstance(result, list):
+                statement.rows += len(result)
+            elif result is not None:
+                statement.rows += 1
+        return result
+
+
+# Aggregated durations and rows of all executions of a statement.
+class StatementSummary:
+    def __init__(self):
+        self.count = 0
+        self.total_duration = 0.0
+        self.max_duration = 0.0
+        self.rows = 0
+        self.durations = collections.deque(maxlen=STATEMENT_SAMPLE_SIZE)
+
+    def add(self, statement):
+        self.count += 1
+        self.total_duration += statement.duration
+        self.max_duration = max(self.max_duration, statement.duration)
+        self.rows += statement.rows
+        self.durations.append(statement.duration)
+
+
+# The latest slow statements.
+slow_queries = collections.deque(maxlen=SLOW_QUERY_LOG_SIZE)
+
+# Dictionary that maps normalized SQL texts to the summary of the statement.
+statement_summaries = {}
+
+# Lock that serializes access to `slow_queries` and `statement_summaries`.
+lock = threading.Lock()
+
+
+# Gets the module, function and line of the code that called into
+# `persistance` (or of the module-level code of `persistance` itself).
+#
+# Must be called in the thread that enqueues the task.
+def get_call_site():
+    frame = sys._getframe(1)
+    while (frame.f_back is not None
+           and frame.f_globals.get('__name__') in INTERNAL_MODULES
+           and frame.f_code.co_name != '<module>'):
+        frame = frame.f_back
+    module = frame.f_globals.get('__name__')
+    return f'{module}.{frame.f_code.co_name}:{frame.f_lineno}'
+
+
+# Collapses the whitespace of the given SQL text such that all executions of a
+# statement are summarized together.
+def normalize_sql(sql):
+    return re.sub(r'\s+', ' ', sql).strip()
+
+
+# Gets the query plan of the given statement as a list of the details of its
+# steps or `None` if the statement cannot be explained (e.g., because a table
+# it used has been dropped in the meantime).
+#
+# Must be called by the database thread that executed the statement.
+def explain(connection, statement):
+    try:
+        rows = connection.execute(f'EXPLAIN QUERY PLAN {statement.sql}',
+                                  statement.args).fetchall()
+        return [row[-1] for row in rows]
+    except sqlite3.Error:
+        return None
+
+
+# Records the statements that have been executed with the given
+# `TracingCursor` by a task that has been enqueued at the given call site,
+# waited the given number of seconds and executed for the given number of
+# seconds.
+#
+# Must be called by the database thread that executed the statements.
+def record(cursor, call_site, wait, duration):
+    if not cursor.statements:
+        return
+    slow_statements = [statement for statement in cursor.statements
+                       if statement.duration * 1000 >= SLOW_QUERY_THRESHOLD_MS]
+    plans = [explain(cursor.connection, statement)
+             for statement in slow_statements]
+    timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    with lock:
+        for statement in cursor.statements:
+            sql = normalize_sql(statement.sql)
+            summary = statement_summaries.setdefault(sql, StatementSummary())
+            summary.add(statement)
+        for statement, plan in zip(slow_statements, plans):
+            slow_queries.append({
+                'timestamp': timestamp,
+                'call-site': call_site,
+                'sql': normalize_sql(statement.sql),
+                'wait-ms': wait * 1000,
+                'task-ms': duration * 1000,
+                'duration-ms': statement.duration * 1000,
+                'rows': statement.rows,
+                'plan': plan,
+            })
+
+
+# Gets the given percentile of a sorted list of samples.
+def percentile(samples, p):
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+# Gets the entries of the slow query log from the oldest to the latest.
+def get_slow_queries():
+    with lock:
+        return list(slow_queries)
+
+
+# Gets a summary of all recorded statements ordered by their total duration.
+#
+# Percentiles are computed from the latest `STATEMENT_SAMPLE_SIZE` executions
+# of every statement.
+def get_statement_summaries():
+    with lock:
+        summaries = [(sql, summary.count, summary.total_duration,
+                      summary.max_duration, summary.rows,
+                      sorted(summary.durations))
+                     for sql, summary in statement_summaries.items()]
+    summaries.sort(key=lambda summary: summary[2], reverse=True)
+    return [{
+        'sql': sql,
+        'count': count,
+        'rows': rows,
+        'total-ms': total_duration * 1000,
+        'max-ms': max_duration * 1000,
+        'p50-ms': percentile(durations, 50) * 1000,
+        'p95-ms': percentile(durations, 95) * 1000,
+        'p99-ms': percentile(durations, 99) * 1000,
+    } for sql, count, total_duration, max_duration, rows, durations
+        in summaries]
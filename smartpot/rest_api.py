@@ -1,17 +1,125 @@
 # This module contains the REST API that is used by the Android app to interact
 # with the Smart Pot Hub.
+#
+# Routes that access the database or the connected pots are coroutines. They
+# run in the event loop of the connection thread (see `set_event_loop`) such
+# that they can await database queries and Bluetooth operations. Routes that
+# are served from the caches are plain functions.
+#
+# The REST API is served either by Flask's development server or by an ASGI
+# server in the event loop of the connection thread (see `asgi`). The server
+# is selected by the `SMART_POT_REST_SERVER` environment variable (`flask` or
+# `asgi`).
 
-from flask import Flask, abort, request
+from flask import Flask, Response, abort, g, request
 from flask_json import FlaskJSON, as_json
 
+import asyncio
+import concurrent.futures
+import contextvars
+import csv
+import datetime
+import functools
+import inspect
+import io
+import json as json_lib
+import os
+import secrets
 import smartpot.available_pots as available_pots
 import smartpot.known_pots as known_pots
 import smartpot.pump_tasks as pump_tasks
+import smartpot.pump_dispatcher as pump_dispatcher
 import smartpot.measurements as measurements
 import smartpot.connected_pots as connected_pots
+import smartpot.events as events
+import smartpot.metrics as metrics
+import smartpot.persistance as persistance
+import smartpot.pot_states as pot_states
+import smartpot.query_log as query_log
+import threading
+import time
+
+# The server that serves the REST API (`flask` or `asgi`).
+REST_SERVER = os.environ.get('SMART_POT_REST_SERVER', 'flask')
+
+# The event loop in which coroutine routes are run or `None` if no event loop
+# has been set or started yet.
+event_loop = None
+
+# Lock that ensures that only one event loop is started by `get_event_loop`.
+event_loop_lock = threading.Lock()
+
+
+# A Flask application that runs coroutine routes in the `event_loop`.
+#
+# Flask would otherwise run every coroutine in a new event loop, where the
+# connected pots cannot be accessed.
+class Api(Flask):
+    def ensure_sync(self, func):
+        if not inspect.iscoroutinefunction(func):
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return run_in_event_loop(func(*args, **kwargs))
+        return wrapper
+
+
+# Sets the event loop in which coroutine routes are run.
+def set_event_loop(loop):
+    global event_loop
+    event_loop = loop
+
+
+# Gets the event loop in which coroutine routes are run.
+#
+# If no event loop has been set, a new event loop is started in a background
+# thread (e.g., when the REST API is used without the connection thread).
+def get_event_loop():
+    global event_loop
+    with event_loop_lock:
+        if event_loop is None:
+            event_loop = asyncio.new_event_loop()
+            threading.Thread(target=event_loop.run_forever,
+                             daemon=True).start()
+    return event_loop
+
+
+# Runs the given coroutine in the `event_loop` and blocks until it completes.
+#
+# The coroutine runs in a copy of the current context such that it can access
+# the current request.
+def run_in_event_loop(coro):
+    context = contextvars.copy_context()
+    future = concurrent.futures.Future()
+
+    def on_done(task):
+        if task.cancelled():
+            future.cancel()
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+
+    def start():
+        task = context.run(asyncio.ensure_future, coro)
+        task.add_done_callback(on_done)
+
+    get_event_loop().call_soon_threadsafe(start)
+    return future.result()
+
+
+# Like `flask_json.as_json` but for routes that are coroutines.
+def as_json_async(route):
+    @functools.wraps(route)
+    async def wrapper(*args, **kwargs):
+        result = await route(*args, **kwargs)
+        return as_json(lambda: result)()
+    return wrapper
+
 
 # Initialize Flask application.
-api = Flask('smart-pot-api')
+api = Api('smart-pot-api')
 json = FlaskJSON(api)
 
 # Configure Flask JSON.
@@ -20,6 +128,63 @@ api.config['JSON_ADD_STATUS'] = False
 # Create an HTTP response for routes without content.
 no_content_response = ('', 204)
 
+# The latency of requests per route (see `metrics`).
+request_latency_seconds = metrics.Histogram(
+    'smartpot_rest_request_seconds',
+    'Time until the response of a REST API request is ready.',
+    ['method', 'route'])
+
+
+# Records the start time of a request such that its latency can be recorded
+# when the response is ready.
+#
+# The hooks are only registered if metrics are enabled.
+def start_request_timer():
+    g.request_start_time = time.perf_counter()
+
+
+# Records the latency of the current request.
+def record_request_latency(response):
+    start_time = g.get('request_start_time')
+    if start_time is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        request_latency_seconds.observe(time.perf_counter() - start_time,
+                                        request.method, route)
+    return response
+
+
+if metrics.ENABLED:
+    api.before_request(start_request_timer)
+    api.after_request(record_request_latency)
+
+# A random prefix of all ETags. The version counters that ETags are derived
+# from start at zero whenever the hub starts. The prefix ensures that ETags
+# from before a restart never match.
+ETAG_PREFIX = secrets.token_hex(4)
+
+
+# Creates an ETag that is derived from the given version counters.
+def make_etag(*versions):
+    return '-'.join([ETAG_PREFIX, *map(str, versions)])
+
+
+# Creates a JSON response with status code 304 if the `If-None-Match` header
+# of the request matches the given ETag. Otherwise, returns `None`.
+#
+# Routes call this function before they build their response such that
+# unchanged responses are neither computed nor serialized again.
+def not_modified_response(etag):
+    if not request.if_none_match.contains(etag):
+        return None
+    response = Response(status=304, mimetype=api.json.mimetype)
+    response.set_etag(etag)
+    return response
+
+
+# Adds the given ETag to the given JSON response content.
+def with_etag(content, etag):
+    return content, {'ETag': f'"{etag}"'}
+
 
 # Gets the IDs and display names of all known pots.
 #
@@ -29,13 +194,17 @@ no_content_response = ('', 204)
 #       "id": string,
 #       "name": string,
 #     }
+#
+# Supports conditional requests via `If-None-Match`. The ETag changes whenever
+# a pot is added, renamed or removed.
 @api.route('/api/pots')
 @as_json
 def get_pots():
-    return [{
+    etag = make_etag(known_pots.get_known_pots_version())
+    return not_modified_response(etag) or with_etag([{
         'id': id,
         'name': name
-    } for id, name in known_pots.get_known_pot_names().items()]
+    } for id, name in known_pots.get_known_pot_names().items()], etag)
 
 
 # Gets the address and signal strength of all visible pots that are unknown.
@@ -50,9 +219,9 @@ def get_pots():
 @as_json
 def get_available_pots():
     return [{
-        'addr': device.address,
-        'rssi': device.rssi,
-    } for device in available_pots.get_available_pots()]
+        'addr': pot.device.address,
+        'rssi': pot.rssi,
+    } for pot in available_pots.get_available_pots()]
 
 
 # Adds an available pot to the list of known pots.
@@ -71,8 +240,8 @@ def get_available_pots():
 #       "id": string
 #     }
 @api.route('/api/pots', methods=['POST'])
-@as_json
-def add_pot():
+@as_json_async
+async def add_pot():
     # Check that all required fields are passed in the request body.
     if (not isinstance(request.json, dict)
             or 'addr' not in request.json
@@ -88,7 +257,7 @@ def add_pot():
         abort(400)
 
     # Add pot to database
-    id = known_pots.add_known_pot(addr, name)
+    id = await known_pots.aadd_known_pot(addr, name)
     return {
         "id": id
     }
@@ -114,31 +283,387 @@ def add_pot():
 #     }
 #
 # If there is no `measurement` yet, the corresponding field is set to `null`.
+#
+# The state of the pot is served from the cache (see `pot_states`) without
+# querying the database. Supports conditional requests via `If-None-Match`.
+# The ETag changes whenever the pot records a measurement, a pump task of the
+# pot is created or executed, the pot is renamed or connects or disconnects.
 @api.route('/api/pot/<int:id>', methods=['GET'])
 @as_json
 def get_pot(id):
+    if not known_pots.is_pot_known_id(id):
+        abort(404)
+    etag = make_etag(pot_states.get_pot_state(id).version)
+    return not_modified_response(etag) or with_etag(get_pot_status(id), etag)
 
-    addr = known_pots.lookup_known_pot_addr(id)
-    measurement = measurements.get_last_measurement(id)
-    last_pump_task = pump_tasks.get_last_task_of(id)
 
+# Gets the status of all known pots or of the known pots with the given IDs.
+#
+# Supports the following optional query parameter.
+#
+#  - `ids`: A comma separated list of the IDs of the pots whose status to get.
+#    Unknown IDs are ignored. Defaults to all known pots.
+#
+# Returns a JSON array of objects with the fields of `GET /api/pot/<id>` and
+# the ID of the pot.
+#
+#     {
+#       "id": number,
+#       "online": boolean,
+#       "measurement": { ... },
+#       "watered": { ... }
+#     }
+#
+# Like `GET /api/pot/<id>`, the states are served from the cache such that
+# the status of all pots is returned without querying the database. Supports
+# conditional requests via `If-None-Match`. The ETag changes whenever the
+# status of any pot changes or a pot is added or removed.
+@api.route('/api/pots/status', methods=['GET'])
+@as_json
+def get_pots_status():
+    etag = make_etag(known_pots.get_known_pots_version(),
+                     pot_states.get_version())
+    not_modified = not_modified_response(etag)
+    if not_modified is not None:
+        return not_modified
+
+    ids = list(known_pots.get_known_pot_names())
+    if 'ids' in request.args:
+        try:
+            requested_ids = {int(id) for id in request.args['ids'].split(',')}
+        except ValueError:
+            abort(400)
+        ids = [id for id in ids if id in requested_ids]
+
+    statuses = []
+    for id in ids:
+        status = get_pot_status(id)
+        if status is not None:
+            statuses.append({'id': id, **status})
+    return with_etag(statuses, etag)
+
+
+# Gets the status of the known pot with the given ID as returned by
+# `GET /api/pot/<id>` or `None` if the pot is not known.
+def get_pot_status(id):
+    if not known_pots.is_pot_known_id(id):
+        return None
+    addr = known_pots.lookup_known_pot_addr(id)
+    state = pot_states.get_pot_state(id)
     return {
         'online': connected_pots.is_connected(addr),
-        'measurement': None if measurement is None else {
-            'soil-moisture': measurement.soil_moisture,
-            'water-level': measurement.water_level,
-            'timestamp': measurement.timestamp,
-        },
-        'watered': None if last_pump_task is None else {
-            'amount': last_pump_task.amount,
-            'timestamp': next(timestamp for timestamp in [
-                last_pump_task.executed_at, last_pump_task.created_at
-            ] if timestamp is not None),
-            'completed': last_pump_task.executed_at is not None,
-        }
+        'measurement': encode_measurement(state.measurement),
+        'watered': encode_pump_task(state.last_pump_task),
+    }
+
+
+# Encodes the given measurement like the `measurement` field of
+# `GET /api/pot/<id>`.
+def encode_measurement(measurement):
+    if measurement is None:
+        return None
+    return {
+        'soil-moisture': measurement.soil_moisture,
+        'water-level': measurement.water_level,
+        'timestamp': measurement.timestamp,
+    }
+
+
+# Encodes the given pump task like the `watered` field of `GET /api/pot/<id>`.
+def encode_pump_task(task):
+    if task is None:
+        return None
+    return {
+        'amount': task.amount,
+        'timestamp': next(timestamp for timestamp in [
+            task.executed_at, task.created_at
+        ] if timestamp is not None),
+        'completed': task.executed_at is not None,
     }
 
 
+# Dictionary that maps the types of events (see `events`) to a function that
+# encodes the value of the event like the corresponding field of
+# `GET /api/pot/<id>`.
+event_encoders = {
+    'measurement': encode_measurement,
+    'watered': encode_pump_task,
+    'online': bool,
+}
+
+# The time in seconds after which a comment is sent to subscribers of
+# `GET /api/events` if there were no events such that idle connections are
+# not closed by proxies.
+EVENT_STREAM_KEEP_ALIVE = 15.0
+
+
+# Subscribes to changes of the state of all known pots or of the known pots
+# with the given IDs.
+#
+# Supports the following optional query parameter.
+#
+#  - `ids`: A comma separated list of the IDs of the pots whose changes to
+#    subscribe to. Defaults to all pots.
+#
+# Returns a stream of Server-Sent Events. The name of an event is the changed
+# field of `GET /api/pot/<id>` (`measurement`, `watered` or `online`). The
+# data of an event is a JSON object with the ID of the pot and the new value
+# of the field, e.g.,
+#
+#     event: measurement
+#     data: {"id": 1, "measurement": {"soil-moisture": 512, ...}}
+#
+# Changes are coalesced if the client does not keep up such that the client
+# only receives the latest value of every field. If the client still missed
+# changes, a `resync` event is sent and the client should get the status of
+# all pots again (see `GET /api/pots/status`).
+#
+# Responds with status code 503 if there are too many subscribers.
+@api.route('/api/events', methods=['GET'])
+def get_events():
+    pot_ids = None
+    if 'ids' in request.args:
+        try:
+            pot_ids = {int(id) for id in request.args['ids'].split(',')}
+        except ValueError:
+            abort(400)
+    subscription = events.subscribe(pot_ids)
+    if subscription is None:
+        abort(503)
+    return Response(EventStream(subscription), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
+
+# An infinite stream of Server-Sent Events for the given subscription.
+#
+# The stream can be iterated both synchronously (by Flask's development
+# server) and asynchronously (by the ASGI server, see `asgi`). The stream
+# starts with a comment such that the response headers are sent immediately.
+# The subscription is cancelled when the stream is closed.
+class EventStream:
+    def __init__(self, subscription):
+        self.subscription = subscription
+
+    def __iter__(self):
+        yield ': subscribed\n\n'
+        while True:
+            yield encode_events(
+                *self.subscription.get(EVENT_STREAM_KEEP_ALIVE))
+
+    async def __aiter__(self):
+        yield ': subscribed\n\n'
+        while True:
+            yield encode_events(
+                *await self.subscription.aget(EVENT_STREAM_KEEP_ALIVE))
+
+    def close(self):
+        events.unsubscribe(self.subscription)
+
+
+# Encodes the given events as Server-Sent Events. A `resync` event is
+# prepended if events have been dropped. If there are no events, a comment is
+# returned.
+def encode_events(pending_events, dropped):
+    chunks = ['event: resync\ndata: {}\n\n'] if dropped else []
+    for event in pending_events:
+        data = json_lib.dumps({
+            'id': event.pot_id,
+            event.type: event_encoders[event.type](event.value),
+        })
+        chunks.append(f'event: {event.type}\ndata: {data}\n\n')
+    return ''.join(chunks) or ': keep-alive\n\n'
+
+
+# Gets the history of measurements of the known pot with the given ID.
+#
+# Supports the following optional query parameters.
+#
+#  - `from`: An ISO 8601 timestamp of the start of the range. Defaults to one
+#    day before the end of the range.
+#  - `to`: An ISO 8601 timestamp of the end of the range. Defaults to now.
+#  - `resolution`: One of `raw`, `minute`, `hour` or `day`. Defaults to
+#    `minute`. A coarser resolution is used if the range is too long.
+#
+# Returns a JSON object with the following fields.
+#
+#     {
+#       "resolution": string,
+#       "measurements": [
+#         {
+#           "timestamp": timestamp,
+#           "count": number,
+#           "soil-moisture": {
+#             "min": number,
+#             "max": number,
+#             "avg": number
+#           },
+#           "water-level": {
+#             "min": number,
+#             "max": number,
+#             "avg": number
+#           }
+#         }
+#       ]
+#     }
+#
+# The timestamp of an entry is the start of the time span it aggregates. The
+# aggregates of the `minute`, `hour` and `day` resolutions cover every reading
+# of the pot, whereas the `raw` resolution only returns the readings that
+# have been saved (see `measurements.should_save_reading`). The `count` of a
+# raw entry is always one.
+@api.route('/api/pot/<int:id>/measurements', methods=['GET'])
+@as_json_async
+async def get_pot_measurements(id):
+    if not known_pots.is_pot_known_id(id):
+        abort(404)
+
+    # Extract and check query parameters.
+    end = parse_timestamp_arg('to', persistance.utc_now())
+    start = parse_timestamp_arg('from', end - datetime.timedelta(days=1))
+    resolution = request.args.get('resolution', 'minute')
+    if resolution not in measurements.RESOLUTIONS or start > end:
+        abort(400)
+
+    resolution, history = await measurements.aget_measurement_history(
+        id,
+        persistance.format_timestamp(start),
+        persistance.format_timestamp(end),
+        resolution)
+
+    return {
+        'resolution': resolution,
+        'measurements': [{
+            'timestamp': summary.timestamp,
+            'count': summary.count,
+            'soil-moisture': {
+                'min': summary.min_soil_moisture,
+                'max': summary.max_soil_moisture,
+                'avg': summary.avg_soil_moisture,
+            },
+            'water-level': {
+                'min': summary.min_water_level,
+                'max': summary.max_water_level,
+                'avg': summary.avg_water_level,
+            },
+        } for summary in history]
+    }
+
+
+# Parses the query parameter with the given name as an ISO 8601 timestamp and
+# converts it to a naive `datetime` in UTC.
+#
+# Returns the given default value if the parameter is missing and aborts with
+# status code 400 if the parameter is invalid.
+def parse_timestamp_arg(name, default):
+    if name not in request.args:
+        return default
+    try:
+        value = datetime.datetime.fromisoformat(request.args[name])
+    except ValueError:
+        abort(400)
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return value
+
+
+# Dictionary that maps the names of the tables that can be exported to a
+# function that iterates over chunks of rows of the table and the names of the
+# columns of the rows.
+exportable_tables = {
+    'measurements': (
+        measurements.iter_measurement_chunks,
+        ['pot-id', 'timestamp', 'soil-moisture', 'water-level'],
+    ),
+    'pump-history': (
+        pump_tasks.iter_history_chunks,
+        ['pot-id', 'created-at', 'amount', 'executed-at'],
+    ),
+}
+
+
+# Exports the raw rows of the `measurements` or `pump-history` table.
+#
+# Supports the following optional query parameters.
+#
+#  - `pot`: The ID of the pot whose rows to export. Defaults to all pots.
+#  - `from`: An ISO 8601 timestamp of the start of the range. Defaults to the
+#    oldest row.
+#  - `to`: An ISO 8601 timestamp of the end of the range. Defaults to now.
+#  - `format`: Either `ndjson` or `csv`. Defaults to `ndjson`.
+#
+# In NDJSON format every line contains a JSON object with the following
+# fields for the `measurements` table
+#
+#     {
+#       "pot-id": number,
+#       "timestamp": timestamp,
+#       "soil-moisture": number,
+#       "water-level": number
+#     }
+#
+# and with the following fields for the `pump-history` table.
+#
+#     {
+#       "pot-id": number,
+#       "created-at": timestamp,
+#       "amount": number,
+#       "executed-at": timestamp
+#     }
+#
+# In CSV format the first line contains the names of the fields.
+#
+# The response is streamed. The rows are fetched in chunks such that the
+# memory usage does not depend on the number of exported rows.
+@api.route('/api/export/<table>', methods=['GET'])
+def export_table(table):
+    if table not in exportable_tables:
+        abort(404)
+    iter_chunks, columns = exportable_tables[table]
+
+    # Extract and check query parameters.
+    end = parse_timestamp_arg('to', persistance.utc_now())
+    start = parse_timestamp_arg('from', datetime.datetime(1970, 1, 1))
+    format = request.args.get('format', 'ndjson')
+    if format not in ['ndjson', 'csv'] or start > end:
+        abort(400)
+    pot_id = request.args.get('pot', type=int)
+    if 'pot' in request.args and pot_id is None:
+        abort(400)
+
+    chunks = iter_chunks(persistance.format_timestamp(start),
+                         persistance.format_timestamp(end),
+                         pot_id)
+    if format == 'csv':
+        body, mimetype = encode_csv(columns, chunks), 'text/csv'
+    else:
+        body, mimetype = encode_ndjson(columns, chunks), 'application/x-ndjson'
+    return Response(body, mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename={table}.{format}'
+    })
+
+
+# Encodes chunks of rows with the given column names as NDJSON. Yields one
+# string per chunk.
+def encode_ndjson(columns, chunks):
+    for rows in chunks:
+        yield ''.join(json_lib.dumps(dict(zip(columns, row))) + '\n'
+                      for row in rows)
+
+
+# Encodes chunks of rows with the given column names as CSV. Yields the header
+# and one string per chunk.
+def encode_csv(columns, chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    yield buffer.getvalue()
+    for rows in chunks:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(rows)
+        yield buffer.getvalue()
+
+
 # Renames the known pot with the given ID.
 #
 # Expects the request body to contain the new name of the pot as a JSON
@@ -150,7 +675,7 @@ def get_pot(id):
 #
 # Returns an HTTP response without content.
 @api.route('/api/pot/<int:id>', methods=['PUT'])
-def rename_pot(id):
+async def rename_pot(id):
     # Check that all required fields are passed in the request body.
     if not isinstance(request.json, dict) or 'name' not in request.json:
         abort(400)
@@ -162,7 +687,7 @@ def rename_pot(id):
     if not isinstance(name, str):
         abort(400)
 
-    known_pots.rename_known_pot(id, name)
+    await known_pots.arename_known_pot(id, name)
     return no_content_response
 
 
@@ -177,8 +702,8 @@ def rename_pot(id):
 #
 # Returns an HTTP response without content.
 @api.route('/api/pot/<int:id>/water', methods=['POST'])
-@as_json
-def water_pot(id):
+@as_json_async
+async def water_pot(id):
     # Check that all required fields are passed in the request body.
     if not isinstance(request.json, dict) or 'amount' not in request.json:
         abort(400)
@@ -196,7 +721,7 @@ def water_pot(id):
         abort(409)
 
     # Water the pot with the given ID.
-    pump_tasks.enqueue_new_pump_task(id, amount)
+    pump_dispatcher.dispatch(await pump_tasks.acreate_pump_task(id, amount))
 
     return no_content_response
 
@@ -207,18 +732,74 @@ def water_pot(id):
 #
 # Returns an HTTP response without content.
 @api.route('/api/pot/<int:id>', methods=['DELETE'])
-@as_json
-def remove_pot(id):
+@as_json_async
+async def remove_pot(id):
     addr = known_pots.lookup_known_pot_addr(id)
-    known_pots.remove_known_pot(id)
-    connected_pots.disconnect(addr)
+    await known_pots.aremove_known_pot(id)
+    await connected_pots.disconnect(addr)
     return no_content_response
 
 
-# Runs the REST API and passes the given arguments to Flask.
-def run(*args, **kw_args):
+# Gets the metrics of the hub in the Prometheus text format (see `metrics`).
+#
+# Responds with status code 404 if metrics are disabled.
+@api.route('/metrics', methods=['GET'])
+def get_metrics():
+    if not metrics.ENABLED:
+        abort(404)
+    return Response(metrics.render(),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+# Gets the slow query log and a summary of all statements that have been
+# executed by the database threads (see `query_log`).
+#
+# Returns a JSON object with the following fields.
+#
+#     {
+#       "slow-queries": [{
+#         "timestamp": string,
+#         "call-site": string,
+#         "sql": string,
+#         "wait-ms": number,
+#         "task-ms": number,
+#         "duration-ms": number,
+#         "rows": number,
+#         "plan": [string] | null
+#       }],
+#       "statements": [{
+#         "sql": string,
+#         "count": number,
+#         "rows": number,
+#         "total-ms": number,
+#         "max-ms": number,
+#         "p50-ms": number,
+#         "p95-ms": number,
+#         "p99-ms": number
+#       }]
+#     }
+#
+# Responds with status code 404 if the query log is disabled.
+@api.route('/api/debug/queries', methods=['GET'])
+@as_json
+def get_query_log():
+    if not query_log.ENABLED:
+        abort(404)
+    return {
+        'slow-queries': query_log.get_slow_queries(),
+        'statements': query_log.get_statement_summaries(),
+    }
+
+
+# Runs the REST API on the given host and port with the server selected by
+# `REST_SERVER`. Other arguments are passed to Flask's development server.
+def run(host='127.0.0.1', port=5000, **kw_args):
     print('starting API...')
-    api.run(*args, **kw_args)
+    if REST_SERVER == 'asgi':
+        import smartpot.asgi as asgi
+        asgi.run(get_event_loop(), host, port)
+    else:
+        api.run(host, port, **kw_args)
 
 
 # When the script is invoked directly, start the REST API in debug mode.
@@ -0,0 +1,31 @@
+# This module selects the transport that is used to communicate with the Smart
+# Pots.
+#
+# By default, Smart Pots are accessed via Bluetooth Low Energy using `bleak`.
+# To load test the hub without real devices, the simulated fleet of
+# `smartpot.debug.simulated_transport` can be used instead by setting the
+# `SMART_POT_TRANSPORT` environment variable to `simulated`.
+#
+# Every transport provides a `Scanner`, `Client` and `TransportError` that
+# behave like `bleak.BleakScanner`, `bleak.BleakClient` and
+# `bleak.exc.BleakError`, respectively. Only the selected transport is
+# imported.
+
+import os
+
+# The names that are provided by every transport.
+__all__ = ['Scanner', 'Client', 'TransportError']
+
+# The name of the selected transport (`bleak` or `simulated`).
+TRANSPORT = os.environ.get('SMART_POT_TRANSPORT', 'bleak')
+
+if TRANSPORT == 'bleak':
+    from bleak import BleakClient as Client
+    from bleak import BleakScanner as Scanner
+    from bleak.exc import BleakError as TransportError
+elif TRANSPORT == 'simulated':
+    from smartpot.debug.simulated_transport import Client
+    from smartpot.debug.simulated_transport import Scanner
+    from smartpot.debug.simulated_transport import TransportError
+else:
+    raise ValueError(f'Unknown transport: {TRANSPORT}')
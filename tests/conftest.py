@@ -0,0 +1,19 @@
+# Configures the hub for tests.
+#
+# The database is created in a temporary directory when `persistance` is
+# imported. Its threads are shut down after all tests such that the test run
+# terminates.
+
+import os
+import sys
+import tempfile
+
+os.environ['SMART_POT_DB'] = os.path.join(tempfile.mkdtemp(), 'smart-pot.db')
+
+
+def pytest_sessionfinish(session, exitstatus):
+    persistance = sys.modules.get('smartpot.persistance')
+    if persistance is not None:
+        persistance.worker.shutdown()
+        if persistance.readers is not persistance.worker:
+            persistance.readers.shutdown()
@@ -0,0 +1,87 @@
+# Tests the decoding of the measurements characteristic (see
+# `characteristics.decode_measurements` and
+# `characteristics.read_measurements`).
+
+import asyncio
+import pytest
+import smartpot.characteristics as characteristics
+import struct
+
+
+# Encodes a versioned frame with the given samples and interval.
+def encode_frame(samples, interval, version=characteristics.FRAME_VERSION,
+                 count=None):
+    values = [value for sample in samples for value in sample]
+    return struct.pack(f'<BBBH{len(values)}H', characteristics.FRAME_MARKER,
+                       version, len(samples) if count is None else count,
+                       interval, *values)
+
+
+def test_legacy_frame():
+    frame = struct.pack('<HH', 512, 1023)
+    assert characteristics.decode_measurements(frame) == ([(512, 1023)], 0)
+
+
+def test_versioned_frame():
+    samples = [(1, 2), (3, 4), (5, 6)]
+    frame = encode_frame(samples, 30)
+    assert characteristics.decode_measurements(frame) == (samples, 30)
+
+
+def test_versioned_frame_with_single_sample():
+    frame = encode_frame([(7, 8)], 0)
+    assert characteristics.decode_measurements(frame) == ([(7, 8)], 0)
+
+
+def test_empty_frame():
+    frame = encode_frame([], 5)
+    assert len(frame) != characteristics.SAMPLE_FORMAT.size
+    assert characteristics.decode_measurements(frame) == ([], 5)
+
+
+@pytest.mark.parametrize('frame', [
+    b'',
+    b'\x01',
+    encode_frame([(1, 2)], 5)[:-1],
+    encode_frame([(1, 2)], 5) + b'\x00',
+    encode_frame([(1, 2)], 5, count=2),
+])
+def test_truncated_frame(frame):
+    with pytest.raises(ValueError):
+        characteristics.decode_measurements(frame)
+
+
+def test_unsupported_version():
+    version = characteristics.FRAME_VERSION + 1
+    frame = encode_frame([(1, 2)], 5, version=version)
+    with pytest.raises(ValueError):
+        characteristics.decode_measurements(frame)
+
+
+def test_invalid_marker():
+    frame = bytearray(encode_frame([(1, 2)], 5))
+    frame[0] = 0x01
+    with pytest.raises(ValueError):
+        characteristics.decode_measurements(bytes(frame))
+
+
+# A client whose measurements characteristic has the given value.
+class FakeClient:
+    def __init__(self, value):
+        self.value = value
+
+    async def read_gatt_char(self, uuid):
+        assert uuid == characteristics.MEASUREMENTS_UUID
+        return self.value
+
+
+def test_read_latest_sample():
+    client = FakeClient(encode_frame([(1, 2), (3, 4)], 5))
+    result = asyncio.run(characteristics.read_measurements(client))
+    assert result == (3, 4)
+
+
+def test_read_empty_frame():
+    client = FakeClient(encode_frame([], 5))
+    with pytest.raises(ValueError):
+        asyncio.run(characteristics.read_measurements(client))
@@ -0,0 +1,78 @@
+# Tests saving measurements (see `measurements`).
+
+import pytest
+import smartpot.known_pots as known_pots
+import smartpot.measurements as measurements
+import smartpot.persistance as persistance
+
+
+# Adds a known pot with the given address and returns its ID.
+def add_pot(addr):
+    return known_pots.add_known_pot(addr, 'Test Pot')
+
+
+# Counts the saved measurements of the pot with the given ID.
+def count_measurements(pot_id):
+    persistance.flush()
+    return sum(persistance.fetchone(f'''
+        SELECT COUNT(*) FROM {measurements.get_partition_table(month)}
+        WHERE pot_id = ?
+    ''', (pot_id,))[0] for month in measurements.partitions)
+
+
+def test_multi_sample_frame_saves_every_sample():
+    pot_id = add_pot('00:00:00:00:01:01')
+    samples = [(i, 1023 - i) for i in range(10)]
+    measurements.add_measurements(pot_id, samples, 60)
+    assert count_measurements(pot_id) == len(samples)
+    last_measurement = measurements.get_last_measurement(pot_id)
+    assert (last_measurement.soil_moisture,
+            last_measurement.water_level) == samples[-1]
+
+
+def test_samples_without_interval_are_rejected():
+    pot_id = add_pot('00:00:00:00:01:02')
+    with pytest.raises(ValueError):
+        measurements.add_measurements(pot_id, [(1, 2), (3, 4)], 0)
+    assert count_measurements(pot_id) == 0
+
+
+# Sums the counts of the rollups of the given resolution of the pot with the
+# given ID.
+def count_rollup_readings(pot_id, resolution):
+    persistance.flush()
+    return persistance.fetchone(f'''
+        SELECT COALESCE(SUM(count), 0) FROM measurement_rollups_{resolution}
+        WHERE pot_id = ?
+    ''', (pot_id,))[0]
+
+
+def test_rollups_cover_readings_that_are_not_saved():
+    pot_id = add_pot('00:00:00:00:01:04')
+    samples = [(100, 200)] * 5 + [(300, 400)]
+    measurements.add_measurements(pot_id, samples, 60)
+    assert count_measurements(pot_id) == 2
+    for resolution in measurements.ROLLUP_BUCKET_FORMATS:
+        assert count_rollup_readings(pot_id, resolution) == len(samples)
+    _, history = measurements.get_measurement_history(
+        pot_id, '2000-01-01 00:00:00', '2100-01-01 00:00:00', 'day')
+    assert sum(summary.count for summary in history) == len(samples)
+
+
+def test_reading_with_same_timestamp_does_not_become_saved_reading():
+    pot_id = add_pot('00:00:00:00:01:05')
+    timestamp = '2026-01-01 00:00:00'
+    assert measurements.should_save_reading(pot_id, 1, 1, 0.0, timestamp)
+    saved_reading = measurements.saved_readings[pot_id]
+    assert not measurements.should_save_reading(pot_id, 2, 2, 0.5, timestamp)
+    assert measurements.saved_readings[pot_id] == saved_reading
+    assert measurements.should_save_reading(pot_id, 2, 2, 1.0,
+                                            '2026-01-01 00:00:01')
+
+
+def test_readings_in_the_same_second_are_saved_once():
+    pot_id = add_pot('00:00:00:00:01:03')
+    for i in range(5):
+        measurements.add_measurement(pot_id, i, i)
+    assert 1 <= count_measurements(pot_id) <= 2
+    assert measurements.get_last_measurement(pot_id).soil_moisture == 4